@@ -0,0 +1,305 @@
+"""Нагрузочные сценарии для бота.
+
+Запуск: python bench.py <сценарий> [параметры]. Каждый сценарий работает
+на временной базе и не трогает bot.db. С USE_UVLOOP=1 сценарий идёт на uvloop.
+"""
+import argparse
+import asyncio
+import contextlib
+import importlib.util
+import os
+import re
+import sys
+import tempfile
+import time
+import types as pytypes
+import typing
+from datetime import datetime
+
+# main.py требует токен и ID модератора при импорте; к Telegram сценарии не обращаются
+os.environ.setdefault("BOT_TOKEN", "123456:bench")
+os.environ.setdefault("MODER_ID", "0")
+
+import aiosqlite
+from aiogram import Bot, types
+from aiogram.client.session.base import BaseSession
+
+import main
+from repository import MemoryRepository, SQLiteRepository
+
+
+async def prepare_db(path: str, users: int):
+    main.DB_PATH = path
+    await main.init_db()
+    async with aiosqlite.connect(path) as db:
+        await db.executemany(
+            "INSERT INTO users (tg_id, full_name) VALUES (?, ?)",
+            [(tg_id, f"User {tg_id}") for tg_id in range(1, users + 1)]
+        )
+        await db.executemany(
+            "INSERT INTO notification_prefs (user_id) VALUES (?)",
+            [(tg_id,) for tg_id in range(1, users + 1)]
+        )
+        await db.commit()
+
+
+async def bench_registrations(args) -> bool:
+    # Все пользователи одновременно жмут «Зарегистрироваться» (каждый по args.taps раз)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        await prepare_db(path, args.users)
+        async with aiosqlite.connect(path) as db:
+            cursor = await db.execute(
+                "INSERT INTO events (title, capacity, waitlist_enabled) VALUES ('Bench', ?, ?)",
+                (args.capacity, int(args.waitlist))
+            )
+            event_id = cursor.lastrowid
+            await db.commit()
+
+        taps = [tg_id for tg_id in range(1, args.users + 1) for _ in range(args.taps)]
+        started = time.perf_counter()
+        results = await asyncio.gather(*(main.repo.register(tg_id, event_id) for tg_id in taps))
+        elapsed = time.perf_counter() - started
+        await main.db_writer.close()
+
+        async with aiosqlite.connect(path) as db:
+            cursor = await db.execute(
+                "SELECT status, COUNT(*) FROM registrations WHERE event_id = ? GROUP BY status", (event_id,)
+            )
+            by_status = dict(await cursor.fetchall())
+            cursor = await db.execute("SELECT seats_taken FROM events WHERE id = ?", (event_id,))
+            seats_taken = (await cursor.fetchone())[0]
+
+    confirmed = by_status.get("confirmed", 0)
+    waitlisted = by_status.get("waitlist", 0)
+    expected_confirmed = min(args.capacity, args.users)
+    expected_waitlist = args.users - expected_confirmed if args.waitlist else 0
+
+    print(f"Нажатий: {len(taps)} за {elapsed:.2f} с ({len(taps) / elapsed:.0f}/с)")
+    print(f"Подтверждено: {confirmed}, в листе ожидания: {waitlisted}, seats_taken: {seats_taken}")
+    print(f"Ответы: { {r: results.count(r) for r in sorted(set(results))} }")
+
+    ok = (
+        confirmed == expected_confirmed == seats_taken
+        and waitlisted == expected_waitlist
+        and results.count("confirmed") == confirmed
+        and results.count("waitlist") == waitlisted
+    )
+    print("OK: нет перебронирования и потерянных регистраций" if ok else "FAIL: счётчики не сходятся")
+    return ok
+
+
+async def commit_per_write(tg_id: int):
+    # Прежний путь /start: своё соединение и свой коммит на каждую запись
+    async with aiosqlite.connect(main.DB_PATH) as db:
+        await db.execute("""
+            INSERT INTO users (tg_id, full_name, username)
+            VALUES (?, ?, ?)
+            ON CONFLICT(tg_id) DO UPDATE SET
+                full_name = excluded.full_name,
+                username = excluded.username
+        """, (tg_id, f"User {tg_id}", None))
+        await db.execute("INSERT OR IGNORE INTO notification_prefs (user_id) VALUES (?)", (tg_id,))
+        await db.commit()
+
+
+async def bench_writes(args) -> bool:
+    # Волна /start: args.writes одновременных upsert пользователя и его настроек
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        await prepare_db(path, 0)
+
+        # На прежнем пути часть записей может не дождаться блокировки — считаем их отдельно
+        failed = 0
+        started = time.perf_counter()
+        for i in range(0, args.writes, args.concurrency):
+            results = await asyncio.gather(
+                *(commit_per_write(tg_id) for tg_id in range(i + 1, min(i + args.concurrency, args.writes) + 1)),
+                return_exceptions=True
+            )
+            failed += sum(isinstance(result, Exception) for result in results)
+        baseline = (args.writes - failed) / (time.perf_counter() - started)
+
+        started = time.perf_counter()
+        for i in range(0, args.writes, args.concurrency):
+            await asyncio.gather(*(
+                main.repo.upsert_user(tg_id, f"User {tg_id}", None)
+                for tg_id in range(i + 1, min(i + args.concurrency, args.writes) + 1)
+            ))
+        grouped = args.writes / (time.perf_counter() - started)
+        await main.db_writer.close()
+
+        async with aiosqlite.connect(path) as db:
+            cursor = await db.execute("SELECT COUNT(*) FROM users")
+            users = (await cursor.fetchone())[0]
+
+    stats = main.db_writer.stats
+    print(f"Коммит на каждую запись: {baseline:.0f} записей/с (ошибок блокировки: {failed})")
+    print(f"Групповой коммит:        {grouped:.0f} записей/с "
+          f"({stats['batches']} пачек, в среднем {stats['operations'] / max(stats['batches'], 1):.1f} операций)")
+    return users == args.writes
+
+
+class NullSession(BaseSession):
+    # Сессия без сети: на любой метод Bot API отвечает заглушкой нужного типа
+    def __init__(self):
+        super().__init__()
+        self.calls = 0
+
+    async def make_request(self, bot, method, timeout=None):
+        self.calls += 1
+        returning = method.__returning__
+        options = typing.get_args(returning) if isinstance(returning, pytypes.UnionType) \
+            or typing.get_origin(returning) is typing.Union else (returning,)
+        if bool in options:
+            return True
+        if types.Message in options:
+            chat_id = getattr(method, "chat_id", 0) or 0
+            return types.Message(
+                message_id=self.calls, date=datetime.now(),
+                chat=types.Chat(id=chat_id, type="private")
+            )
+        return None
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b""
+
+    async def close(self):
+        pass
+
+
+def user_updates(tg_id: int, event_id: int) -> list[types.Update]:
+    # Типичная сессия пользователя: /start, профиль, настройки, переключатель, список и регистрация
+    user = types.User(id=tg_id, is_bot=False, first_name=f"User {tg_id}")
+    chat = types.Chat(id=tg_id, type="private")
+    message = types.Message(message_id=1, date=datetime.now(), chat=chat, from_user=user, text="/start")
+    updates = [types.Update(update_id=tg_id * 10, message=message)]
+    for i, data in enumerate(["my_profile", "notif_settings", "toggle_news", "active_events", f"reg_{event_id}"], 1):
+        updates.append(types.Update(update_id=tg_id * 10 + i, callback_query=types.CallbackQuery(
+            id=f"{tg_id}:{i}", from_user=user, chat_instance="bench", data=data,
+            message=types.Message(message_id=2, date=datetime.now(), chat=chat, from_user=user, caption="bench")
+        )))
+    return updates
+
+
+async def run_handlers(bot: Bot, repository, first_user: int, users: int) -> tuple[float, int, dict]:
+    # Подменяем хранилище и сбрасываем всё, что успело закэшироваться от прошлого прогона
+    main.repo = repository
+    main.MEDIA_CACHE = None
+    main.event_cache = main.RowCache(main.load_event_row, main.ROW_CACHE_SIZE)
+    main.location_cache = main.RowCache(main.load_location_row, main.ROW_CACHE_SIZE)
+    main.subscribers = main.SubscriberIndex()
+    for key in ("welcome", "profile", "notifications", "actives", "hub", "select", "news", "about"):
+        await repository.set_media_asset(key, f"bench-{key}", key)
+    event_id = await repository.create_event(
+        "Bench", "Нагрузочный прогон", "2099-01-01 18:00", "2099-01-01 12:00", "Кампус", None, 0
+    )
+
+    async def session(tg_id: int):
+        for update in user_updates(tg_id, event_id):
+            await main.dp.feed_update(bot, update)
+
+    # Свой сторож на прогон, чтобы перцентили задержки не смешивались между хранилищами
+    watchdog = main.LoopLagWatchdog(main.LAG_CHECK_INTERVAL, main.LAG_THRESHOLD_MS, main.LAG_WINDOW)
+    watchdog_task = asyncio.create_task(watchdog.run())
+    started = time.perf_counter()
+    await asyncio.gather(*(session(tg_id) for tg_id in range(first_user, first_user + users)))
+    elapsed = time.perf_counter() - started
+    watchdog_task.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+        await watchdog_task
+
+    confirmed = len([tg_id for tg_id in range(first_user, first_user + users)
+                     if await repository.confirmed_events(tg_id)])
+    return elapsed, confirmed, {**watchdog.percentiles(), "max": watchdog.stats["max_ms"]}
+
+
+async def bench_handlers(args) -> bool:
+    # Одни и те же обработчики на SQLite и в памяти: разница — доля времени, которую съедает хранилище
+    bot = Bot(token=main.BOT_TOKEN, session=NullSession())
+    with tempfile.TemporaryDirectory() as tmp:
+        await prepare_db(os.path.join(tmp, "bench.db"), 0)
+        # Разные диапазоны ID, чтобы троттлинг колбэков не помнил пользователей прошлого прогона
+        sqlite_time, sqlite_ok, sqlite_lag = await run_handlers(
+            bot, SQLiteRepository(main.connect_db, main.db_writer), 1, args.users
+        )
+        memory_time, memory_ok, memory_lag = await run_handlers(bot, MemoryRepository(), args.users + 1, args.users)
+        await main.db_writer.close()
+
+    updates = args.users * 6
+    for name, elapsed, lag in (("SQLite", sqlite_time, sqlite_lag), ("Память", memory_time, memory_lag)):
+        print(f"{name}: {updates} апдейтов за {elapsed:.2f} с ({updates / elapsed:.0f}/с), "
+              f"задержка цикла p50 {lag['p50']:.1f} / p99 {lag['p99']:.1f} / макс. {lag['max']:.0f} мс")
+    print(f"Доля хранилища в обработке: {max(0.0, 1 - memory_time / sqlite_time):.0%}")
+    print(f"Регистраций: SQLite {sqlite_ok}, память {memory_ok}; вызовов Bot API: {bot.session.calls}")
+    return sqlite_ok == memory_ok == args.users
+
+
+async def run_handlers_subprocess(users: int, use_uvloop: bool) -> dict | None:
+    # Каждый цикл — в своём процессе: состояние main.py привязано к одному event loop
+    env = {**os.environ, "USE_UVLOOP": "1" if use_uvloop else "0"}
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, os.path.abspath(__file__), "handlers", "--users", str(users),
+        env=env, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT
+    )
+    output = (await process.communicate())[0].decode()
+    results = {}
+    for name in ("SQLite", "Память"):
+        match = re.search(rf"^{name}: .*?\((\d+)/с\).*?p50 ([\d.]+) / p99 ([\d.]+)", output, re.M)
+        if not match:
+            print(output)
+            return None
+        results[name] = tuple(float(value) for value in match.groups())
+    return results
+
+
+async def bench_loops(args) -> bool:
+    # Тот же сценарий handlers на asyncio и на uvloop
+    if importlib.util.find_spec("uvloop") is None:
+        print("uvloop не установлен (pip install uvloop) — сравнивать не с чем")
+        return False
+
+    default = await run_handlers_subprocess(args.users, use_uvloop=False)
+    fast = await run_handlers_subprocess(args.users, use_uvloop=True)
+    if not default or not fast:
+        print("FAIL: сценарий handlers не отработал")
+        return False
+
+    for name in ("SQLite", "Память"):
+        (base_rate, base_p50, base_p99), (uv_rate, uv_p50, uv_p99) = default[name], fast[name]
+        print(f"{name}: asyncio {base_rate:.0f}/с (задержка p50 {base_p50:.1f} / p99 {base_p99:.1f} мс), "
+              f"uvloop {uv_rate:.0f}/с (p50 {uv_p50:.1f} / p99 {uv_p99:.1f} мс), "
+              f"выигрыш {uv_rate / base_rate - 1:+.0%}")
+    return True
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    scenarios = parser.add_subparsers(dest="scenario", required=True)
+
+    registrations = scenarios.add_parser("registrations", help="одновременная регистрация на мероприятие с лимитом мест")
+    registrations.add_argument("--users", type=int, default=3000)
+    registrations.add_argument("--capacity", type=int, default=500)
+    registrations.add_argument("--taps", type=int, default=2, help="нажатий на пользователя")
+    registrations.add_argument("--waitlist", action="store_true")
+    registrations.set_defaults(run=bench_registrations)
+
+    writes = scenarios.add_parser("writes", help="пропускная способность мелких записей: коммит на запись против группового")
+    writes.add_argument("--writes", type=int, default=5000)
+    writes.add_argument("--concurrency", type=int, default=500, help="одновременных обработчиков")
+    writes.set_defaults(run=bench_writes)
+
+    handlers = scenarios.add_parser("handlers", help="обработчики на SQLite против хранилища в памяти")
+    handlers.add_argument("--users", type=int, default=500)
+    handlers.set_defaults(run=bench_handlers)
+
+    loops = scenarios.add_parser("loops", help="сценарий handlers на asyncio против uvloop")
+    loops.add_argument("--users", type=int, default=500)
+    loops.set_defaults(run=bench_loops)
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    sys.exit(0 if main.run_event_loop(args.run(args)) else 1)
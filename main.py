@@ -1,29 +1,51 @@
+import time
+
+# Точка отсчёта для замера холодного старта
+STARTUP_STARTED = time.perf_counter()
+
 import asyncio
 import aiosqlite
 import os
-import qrcode
-import feedparser
-import asyncio
-from datetime import datetime, timezone
-from PIL import Image, ImageDraw
+import base64
+import csv
+import heapq
+import importlib.util
+import io
+import itertools
+import json
+import math
+import sqlite3
+import sys
+import threading
+import traceback
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter, OrderedDict, deque
+from contextvars import ContextVar
+from datetime import datetime, timedelta, timezone
 from io import BytesIO
-from aiogram import Bot, Dispatcher, types
+from aiogram import BaseMiddleware, Bot, Dispatcher, F, types
 from aiogram.filters import Command
-from aiogram.types import InlineKeyboardMarkup, BufferedInputFile, InputMediaAnimation, InputMediaPhoto
+from aiogram.types import (
+    InlineKeyboardMarkup, BufferedInputFile, InputMediaAnimation, InputMediaDocument, InputMediaPhoto,
+    KeyboardButton, ReplyKeyboardMarkup, ReplyKeyboardRemove,
+)
 from aiogram.utils.keyboard import InlineKeyboardBuilder
-from aiogram.exceptions import TelegramBadRequest
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.storage.memory import MemoryStorage
 from dotenv import load_dotenv
 
+import qr_sheets
+from repository import SQLiteRepository
+
 load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 MODERATOR_TG_ID = os.getenv("MODER_ID")
 BOT_USERNAME = "abitohelp_bot"
 
-LAST_PROCESSED_LINK = None
-
 if not BOT_TOKEN:
     raise ValueError("BOT_TOKEN не задан в .env")
 
@@ -33,6 +55,10 @@ except (ValueError, TypeError):
     raise ValueError("MODER_ID должен быть целым числом")
 
 DB_PATH = "bot.db"
+RSS_URL = "https://www.vsu.ru/ru/news/rss"
+
+# Глобальный лимит вызовов Bot API в секунду (лимит Telegram — около 30 сообщений)
+SEND_RATE = float(os.getenv("SEND_RATE", "25"))
 
 bot = Bot(token=BOT_TOKEN)
 dp = Dispatcher(storage=MemoryStorage())
@@ -40,77 +66,289 @@ dp = Dispatcher(storage=MemoryStorage())
 
 # === Вспомогательные функции ===
 
-async def rss_monitor():
-    global LAST_PROCESSED_LINK
-    rss_url = "https://www.vsu.ru/ru/news/rss"
+async def fetch_feed(url: str, **kwargs):
+    # feedparser тяжёлый и синхронный: импортируем при первом использовании
+    # и разбираем ленту в отдельном потоке, чтобы не блокировать event loop
+    import feedparser
+    return await asyncio.to_thread(feedparser.parse, url, **kwargs)
+
+
+# === Новостные ленты ===
+
+def parse_rss_feeds(value: str | None) -> list[tuple[str, str]]:
+    # RSS_FEEDS="Новости ВГУ|https://...,Приёмная комиссия|https://..."
+    feeds = []
+    for item in (value or "").split(","):
+        name, _, url = item.strip().rpartition("|")
+        if url:
+            feeds.append((name.strip() or url, url.strip()))
+    return feeds or [("Новости ВГУ", RSS_URL)]
+
+
+RSS_FEEDS = parse_rss_feeds(os.getenv("RSS_FEEDS"))
+# Интервал опроса подстраивается под ленту: чаще, пока она обновляется,
+# реже, пока молчит или недоступна
+RSS_MIN_INTERVAL = float(os.getenv("RSS_MIN_INTERVAL", "120"))
+RSS_MAX_INTERVAL = float(os.getenv("RSS_MAX_INTERVAL", "3600"))
+RSS_START_INTERVAL = 600
+
+
+class NewsFeed:
+    def __init__(self, feed_id: int, name: str, url: str, primed: bool):
+        self.id = feed_id
+        self.name = name
+        self.url = url
+        self.primed = primed
+        self.interval = RSS_START_INTERVAL
+        self.etag = None
+        self.modified = None
+        self.failures = 0
+        self.polls = 0
+        self.not_modified = 0
+
+    def adapt(self, new_items: int, failed: bool = False):
+        if failed:
+            self.failures += 1
+            self.interval = min(self.interval * 2, RSS_MAX_INTERVAL)
+        elif new_items:
+            self.failures = 0
+            self.interval = max(self.interval / 2, RSS_MIN_INTERVAL)
+        else:
+            self.failures = 0
+            self.interval = min(self.interval * 1.5, RSS_MAX_INTERVAL)
+
+
+NEWS_FEEDS: dict[int, NewsFeed] = {}
+
+
+async def load_news_feeds():
+    # Ленты из конфигурации заводим в таблице, чтобы у них были постоянные ID для подписок
+    async with aiosqlite.connect(DB_PATH) as db:
+        await db.executemany("""
+            INSERT INTO news_feeds (name, url) VALUES (?, ?)
+            ON CONFLICT(url) DO UPDATE SET name = excluded.name
+        """, RSS_FEEDS)
+        await db.commit()
+        cursor = await db.execute(
+            f"SELECT id, name, url, primed FROM news_feeds WHERE url IN ({','.join('?' * len(RSS_FEEDS))}) ORDER BY id",
+            [url for _, url in RSS_FEEDS]
+        )
+        rows = await cursor.fetchall()
+    NEWS_FEEDS.clear()
+    for feed_id, name, url, primed in rows:
+        NEWS_FEEDS[feed_id] = NewsFeed(feed_id, name, url, bool(primed))
+
+
+def normalize_news_link(link: str) -> str:
+    # Одна и та же новость в разных лентах отличается разве что хвостовым слэшем
+    return link.strip().rstrip("/")
+
+
+async def store_news_items(feed: NewsFeed, entries: list) -> list[dict]:
+    # Запоминаем новости; возвращаем только те, которых ещё не было ни в одной ленте
+    items = []
+    for entry in entries:
+        link = entry.get("link")
+        if not link:
+            continue
+        items.append({
+            "feed_id": feed.id,
+            "link": normalize_news_link(link),
+            "title": (entry.get("title") or "").strip(),
+            "description": entry.get("description") or "",
+            "published": entry.get("published", ""),
+            # Новости первого опроса ленты не рассылаются — ни сразу, ни дайджестом
+            "primed": int(not feed.primed),
+        })
+
+    async def operation(db):
+        new_items = []
+        for item in items:
+            cursor = await db.execute("""
+                INSERT INTO news_items (feed_id, link, title, description, published, primed)
+                VALUES (:feed_id, :link, :title, :description, :published, :primed)
+                ON CONFLICT(link) DO NOTHING
+                RETURNING id
+            """, item)
+            row = await cursor.fetchone()
+            await cursor.close()
+            if row:
+                new_items.append({**item, "id": row[0]})
+        if not feed.primed:
+            await db.execute("UPDATE news_feeds SET primed = 1 WHERE id = ?", (feed.id,))
+        return new_items
+    return await db_writer.submit(operation)
 
-    # Загружаем последнюю известную новость при старте
-    feed = feedparser.parse(rss_url)
-    if feed.entries:
-        LAST_PROCESSED_LINK = feed.entries[0].link
 
+def format_news_item(item: dict) -> str:
+    try:
+        dt = datetime.strptime(item["published"], "%a, %d %b %Y %H:%M:%S %z")
+        date_str = dt.strftime("%d.%m.%Y")
+    except (TypeError, ValueError):
+        date_str = ""
+
+    text = f"🗞 <b>{item['title']}</b>\n\n{item['description']}\n\n<a href='{item['link']}'>Читать далее</a>"
+    if date_str:
+        text = f"📅 {date_str}\n" + text
+    return text
+
+
+async def deliver_news(feed: NewsFeed, items: list[dict]):
+    # Тексты готовим заранее, чтобы не форматировать их для каждого получателя
+    texts = [format_news_item(item) for item in items]
+    news_segment = {"pref": "news", "kind": "all", "value": None, "feed": feed.id, "mode": "immediate"}
+    SUPPRESSION_STATS["suppressed"] += len(texts) * await count_segment(news_segment, active=False)
+    async for chunk in iter_recipient_chunks(news_segment):
+        for text in texts:
+            payload = {"type": "text", "text": text, "parse_mode": "HTML"}
+            _, blocked = await send_batch(chunk, payload)
+            if blocked:
+                blocked_ids = set(blocked)
+                chunk = [tg_id for tg_id in chunk if tg_id not in blocked_ids]
+
+
+async def poll_feed(feed: NewsFeed):
+    # Условный запрос: если лента не менялась, сервер отвечает 304 без тела
+    parsed = await fetch_feed(feed.url, etag=feed.etag, modified=feed.modified)
+    feed.polls += 1
+    if parsed.get("status") == 304:
+        feed.not_modified += 1
+        feed.adapt(0)
+        return
+    if parsed.get("bozo") and not parsed.entries:
+        raise parsed.get("bozo_exception") or ValueError("лента не разобрана")
+
+    feed.etag = parsed.get("etag")
+    feed.modified = parsed.get("modified")
+
+    new_items = await store_news_items(feed, parsed.entries)
+    if not feed.primed:
+        # Первый опрос новой ленты: запоминаем, что в ней уже есть, и ничего не рассылаем
+        feed.primed = True
+        feed.adapt(0)
+        return
+
+    feed.adapt(len(new_items))
+    if new_items:
+        print(f"[RSS] {feed.name}: новых новостей {len(new_items)}, следующий опрос через {feed.interval:.0f} с")
+        # Обрабатываем от старых к новым, чтобы сохранить хронологию
+        new_items.reverse()
+        await deliver_news(feed, new_items)
+
+
+async def feed_loop(feed: NewsFeed):
     while True:
         try:
-            feed = feedparser.parse(rss_url)
-            new_news = []
-
-            for entry in feed.entries:
-                # Останавливаемся, когда дошли до уже обработанной новости
-                if entry.link == LAST_PROCESSED_LINK:
-                    break
-                new_news.append(entry)
-
-            # Обрабатываем в обратном порядке (от старых к новым), чтобы сохранить хронологию
-            new_news.reverse()
-
-            if new_news:
-                # Сохраняем самую свежую ссылку
-                LAST_PROCESSED_LINK = feed.entries[0].link
-
-                # Получаем ID пользователей, подписанных на новости
-                async with aiosqlite.connect(DB_PATH) as db:
-                    cursor = await db.execute("""
-                        SELECT u.tg_id FROM users u
-                        JOIN notification_prefs np ON u.tg_id = np.user_id
-                        WHERE np.news_enabled = 1
-                    """)
-                    recipients = [row[0] for row in await cursor.fetchall()]
-
-                # Рассылаем каждую новость
-                for entry in new_news:
-                    title = entry.title
-                    description = entry.description or ""
-                    link = entry.link
-                    pub_date = entry.get('published', '')
-
-                    # Форматируем дату (опционально)
-                    try:
-                        dt = datetime.strptime(pub_date, "%a, %d %b % %H:%M:%S %z")
-                        date_str = dt.strftime("%d.%m.%Y")
-                    except:
-                        date_str = ""
-
-                    text = f"🗞 <b>{title}</b>\n\n{description}\n\n<a href='{link}'>Читать далее</a>"
-                    if date_str:
-                        text = f"📅 {date_str}\n" + text
-
-                    for tg_id in recipients:
-                        try:
-                            await bot.send_message(
-                                tg_id,
-                                text,
-                                parse_mode="HTML",
-                                disable_web_page_preview=False
-                            )
-                            await asyncio.sleep(0.05)  # избегаем лимитов Telegram
-                        except Exception:
-                            pass  # пользователь заблокировал бота
-
+            await poll_feed(feed)
         except Exception as e:
-            print(f"[RSS] Ошибка: {e}")
+            feed.adapt(0, failed=True)
+            print(f"[RSS] {feed.name}: ошибка ({e}), повтор через {feed.interval:.0f} с")
+        await asyncio.sleep(feed.interval)
+
+
+async def rss_monitor():
+    # Каждая лента опрашивается в своём цикле и со своим интервалом
+    await asyncio.gather(*(feed_loop(feed) for feed in NEWS_FEEDS.values()))
+
+
+# === Дайджест новостей ===
+
+NEWS_MODES = {"immediate": "Сразу", "hourly": "Раз в час", "daily": "Раз в день"}
+NEWS_DIGEST_HOUR = int(os.getenv("NEWS_DIGEST_HOUR", "18"))  # час ежедневного дайджеста
+DIGEST_TITLE_LIMIT = 100
+DIGEST_TEXT_LIMIT = 3800  # запас до лимита Telegram в 4096 символов
+
+# Сколько сообщений ушло дайджестами и сколько отдельных отправок они заменили
+DIGEST_STATS = {"messages": 0, "items": 0}
+
 
-        # Проверяем каждые 10 минут
-        await asyncio.sleep(600)
+def next_digest_time(mode: str, now: datetime) -> datetime:
+    if mode == "hourly":
+        return now.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+    fire_at = now.replace(hour=NEWS_DIGEST_HOUR, minute=0, second=0, microsecond=0)
+    return fire_at if fire_at > now else fire_at + timedelta(days=1)
+
+
+def format_news_digest(mode: str, items: list[tuple]) -> str:
+    header = "📰 <b>Новости за час</b>" if mode == "hourly" else "📰 <b>Новости за день</b>"
+    lines = [header, ""]
+    length = len(header) + 2
+    for i, (_, _, title, link) in enumerate(items):
+        if len(title) > DIGEST_TITLE_LIMIT:
+            title = title[:DIGEST_TITLE_LIMIT - 3] + "..."
+        line = f"• <a href='{link}'>{title}</a>"
+        if length + len(line) > DIGEST_TEXT_LIMIT:
+            lines.append(f"\n…и ещё {len(items) - i}")
+            break
+        lines.append(line)
+        length += len(line) + 1
+    return "\n".join(lines)
+
+
+async def send_news_digest(mode: str):
+    # Все новости, появившиеся после курсора режима, — одним сообщением на пользователя
+    async with aiosqlite.connect(DB_PATH) as db:
+        cursor = await db.execute("SELECT last_item_id FROM news_digest_cursors WHERE mode = ?", (mode,))
+        row = await cursor.fetchone()
+        cursor = await db.execute("SELECT COALESCE(MAX(id), 0) FROM news_items")
+        max_id = (await cursor.fetchone())[0]
+        if row is None:
+            # Первый запуск режима: старые новости не рассылаем
+            items = []
+        else:
+            cursor = await db.execute(
+                "SELECT id, feed_id, title, link FROM news_items WHERE id > ? AND id <= ? AND primed = 0 ORDER BY id",
+                (row[0], max_id)
+            )
+            items = await cursor.fetchall()
+
+    if items:
+        segment = {"pref": "news", "kind": "all", "value": None, "mode": mode}
+        async for chunk in iter_recipient_chunks(segment):
+            # Пользователи с одинаковыми отписками получают одинаковый текст
+            groups: dict[frozenset, list[int]] = {}
+            for tg_id in chunk:
+                groups.setdefault(frozenset(await subscribers.get_feed_optouts(tg_id)), []).append(tg_id)
+
+            for skipped_feeds, tg_ids in groups.items():
+                user_items = [item for item in items if item[1] not in skipped_feeds]
+                if not user_items:
+                    continue
+                payload = {"type": "text", "text": format_news_digest(mode, user_items), "parse_mode": "HTML"}
+                sent, _ = await send_batch(tg_ids, payload)
+                DIGEST_STATS["messages"] += sent
+                DIGEST_STATS["items"] += sent * len(user_items)
+
+    async def operation(db):
+        await db.execute("""
+            INSERT INTO news_digest_cursors (mode, last_item_id, sent_at) VALUES (?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(mode) DO UPDATE SET last_item_id = excluded.last_item_id, sent_at = excluded.sent_at
+        """, (mode, max_id))
+    await db_writer.submit(operation)
+    if items:
+        print(f"[DIGEST] {mode}: новостей {len(items)}")
+
+
+async def news_digest_loop():
+    # Курсоры в БД: пропущенное из-за перезапуска окно уйдёт следующим дайджестом
+    for mode in ("hourly", "daily"):
+        async with aiosqlite.connect(DB_PATH) as db:
+            cursor = await db.execute("SELECT 1 FROM news_digest_cursors WHERE mode = ?", (mode,))
+            initialized = await cursor.fetchone()
+        if not initialized:
+            await send_news_digest(mode)
+
+    while True:
+        now = datetime.now()
+        schedule = {mode: next_digest_time(mode, now) for mode in ("hourly", "daily")}
+        fire_at = min(schedule.values())
+        await asyncio.sleep(max((fire_at - datetime.now()).total_seconds(), 0))
+        for mode, mode_fire_at in schedule.items():
+            if mode_fire_at == fire_at:
+                try:
+                    await send_news_digest(mode)
+                except Exception as e:
+                    print(f"[DIGEST] Ошибка ({mode}): {e}")
 
 
 class EventCreation(StatesGroup):
@@ -127,6 +365,8 @@ class RoleAssignment(StatesGroup):
 
 class Broadcast(StatesGroup):
     waiting_for_message = State()
+    waiting_for_segment = State()
+    waiting_for_confirm = State()
 
 class UserSearch(StatesGroup):
     waiting_for_query = State()
@@ -137,6 +377,11 @@ class Feedback(StatesGroup):
 
 async def init_db():
     async with aiosqlite.connect(DB_PATH) as db:
+        # Для новой базы сразу включаем incremental vacuum (для существующей — см. обслуживание БД)
+        await db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        # WAL: читатели не ждут писателя, а групповой коммит пишет один fsync на пачку
+        await db.execute("PRAGMA journal_mode=WAL")
+
         await db.execute("""
         CREATE TABLE IF NOT EXISTS users (
             tg_id INTEGER PRIMARY KEY,
@@ -202,17 +447,171 @@ async def init_db():
         )
         """)
 
+        await db.execute("""
+        CREATE TABLE IF NOT EXISTS event_reminders (
+            event_id INTEGER,
+            kind TEXT,
+            sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY(event_id) REFERENCES events(id),
+            PRIMARY KEY(event_id, kind)
+        )
+        """)
+
+        # Пользователи, заблокировавшие бота, исключаются из рассылок до следующего /start
+        await ensure_column(db, "users", "is_active", "INTEGER NOT NULL DEFAULT 1")
+        await ensure_column(db, "users", "deactivated_at", "TIMESTAMP")
+
+        # Вместимость мероприятий: seats_taken поддерживается триггерами ниже
+        await ensure_column(db, "events", "capacity", "INTEGER")
+        await ensure_column(db, "events", "waitlist_enabled", "INTEGER NOT NULL DEFAULT 0")
+        if await ensure_column(db, "events", "seats_taken", "INTEGER NOT NULL DEFAULT 0"):
+            await db.execute("""
+                UPDATE events SET seats_taken = (
+                    SELECT COUNT(*) FROM registrations r
+                    WHERE r.event_id = events.id AND r.status = 'confirmed'
+                )
+            """)
+
+        await db.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_registrations_seat_insert
+        AFTER INSERT ON registrations WHEN NEW.status = 'confirmed'
+        BEGIN
+            UPDATE events SET seats_taken = seats_taken + 1 WHERE id = NEW.event_id;
+        END
+        """)
+        await db.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_registrations_seat_delete
+        AFTER DELETE ON registrations WHEN OLD.status = 'confirmed'
+        BEGIN
+            UPDATE events SET seats_taken = seats_taken - 1 WHERE id = OLD.event_id;
+        END
+        """)
+        await db.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_registrations_seat_update
+        AFTER UPDATE OF status ON registrations WHEN OLD.status IS NOT NEW.status
+        BEGIN
+            UPDATE events
+            SET seats_taken = seats_taken + (NEW.status = 'confirmed') - (OLD.status = 'confirmed')
+            WHERE id = NEW.event_id;
+        END
+        """)
+
+        # file_id заранее загруженного QR для входа на мероприятие
+        await ensure_column(db, "registrations", "qr_file_id", "TEXT")
+
+        # Новостные ленты, уже виденные новости (общие для всех лент) и отписки от отдельных лент
+        await db.execute("""
+        CREATE TABLE IF NOT EXISTS news_feeds (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            url TEXT NOT NULL UNIQUE,
+            primed BOOLEAN DEFAULT 0
+        )""")
+        await db.execute("""
+        CREATE TABLE IF NOT EXISTS news_items (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            feed_id INTEGER NOT NULL,
+            link TEXT NOT NULL UNIQUE,
+            title TEXT,
+            description TEXT,
+            published TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY(feed_id) REFERENCES news_feeds(id)
+        )""")
+        # Строки, сохранённые при первом опросе ленты: дайджест их пропускает
+        await ensure_column(db, "news_items", "primed", "INTEGER NOT NULL DEFAULT 0")
+        await db.execute("""
+        CREATE TABLE IF NOT EXISTS feed_optouts (
+            user_id INTEGER NOT NULL,
+            feed_id INTEGER NOT NULL,
+            PRIMARY KEY (user_id, feed_id)
+        )""")
+
+        # Режим доставки новостей: сразу или дайджестом; курсор — последняя разосланная новость
+        await ensure_column(db, "notification_prefs", "news_mode", "TEXT NOT NULL DEFAULT 'immediate'")
+        await db.execute("""
+        CREATE TABLE IF NOT EXISTS news_digest_cursors (
+            mode TEXT PRIMARY KEY,
+            last_item_id INTEGER NOT NULL,
+            sent_at TIMESTAMP
+        )""")
+
+        # Архив прошедших мероприятий и итоги посещений по архиву
+        await db.execute("""
+        CREATE TABLE IF NOT EXISTS events_archive (
+            id INTEGER PRIMARY KEY,
+            title TEXT NOT NULL,
+            description TEXT,
+            event_datetime TEXT,
+            location TEXT,
+            registration_deadline TEXT,
+            photo_file_id TEXT,
+            created_by INTEGER,
+            created_at TIMESTAMP,
+            capacity INTEGER,
+            waitlist_enabled INTEGER,
+            seats_taken INTEGER,
+            archived_at TIMESTAMP
+        )""")
+        await db.execute("""
+        CREATE TABLE IF NOT EXISTS registrations_archive (
+            user_id INTEGER,
+            event_id INTEGER,
+            registered_at TIMESTAMP,
+            status TEXT,
+            attended BOOLEAN,
+            archived_at TIMESTAMP,
+            PRIMARY KEY(user_id, event_id)
+        )""")
+        await db.execute("""
+        CREATE TABLE IF NOT EXISTS user_attendance_totals (
+            user_id INTEGER PRIMARY KEY,
+            registrations INTEGER NOT NULL DEFAULT 0,
+            attended INTEGER NOT NULL DEFAULT 0
+        )""")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_events_datetime ON events(event_datetime)")
+
+        # Журнал обслуживания БД
+        await db.execute("""
+        CREATE TABLE IF NOT EXISTS maintenance_log (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            task TEXT NOT NULL,
+            duration_ms REAL,
+            details TEXT,
+            started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )""")
+
+        # Индексы под сегменты рассылок
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_users_role ON users(role, tg_id)")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_users_status ON users(status, tg_id)")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_users_joined_at ON users(joined_at)")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_registrations_event ON registrations(event_id, user_id)")
+
         await db.commit()
 
 
-async def get_media_asset(key: str) -> str | None:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("SELECT file_id FROM media_assets WHERE key = ?", (key,))
-        row = await cursor.fetchone()
-        return row[0] if row else None
+async def ensure_column(db: aiosqlite.Connection, table: str, column: str, definition: str) -> bool:
+    # Простая миграция: добавляем колонку в существующую таблицу, если её ещё нет
+    cursor = await db.execute(f"PRAGMA table_info({table})")
+    if column in [row[1] for row in await cursor.fetchall()]:
+        return False
+    await db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+    return True
+
+
+# Кэш media_assets: ключей немного, из них собираются экраны меню (SCREENS)
+MEDIA_CACHE: dict[str, str] | None = None
+
+
+async def load_media_cache():
+    global MEDIA_CACHE
+    MEDIA_CACHE = await repo.media_assets()
+    compile_screens()
 
 
 def generate_qr(data: str) -> BytesIO:
+    import qrcode
+
     qr = qrcode.QRCode(version=1, box_size=8, border=2)
     qr.add_data(data)
     qr.make(fit=True)
@@ -224,6 +623,8 @@ def generate_qr(data: str) -> BytesIO:
 
 
 def generate_qr_gif(data: str) -> BytesIO:
+    import qrcode
+
     # Генерируем QR-код как изображение
     qr = qrcode.QRCode(version=1, box_size=8, border=2)
     qr.add_data(data)
@@ -237,9 +638,988 @@ def generate_qr_gif(data: str) -> BytesIO:
     return gif_bio
 
 
+# === Групповая запись в БД ===
+
+WRITE_BATCH_SIZE = int(os.getenv("WRITE_BATCH_SIZE", "200"))
+WRITE_BATCH_DELAY = float(os.getenv("WRITE_BATCH_DELAY_MS", "2")) / 1000
+
+
+class GroupCommitWriter:
+    # Единственный писатель: частые мелкие записи из обработчиков собираются в пачки
+    # и фиксируются одним коммитом (один fsync на пачку). Каждая операция выполняется
+    # в своём SAVEPOINT, поэтому ошибка одной не откатывает соседей по пачке.
+    def __init__(self, batch_size: int, delay: float):
+        self.batch_size = batch_size
+        self.delay = delay
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.task: asyncio.Task | None = None
+        self.stats = {"operations": 0, "batches": 0}
+
+    async def submit(self, operation):
+        # operation — корутинная функция, принимающая соединение; её результат вернётся вызывающему
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+        elif self.task.done():
+            # Писатель остановлен (close) или упал: операция никогда бы не выполнилась
+            raise RuntimeError("Писатель БД остановлен")
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((operation, future))
+        return await future
+
+    async def execute(self, sql: str, params=()) -> int:
+        async def operation(db):
+            cursor = await db.execute(sql, params)
+            return cursor.rowcount
+        return await self.submit(operation)
+
+    async def run(self):
+        batch = []
+        error = RuntimeError("Писатель БД остановлен")
+        try:
+            async with aiosqlite.connect(DB_PATH) as db:
+                while True:
+                    batch = [await self.queue.get()]
+                    if batch[0] is None:
+                        return
+                    # Даём набежать соседним записям, затем забираем всё, что уже в очереди
+                    await asyncio.sleep(self.delay)
+                    stop = False
+                    while len(batch) < self.batch_size and not self.queue.empty():
+                        item = self.queue.get_nowait()
+                        if item is None:
+                            stop = True
+                            break
+                        batch.append(item)
+
+                    await self.commit_batch(db, batch)
+                    batch = []
+                    if stop:
+                        return
+        except Exception as e:
+            # Ошибка уже в логе и дойдёт до ожидающих; submit теперь отказывает
+            print(f"[DB] Писатель остановился с ошибкой: {e!r}")
+            error = e
+        finally:
+            # Никто не должен ждать вечно: и взятые в работу, и оставшиеся в очереди операции получают ошибку
+            pending = [item for item in batch if item is not None]
+            while not self.queue.empty():
+                item = self.queue.get_nowait()
+                if item is not None:
+                    pending.append(item)
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(error)
+
+    async def commit_batch(self, db: aiosqlite.Connection, batch: list):
+        outcomes = []
+        try:
+            await db.execute("BEGIN IMMEDIATE")
+            for operation, future in batch:
+                await db.execute("SAVEPOINT operation")
+                try:
+                    result = await operation(db)
+                    await db.execute("RELEASE operation")
+                    outcomes.append((future, result, None))
+                except Exception as e:
+                    await db.execute("ROLLBACK TO operation")
+                    await db.execute("RELEASE operation")
+                    outcomes.append((future, None, e))
+            await db.commit()
+        except Exception as e:
+            if db.in_transaction:
+                await db.rollback()
+            outcomes = [(future, None, e) for _, future in batch]
+
+        self.stats["operations"] += len(batch)
+        self.stats["batches"] += 1
+        # Вызывающие узнают результат только после того, как пачка зафиксирована
+        for future, result, error in outcomes:
+            if future.cancelled():
+                continue
+            if error:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    async def close(self):
+        if self.task and not self.task.done():
+            self.queue.put_nowait(None)
+            await self.task
+        # После штатной остановки следующий submit запустит писателя заново
+        self.task = None
+
+
+db_writer = GroupCommitWriter(WRITE_BATCH_SIZE, WRITE_BATCH_DELAY)
+
+
+def connect_db() -> aiosqlite.Connection:
+    return aiosqlite.connect(DB_PATH)
+
+
+# Данные для обработчиков; стенд подменяет его на MemoryRepository
+repo = SQLiteRepository(connect_db, db_writer)
+
+
+# === Кэш строк мероприятий и локаций ===
+
+ROW_CACHE_SIZE = int(os.getenv("ROW_CACHE_SIZE", "1000"))
+
+
+class RowCache:
+    # Ограниченный read-through LRU. invalidate() повышает версию ключа: запись
+    # со старой версией считается промахом, а загрузка, начатая до инвалидации,
+    # не положит в кэш устаревшую строку. Одновременные промахи по одному ключу
+    # склеиваются в один запрос.
+    def __init__(self, loader, max_size: int):
+        self.loader = loader
+        self.max_size = max_size
+        self.entries: OrderedDict = OrderedDict()
+        self.versions: dict = {}
+        self.loading: dict = {}
+        self.stats = {"hits": 0, "misses": 0}
+
+    async def get(self, key):
+        version = self.versions.get(key, 0)
+        entry = self.entries.get(key)
+        if entry and entry[0] == version:
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry[1]
+
+        self.stats["misses"] += 1
+        pending = self.loading.get((key, version))
+        if pending:
+            return await asyncio.shield(pending)
+
+        future = asyncio.get_running_loop().create_future()
+        self.loading[(key, version)] = future
+        try:
+            value = await self.loader(key)
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # помечаем как полученное, если ждущих нет
+            raise
+        finally:
+            del self.loading[(key, version)]
+
+        future.set_result(value)
+        if self.versions.get(key, 0) == version:
+            self.entries[key] = (version, value)
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return value
+
+    def invalidate(self, key):
+        self.versions[key] = self.versions.get(key, 0) + 1
+        self.entries.pop(key, None)
+
+
+async def load_event_row(event_id: int) -> dict | None:
+    # seats_taken меняется при каждой регистрации, поэтому в кэш не попадает
+    return await repo.get_event(event_id)
+
+
+async def load_location_row(loc_id: str) -> dict | None:
+    return await repo.get_location(loc_id)
+
+
+event_cache = RowCache(load_event_row, ROW_CACHE_SIZE)
+location_cache = RowCache(load_location_row, ROW_CACHE_SIZE)
+
+
+# === Архив прошедших мероприятий ===
+
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "180"))
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "500"))  # регистраций за одну транзакцию
+ARCHIVE_INTERVAL = 24 * 3600
+
+ARCHIVE_STATS = {"events": 0, "registrations": 0}
+
+async def archive_past_events() -> tuple[int, int]:
+    # Мероприятия старше горизонта уезжают в архив вместе с регистрациями.
+    # Каждая пачка — отдельная короткая транзакция, между ними проходят остальные записи.
+    cutoff = (datetime.now() - timedelta(days=ARCHIVE_AFTER_DAYS)).strftime("%Y-%m-%d %H:%M")
+
+    events = registrations = 0
+    for event_id in await repo.past_event_ids(cutoff):
+        await repo.snapshot_event(event_id)
+        while moved := await repo.archive_registrations_batch(event_id, ARCHIVE_BATCH_SIZE):
+            registrations += moved
+            await asyncio.sleep(0.05)
+        await repo.delete_archived_event(event_id)
+        event_cache.invalidate(event_id)
+        events += 1
+
+    ARCHIVE_STATS["events"] += events
+    ARCHIVE_STATS["registrations"] += registrations
+    if events:
+        print(f"[ARCHIVE] В архив перенесено мероприятий: {events}, регистраций: {registrations}")
+    return events, registrations
+
+
+async def archive_loop():
+    while True:
+        try:
+            await archive_past_events()
+        except Exception as e:
+            print(f"[ARCHIVE] Ошибка: {e}")
+        await asyncio.sleep(ARCHIVE_INTERVAL)
+
+
+# === Подписчики в памяти ===
+
+class SubscriberSet:
+    # Отсортированный массив tg_id: 8 байт на пользователя, поиск бинарный
+    def __init__(self, ids=()):
+        self.ids = array("q", sorted(set(ids)))
+
+    def __contains__(self, tg_id: int) -> bool:
+        i = bisect_left(self.ids, tg_id)
+        return i < len(self.ids) and self.ids[i] == tg_id
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def add(self, tg_id: int):
+        i = bisect_left(self.ids, tg_id)
+        if i == len(self.ids) or self.ids[i] != tg_id:
+            self.ids.insert(i, tg_id)
+
+    def discard(self, tg_id: int):
+        i = bisect_left(self.ids, tg_id)
+        if i < len(self.ids) and self.ids[i] == tg_id:
+            del self.ids[i]
+
+    def iter_after(self, tg_id: int):
+        # Обходить целиком без await: массив может меняться между вызовами
+        ids = self.ids
+        for i in range(bisect_right(ids, tg_id), len(ids)):
+            yield ids[i]
+
+
+class SubscriberIndex:
+    # Кто получает уведомления о мероприятиях и новостях. Загружается при старте,
+    # дальше его обновляют те же обработчики, что пишут настройки в БД: сегменты
+    # «все подписчики» и экраны настроек обходятся без запросов
+    def __init__(self):
+        self.loaded = False
+        self.loading: asyncio.Task | None = None
+        self.known = SubscriberSet()
+        self.events = SubscriberSet()
+        self.news = SubscriberSet()
+        self.inactive = SubscriberSet()
+        # Режим доставки новостей храним только для тех, у кого он не «сразу»
+        self.modes: dict[int, str] = {}
+        # feed_id -> отписавшиеся от ленты
+        self.optouts: dict[int, SubscriberSet] = {}
+
+    async def load(self):
+        prefs, optouts = await repo.subscriber_snapshot()
+        self.known = SubscriberSet(row[0] for row in prefs)
+        self.events = SubscriberSet(row[0] for row in prefs if row[1])
+        self.news = SubscriberSet(row[0] for row in prefs if row[2])
+        self.inactive = SubscriberSet(row[0] for row in prefs if not row[4])
+        self.modes = {row[0]: row[3] for row in prefs if row[3] != "immediate"}
+        by_feed: dict[int, list[int]] = {}
+        for user_id, feed_id in optouts:
+            by_feed.setdefault(feed_id, []).append(user_id)
+        self.optouts = {feed_id: SubscriberSet(ids) for feed_id, ids in by_feed.items()}
+        self.loaded = True
+        print(f"[SUBS] События: {len(self.events)}, новости: {len(self.news)}, неактивных: {len(self.inactive)}")
+
+    async def ensure_loaded(self):
+        # Одновременные первые обращения ждут одну загрузку, а не запускают свои
+        if self.loaded:
+            return
+        if self.loading is None or self.loading.done():
+            self.loading = asyncio.create_task(self.load())
+        await asyncio.shield(self.loading)
+
+    async def get_prefs(self, tg_id: int) -> tuple[bool, bool, str]:
+        await self.ensure_loaded()
+        return tg_id in self.events, tg_id in self.news, self.modes.get(tg_id, "immediate")
+
+    async def get_feed_optouts(self, tg_id: int) -> set[int]:
+        await self.ensure_loaded()
+        return {feed_id for feed_id, users in self.optouts.items() if tg_id in users}
+
+    def user_started(self, tg_id: int):
+        # /start: новый пользователь подписан на всё, вернувшийся снова активен
+        if tg_id not in self.known:
+            self.known.add(tg_id)
+            self.events.add(tg_id)
+            self.news.add(tg_id)
+        self.inactive.discard(tg_id)
+
+    def set_prefs(self, tg_id: int, events_on: bool, news_on: bool, news_mode: str):
+        (self.events.add if events_on else self.events.discard)(tg_id)
+        (self.news.add if news_on else self.news.discard)(tg_id)
+        if news_mode == "immediate":
+            self.modes.pop(tg_id, None)
+        else:
+            self.modes[tg_id] = news_mode
+
+    def set_feed_optout(self, tg_id: int, feed_id: int, subscribed: bool):
+        users = self.optouts.setdefault(feed_id, SubscriberSet())
+        (users.discard if subscribed else users.add)(tg_id)
+
+    def deactivate(self, tg_ids: list[int]):
+        for tg_id in tg_ids:
+            self.inactive.add(tg_id)
+
+    def matching(self, segment: dict, after: int, active: bool = True):
+        # Только сегмент kind="all": остальные условия живут в таблицах users и registrations
+        pref = segment.get("pref")
+        if pref == "events":
+            candidates = self.events.iter_after(after)
+        elif pref == "news":
+            candidates = self.news.iter_after(after)
+        elif pref == "any":
+            candidates = heapq.merge(self.events.iter_after(after), self.news.iter_after(after))
+        else:
+            candidates = self.known.iter_after(after)
+        mode = segment.get("mode")
+        skipped = self.optouts.get(segment["feed"]) if segment.get("feed") else None
+
+        previous = None
+        for tg_id in candidates:
+            if tg_id == previous:
+                continue
+            previous = tg_id
+            if (tg_id in self.inactive) == active:
+                continue
+            if mode and self.modes.get(tg_id, "immediate") != mode:
+                continue
+            if skipped and tg_id in skipped:
+                continue
+            yield tg_id
+
+
+subscribers = SubscriberIndex()
+
+
+# === Сегменты аудитории ===
+
+RECIPIENT_CHUNK_SIZE = 500
+
+SEGMENT_HELP = (
+    "🎯 Укажите <b>сегмент получателей</b>:\n\n"
+    "<code>all</code> — все подписчики\n"
+    "<code>role:student</code> — по роли (applicant, student, curator, moderator)\n"
+    "<code>status:Зачислен</code> — по статусу\n"
+    "<code>event:12</code> — зарегистрированные на мероприятие\n"
+    "<code>joined:2025-06-01</code> — присоединившиеся с даты\n"
+    "<code>joined:2025-06-01..2025-07-01</code> — присоединившиеся в период"
+)
+
+
+def parse_segment(text: str, pref: str = "any") -> dict | None:
+    text = text.strip()
+    if text.lower() in ("all", "все"):
+        return {"pref": pref, "kind": "all", "value": None}
+
+    kind, sep, value = text.partition(":")
+    kind, value = kind.strip().lower(), value.strip()
+    if not sep or not value:
+        return None
+
+    if kind == "role":
+        if value not in ("applicant", "student", "curator", "moderator"):
+            return None
+        return {"pref": pref, "kind": "role", "value": value}
+    if kind == "status":
+        return {"pref": pref, "kind": "status", "value": value}
+    if kind == "event":
+        if not value.isdigit():
+            return None
+        return {"pref": pref, "kind": "event", "value": int(value)}
+    if kind == "joined":
+        since, _, until = value.partition("..")
+        try:
+            for day in filter(None, (since, until)):
+                datetime.strptime(day, "%Y-%m-%d")
+        except ValueError:
+            return None
+        return {"pref": pref, "kind": "joined", "value": [since or None, until or None]}
+    return None
+
+
+def describe_segment(segment: dict) -> str:
+    kind, value = segment["kind"], segment["value"]
+    if kind == "role":
+        return f"роль {value}"
+    if kind == "status":
+        return f"статус «{value}»"
+    if kind == "event":
+        return f"участники мероприятия {value}"
+    if kind == "not_event":
+        return f"не зарегистрированные на мероприятие {value}"
+    if kind == "joined":
+        since, until = value
+        return f"присоединились {'с ' + since if since else ''} {'по ' + until if until else ''}".strip()
+    return "все подписчики"
+
+
+async def count_segment(segment: dict, active: bool = True) -> int:
+    if segment.get("kind", "all") == "all":
+        await subscribers.ensure_loaded()
+        return sum(1 for _ in subscribers.matching(segment, -(2 ** 63), active))
+
+    return await repo.count_segment(segment, active)
+
+
+async def iter_recipient_chunks(segment: dict, chunk_size: int = RECIPIENT_CHUNK_SIZE):
+    # Keyset-пагинация по ID пользователя: в памяти не больше одной пачки,
+    # соединение не держится открытым, пока идёт отправка
+    # Сегмент «все подписчики» берётся из индекса в памяти с той же пагинацией
+    in_memory = segment.get("kind", "all") == "all"
+    if in_memory:
+        await subscribers.ensure_loaded()
+    last_id = -(2 ** 63)
+    while True:
+        if in_memory:
+            chunk = list(itertools.islice(subscribers.matching(segment, last_id), chunk_size))
+        else:
+            chunk = await repo.segment_page(segment, last_id, chunk_size)
+
+        if not chunk:
+            return
+        yield chunk
+        if len(chunk) < chunk_size:
+            return
+        last_id = chunk[-1]
+
+
+def message_payload(message: types.Message) -> dict:
+    # Снимок сообщения модератора, который можно разослать повторно
+    def html_mode(text: str | None) -> str | None:
+        return "HTML" if text and "<" in text else None
+
+    if message.text:
+        return {"type": "text", "text": message.text, "parse_mode": html_mode(message.text)}
+    if message.photo:
+        return {"type": "photo", "file_id": message.photo[-1].file_id,
+                "caption": message.caption, "parse_mode": html_mode(message.caption)}
+    if message.video:
+        return {"type": "video", "file_id": message.video.file_id,
+                "caption": message.caption, "parse_mode": html_mode(message.caption)}
+    if message.animation:
+        return {"type": "animation", "file_id": message.animation.file_id,
+                "caption": message.caption, "parse_mode": html_mode(message.caption)}
+    return {"type": "text", "text": "Сообщение от модератора", "parse_mode": None}
+
+
+async def send_payload(tg_id: int, payload: dict):
+    kind = payload["type"]
+    reply_markup = payload.get("reply_markup")
+    if kind == "photo":
+        await bot.send_photo(tg_id, photo=payload["file_id"], caption=payload.get("caption"),
+                             parse_mode=payload.get("parse_mode"), reply_markup=reply_markup)
+    elif kind == "video":
+        await bot.send_video(tg_id, video=payload["file_id"], caption=payload.get("caption"),
+                             parse_mode=payload.get("parse_mode"), reply_markup=reply_markup)
+    elif kind == "animation":
+        await bot.send_animation(tg_id, animation=payload["file_id"], caption=payload.get("caption"),
+                                 parse_mode=payload.get("parse_mode"), reply_markup=reply_markup)
+    else:
+        await bot.send_message(tg_id, payload["text"], parse_mode=payload.get("parse_mode"),
+                               reply_markup=reply_markup)
+
+
+# === Планировщик вызовов Bot API ===
+
+# Полоса текущего вызова: ответы пользователям идут раньше массовых рассылок
+api_lane: ContextVar[str] = ContextVar("api_lane", default="interactive")
+API_LANES = ("interactive", "bulk")
+API_RETRY_ATTEMPTS = int(os.getenv("API_RETRY_ATTEMPTS", "3"))
+# Long polling не расходует лимит отправки и не должен стоять в очереди
+API_UNTHROTTLED_METHODS = {"getUpdates", "getMe"}
+
+
+class ApiScheduler(BaseRequestMiddleware):
+    # Общий token bucket на все исходящие вызовы. Токен достаётся первому
+    # ожидающему из interactive, bulk получает только то, что осталось.
+    # На 429 (retry_after) останавливается вся отправка, вызов повторяется.
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.waiters = {lane: deque() for lane in API_LANES}
+        self.wakeup = asyncio.Event()
+        self.task: asyncio.Task | None = None
+        self.stats = {lane: {"calls": 0, "wait_total": 0.0, "wait_max": 0.0} for lane in API_LANES}
+        self.stats["retry_after"] = 0
+
+    async def acquire(self, lane: str):
+        loop = asyncio.get_running_loop()
+        if self.task is None or self.task.done() or self.task.get_loop() is not loop:
+            self.wakeup = asyncio.Event()
+            self.task = loop.create_task(self.run())
+        started = time.monotonic()
+        future = loop.create_future()
+        self.waiters[lane].append(future)
+        self.wakeup.set()
+        try:
+            await future
+        except asyncio.CancelledError:
+            # Отменили уже после выдачи токена: возвращаем его следующему ожидающему
+            if future.done() and not future.cancelled():
+                self.tokens = min(self.capacity, self.tokens + 1)
+                self.wakeup.set()
+            raise
+
+        waited = time.monotonic() - started
+        stats = self.stats[lane]
+        stats["calls"] += 1
+        stats["wait_total"] += waited
+        stats["wait_max"] = max(stats["wait_max"], waited)
+
+    def next_waiter(self) -> asyncio.Future | None:
+        for lane in API_LANES:
+            queue = self.waiters[lane]
+            while queue:
+                future = queue.popleft()
+                if not future.done():  # ожидавший вызов могли отменить
+                    return future
+        return None
+
+    async def run(self):
+        while True:
+            if not any(self.waiters.values()):
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                continue
+
+            future = self.next_waiter()
+            if future:
+                self.tokens -= 1
+                future.set_result(None)
+
+    async def __call__(self, make_request, bot, method):
+        if method.__api_method__ in API_UNTHROTTLED_METHODS:
+            return await make_request(bot, method)
+
+        lane = api_lane.get()
+        for attempt in range(API_RETRY_ATTEMPTS):
+            await self.acquire(lane)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                self.stats["retry_after"] += 1
+                self.paused_until = max(self.paused_until, time.monotonic() + e.retry_after)
+                if attempt == API_RETRY_ATTEMPTS - 1:
+                    raise
+
+    def queue_depth(self, lane: str) -> int:
+        return sum(not future.done() for future in self.waiters[lane])
+
+
+api_scheduler = ApiScheduler(SEND_RATE)
+bot.session.middleware(api_scheduler)
+
+
+BACKGROUND_TASKS: set[asyncio.Task] = set()
+
+
+def spawn(coro) -> asyncio.Task:
+    # Держим ссылку на фоновую задачу, иначе её может собрать GC
+    task = asyncio.create_task(coro)
+    BACKGROUND_TASKS.add(task)
+    task.add_done_callback(BACKGROUND_TASKS.discard)
+    return task
+
+
+# Счётчики подавленных отправок с момента запуска
+SUPPRESSION_STATS = {"deactivated": 0, "suppressed": 0}
+
+
+def is_unreachable_error(error: Exception) -> bool:
+    # Пользователь заблокировал бота, удалил аккаунт или чат больше не существует
+    if isinstance(error, TelegramForbiddenError):
+        return True
+    return isinstance(error, TelegramBadRequest) and "chat not found" in str(error).lower()
+
+
+async def mark_users_inactive(tg_ids: list[int]):
+    if not tg_ids:
+        return
+    await repo.mark_inactive(tg_ids)
+    subscribers.deactivate(tg_ids)
+    SUPPRESSION_STATS["deactivated"] += len(tg_ids)
+
+
+async def send_batch(tg_ids: list[int], payload: dict) -> tuple[int, list[int]]:
+    blocked = []
+
+    async def send_one(tg_id: int) -> bool:
+        # Каждый send_one — отдельная задача gather, полоса не утекает наружу
+        api_lane.set("bulk")
+        try:
+            await send_payload(tg_id, payload)
+            return True
+        except Exception as e:
+            if is_unreachable_error(e):
+                blocked.append(tg_id)
+            return False
+
+    results = await asyncio.gather(*(send_one(tg_id) for tg_id in tg_ids))
+    await mark_users_inactive(blocked)
+    return sum(results), blocked
+
+
+async def deliver_to_segment(segment: dict, payload: dict) -> dict:
+    stats = {"sent": 0, "failed": 0, "blocked": 0, "total": 0}
+    # Неактивные пользователи в выборку не попадают — считаем, сколько отправок сэкономили
+    stats["suppressed"] = await count_segment(segment, active=False)
+    SUPPRESSION_STATS["suppressed"] += stats["suppressed"]
+
+    async for chunk in iter_recipient_chunks(segment):
+        sent, blocked = await send_batch(chunk, payload)
+        stats["total"] += len(chunk)
+        stats["sent"] += sent
+        stats["blocked"] += len(blocked)
+        stats["failed"] += len(chunk) - sent - len(blocked)
+    return stats
+
+
+def delivery_report(stats: dict) -> str:
+    text = f"📤 Рассылка отправлена {stats['sent']} из {stats['total']} пользователей."
+    if stats["blocked"]:
+        text += f"\n🚫 Заблокировали бота: {stats['blocked']}"
+    if stats["failed"]:
+        text += f"\n⚠️ Ошибки отправки: {stats['failed']}"
+    if stats["suppressed"]:
+        text += f"\n💤 Пропущено неактивных: {stats['suppressed']}"
+    return text
+
+
+# === Фоновые рассылки с прогрессом ===
+
+BROADCAST_BATCH_SIZE = int(os.getenv("BROADCAST_BATCH_SIZE", "100"))
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", "3"))
+
+BROADCAST_JOBS: dict[int, "BroadcastJob"] = {}
+broadcast_job_ids = itertools.count(1)
+
+
+class BroadcastJob:
+    # Рассылка модератора как отслеживаемая задача: пауза и отмена проверяются
+    # перед каждой пачкой, статус редактируется не чаще BROADCAST_PROGRESS_INTERVAL
+    def __init__(self, segment: dict, payload: dict, status_message: types.Message):
+        self.id = next(broadcast_job_ids)
+        self.segment = segment
+        self.payload = payload
+        self.status_message = status_message
+        self.stats = {"sent": 0, "failed": 0, "blocked": 0, "total": 0, "suppressed": 0}
+        self.expected = 0
+        self.state = "running"  # running / paused / cancelled / done
+        self.resumed = asyncio.Event()
+        self.resumed.set()
+        self.started = time.monotonic()
+        self.paused_at = None
+        self.paused_total = 0.0
+        self.rendered_at = 0.0
+
+    def pause(self):
+        if self.state == "running":
+            self.state = "paused"
+            self.paused_at = time.monotonic()
+            self.resumed.clear()
+
+    def resume(self):
+        if self.state == "paused":
+            self.state = "running"
+            self.paused_total += time.monotonic() - self.paused_at
+            self.paused_at = None
+            self.resumed.set()
+
+    def cancel(self):
+        if self.state in ("running", "paused"):
+            self.resume()
+            self.state = "cancelled"
+
+    def throughput(self) -> float:
+        now = self.paused_at or time.monotonic()
+        elapsed = now - self.started - self.paused_total
+        return self.stats["total"] / elapsed if elapsed > 0 else 0.0
+
+    def controls_kb(self) -> InlineKeyboardMarkup | None:
+        if self.state not in ("running", "paused"):
+            return None
+        builder = InlineKeyboardBuilder()
+        if self.state == "running":
+            builder.button(text="⏸ Пауза", callback_data=f"bcjob_pause_{self.id}")
+        else:
+            builder.button(text="▶️ Продолжить", callback_data=f"bcjob_resume_{self.id}")
+        builder.button(text="⏹ Отменить", callback_data=f"bcjob_cancel_{self.id}")
+        return builder.as_markup()
+
+    def status_text(self) -> str:
+        if self.state in ("done", "cancelled"):
+            text = delivery_report(self.stats)
+            if self.state == "cancelled":
+                remaining = max(self.expected - self.stats["total"], 0)
+                text = f"⏹ <b>Рассылка отменена</b>\n{text}\n⏳ Не отправлено: {remaining}"
+            return text
+
+        header = "⏸ <b>Рассылка на паузе</b>" if self.state == "paused" else "📤 <b>Идёт рассылка</b>"
+        remaining = max(self.expected - self.stats["total"], 0)
+        return (
+            f"{header}\n\n"
+            f"✅ Отправлено: {self.stats['sent']}\n"
+            f"⚠️ Ошибок: {self.stats['failed'] + self.stats['blocked']}\n"
+            f"⏳ Осталось: {remaining}\n"
+            f"⚡ Скорость: {self.throughput():.1f} сообщ./с"
+        )
+
+    async def render(self, force: bool = False):
+        now = time.monotonic()
+        if not force and now - self.rendered_at < BROADCAST_PROGRESS_INTERVAL:
+            return
+        self.rendered_at = now
+        try:
+            await self.status_message.edit_text(
+                self.status_text(), parse_mode="HTML", reply_markup=self.controls_kb()
+            )
+        except TelegramBadRequest:
+            pass  # текст не изменился или сообщение удалено — прогресс не критичен
+
+    async def run(self):
+        BROADCAST_JOBS[self.id] = self
+        try:
+            self.expected = await count_segment(self.segment)
+            self.stats["suppressed"] = await count_segment(self.segment, active=False)
+            SUPPRESSION_STATS["suppressed"] += self.stats["suppressed"]
+            await self.render(force=True)
+
+            async for chunk in iter_recipient_chunks(self.segment):
+                for i in range(0, len(chunk), BROADCAST_BATCH_SIZE):
+                    await self.resumed.wait()
+                    if self.state == "cancelled":
+                        return
+                    batch = chunk[i:i + BROADCAST_BATCH_SIZE]
+                    sent, blocked = await send_batch(batch, self.payload)
+                    self.stats["total"] += len(batch)
+                    self.stats["sent"] += sent
+                    self.stats["blocked"] += len(blocked)
+                    self.stats["failed"] += len(batch) - sent - len(blocked)
+                    await self.render()
+            self.state = "done"
+        except Exception as e:
+            print(f"[BROADCAST] Задача {self.id} прервана: {e}")
+            self.state = "cancelled"
+        finally:
+            BROADCAST_JOBS.pop(self.id, None)
+            await self.render(force=True)
+
+
+# === Напоминания о мероприятиях ===
+
+EVENT_REMINDERS = {
+    "event_24h": timedelta(hours=24),
+    "event_1h": timedelta(hours=1),
+}
+REG_CLOSING_REMINDER = timedelta(hours=int(os.getenv("REG_CLOSING_REMINDER_HOURS", "6")))
+
+
+def parse_event_time(value: str | None) -> datetime | None:
+    try:
+        return datetime.strptime(value, "%Y-%m-%d %H:%M")
+    except (TypeError, ValueError):
+        return None
+
+
+def format_time_left(delta: timedelta) -> str:
+    minutes = max(int(delta.total_seconds() // 60), 0)
+    if minutes >= 120:
+        return f"{round(minutes / 60)} ч"
+    if minutes >= 60:
+        return f"1 ч {minutes - 60} мин" if minutes > 60 else "1 ч"
+    return f"{minutes} мин"
+
+
+class ReminderScheduler:
+    # Min-heap (время срабатывания, event_id, вид напоминания).
+    # Отправленные напоминания пишутся в event_reminders, поэтому
+    # после перезапуска очередь восстанавливается без повторов.
+    def __init__(self):
+        self.heap: list[tuple[datetime, int, str]] = []
+        self.wakeup = asyncio.Event()
+        # Напоминания, которые прямо сейчас рассылаются: отметка в БД появится только после отправки
+        self.firing: set[tuple[int, str]] = set()
+
+    def add_event(self, event_id: int, event_datetime: str | None, registration_deadline: str | None,
+                  sent: set[str] = frozenset()):
+        now = datetime.now()
+        starts_at = parse_event_time(event_datetime)
+        if starts_at and starts_at > now:
+            for kind, offset in EVENT_REMINDERS.items():
+                superseded = any(starts_at - o <= now for o in EVENT_REMINDERS.values() if o < offset)
+                if kind not in sent and not superseded:
+                    heapq.heappush(self.heap, (starts_at - offset, event_id, kind))
+
+        deadline = parse_event_time(registration_deadline)
+        if deadline and deadline > now and "reg_closing" not in sent:
+            heapq.heappush(self.heap, (deadline - REG_CLOSING_REMINDER, event_id, "reg_closing"))
+
+        self.wakeup.set()
+
+    async def rebuild(self):
+        self.heap.clear()
+        async with aiosqlite.connect(DB_PATH) as db:
+            cursor = await db.execute("SELECT event_id, kind FROM event_reminders")
+            sent: dict[int, set[str]] = {}
+            for event_id, kind in await cursor.fetchall():
+                sent.setdefault(event_id, set()).add(kind)
+
+            cursor = await db.execute("""
+                SELECT id, event_datetime, registration_deadline FROM events
+                WHERE datetime(event_datetime) > datetime('now', 'localtime')
+                   OR datetime(registration_deadline) > datetime('now', 'localtime')
+            """)
+            rows = await cursor.fetchall()
+
+        for event_id, event_datetime, registration_deadline in rows:
+            self.add_event(event_id, event_datetime, registration_deadline, sent.get(event_id, set()))
+        print(f"[Reminders] В очереди {len(self.heap)} напоминаний")
+
+    async def run(self):
+        while True:
+            self.wakeup.clear()
+            if not self.heap:
+                await self.wakeup.wait()
+                continue
+
+            fire_at, event_id, kind = self.heap[0]
+            delay = (fire_at - datetime.now()).total_seconds()
+            if delay > 0:
+                # Просыпаемся раньше, если в очередь добавили более срочное напоминание
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=min(delay, 3600))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            heapq.heappop(self.heap)
+            spawn(self.fire(event_id, kind))
+
+    async def fire(self, event_id: int, kind: str):
+        try:
+            event = await event_cache.get(event_id)
+            if not event:
+                return
+
+            event_datetime, registration_deadline = event["event_datetime"], event["registration_deadline"]
+            now = datetime.now()
+            if kind == "reg_closing":
+                anchor = parse_event_time(registration_deadline)
+                pending_offsets = []
+            else:
+                anchor = parse_event_time(event_datetime)
+                # Если уже пора и более позднему напоминанию, это пропускаем
+                pending_offsets = [o for k, o in EVENT_REMINDERS.items() if o < EVENT_REMINDERS[kind]]
+            if not anchor or anchor <= now or any(anchor - o <= now for o in pending_offsets):
+                return
+
+            key = (event_id, kind)
+            if key in self.firing:
+                return
+            async with aiosqlite.connect(DB_PATH) as db:
+                cursor = await db.execute(
+                    "SELECT 1 FROM event_reminders WHERE event_id = ? AND kind = ?", key
+                )
+                if await cursor.fetchone():
+                    return  # уже отправлено
+            self.firing.add(key)
+            try:
+                await self.deliver(event_id, kind, event, anchor, now)
+            finally:
+                self.firing.discard(key)
+        except Exception as e:
+            print(f"[Reminders] Ошибка: {e}")
+
+    async def deliver(self, event_id: int, kind: str, event: dict, anchor: datetime, now: datetime):
+        title, location = event["title"], event["location"]
+        event_datetime, registration_deadline = event["event_datetime"], event["registration_deadline"]
+        if kind == "reg_closing":
+            # Занятые места в кэше не хранятся — берём текущие из базы
+            async with aiosqlite.connect(DB_PATH) as db:
+                cursor = await db.execute(
+                    "SELECT capacity, seats_taken, waitlist_enabled FROM events WHERE id = ?", (event_id,)
+                )
+                row = await cursor.fetchone()
+            if not row:
+                return
+            capacity, seats_taken, waitlist_enabled = row
+            full = capacity is not None and seats_taken >= capacity
+            if full and not waitlist_enabled:
+                # Отметку не ставим: если до перезапуска места освободятся, напоминание ещё уйдёт
+                print(f"[Reminders] reg_closing для мероприятия {event_id} пропущено: мест нет")
+                return
+
+            segment = {"pref": "events", "kind": "not_event", "value": event_id}
+            call_to_action = "Мест нет, но можно встать в лист ожидания." if full else "Успейте записаться!"
+            payload = {
+                "type": "text",
+                "text": (
+                    f"⏳ Регистрация на <b>{title}</b> закрывается через {format_time_left(anchor - now)} "
+                    f"({registration_deadline}).\n\n{call_to_action}"
+                ),
+                "parse_mode": "HTML",
+                "reply_markup": event_register_kb(event_id),
+            }
+        else:
+            # Записавшимся напоминаем всегда: отключённые анонсы не отменяют их собственную запись
+            segment = {"kind": "event", "value": event_id}
+            payload = {
+                "type": "text",
+                "text": (
+                    f"⏰ <b>Напоминание</b>\n\n"
+                    f"🎉 <b>{title}</b> начнётся через {format_time_left(anchor - now)}\n"
+                    f"📅 {event_datetime}\n"
+                    f"📍 {location}"
+                ),
+                "parse_mode": "HTML",
+            }
+
+        stats = await deliver_to_segment(segment, payload)
+        # Отметка только после рассылки: при падении посреди отправки напоминание уйдёт после перезапуска
+        await db_writer.execute(
+            "INSERT OR IGNORE INTO event_reminders (event_id, kind) VALUES (?, ?)",
+            (event_id, kind)
+        )
+        print(
+            f"[Reminders] {kind} для мероприятия {event_id}: {stats['sent']} из {stats['total']}, "
+            f"заблокировали {stats['blocked']}, пропущено неактивных {stats['suppressed']}"
+        )
+
+
+reminder_scheduler = ReminderScheduler()
+
+
 async def show_event_by_index(message: types.Message, events: list, index: int, state: FSMContext):
-    event_id, title, reg_deadline, photo_id = events[index]
-    text = f"🎉 <b>{title}</b>\n⏳ Регистрация до: {reg_deadline}"
+    event_id, title, reg_deadline, photo_id, capacity, seats_taken = events[index]
+    text = f"🎉 <b>{title}</b>"
+    event = await event_cache.get(event_id)
+    if event:
+        text += f"\n📅 {event['event_datetime']}\n📍 {event['location']}"
+    text += f"\n⏳ Регистрация до: {reg_deadline}"
+    if capacity is not None:
+        seats_left = max(capacity - seats_taken, 0)
+        text += f"\n👥 Свободных мест: {seats_left} из {capacity}" if seats_left else "\n👥 Мест нет, доступен лист ожидания"
 
     builder = InlineKeyboardBuilder()
     builder.button(text="✅ Зарегистрироваться", callback_data=f"reg_{event_id}")
@@ -255,18 +1635,15 @@ async def show_event_by_index(message: types.Message, events: list, index: int,
 
     if photo_id:
         media = InputMediaPhoto(media=photo_id, caption=text, parse_mode="HTML")
-        await message.edit_media(media=media, reply_markup=builder.as_markup())
+        await render_cache.edit_media(message, media, reply_markup=builder.as_markup())
     else:
-        await message.edit_text(text=text, reply_markup=builder.as_markup(), parse_mode="HTML")
+        await render_cache.edit_text(message, text=text, reply_markup=builder.as_markup(), parse_mode="HTML")
 
 
 async def has_admin_access(tg_id: int) -> bool:
     if tg_id == MODERATOR_TG_ID:
         return True
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("SELECT role FROM users WHERE tg_id = ?", (tg_id,))
-        row = await cursor.fetchone()
-        return bool(row and row[0] == "moderator")
+    return await repo.get_role(tg_id) == "moderator"
 
 
 async def start_event_creation(message: types.Message, state: FSMContext):
@@ -296,6 +1673,105 @@ async def start_user_search(message: types.Message, state: FSMContext):
     await state.set_state(UserSearch.waiting_for_query)
 
 
+# === Предварительный рендер QR для входа ===
+
+# Служебный чат, куда QR загружаются один раз ради переиспользуемого file_id
+QR_CACHE_CHAT_ID = int(os.getenv("QR_CACHE_CHAT_ID", "0")) or None
+
+CHECKIN_QR_QUEUE: asyncio.Queue[tuple[int, int]] = asyncio.Queue()
+
+
+def checkin_deeplink(event_id: int, user_id: int) -> str:
+    return f"https://t.me/{BOT_USERNAME}?start=checkin_{event_id}_{user_id}"
+
+
+def enqueue_checkin_qr(user_id: int, event_id: int):
+    if QR_CACHE_CHAT_ID:
+        CHECKIN_QR_QUEUE.put_nowait((user_id, event_id))
+
+
+async def checkin_qr_worker():
+    # Предзагрузка QR не должна задерживать ответы пользователям
+    api_lane.set("bulk")
+    while True:
+        user_id, event_id = await CHECKIN_QR_QUEUE.get()
+        try:
+            if await repo.get_checkin_qr(user_id, event_id):
+                continue
+
+            qr_png = await asyncio.to_thread(generate_qr, checkin_deeplink(event_id, user_id))
+            sent = await bot.send_photo(
+                QR_CACHE_CHAT_ID,
+                photo=BufferedInputFile(qr_png.getvalue(), filename=f"qr_checkin_{event_id}_{user_id}.png"),
+                disable_notification=True
+            )
+            await repo.save_checkin_qr(user_id, event_id, sent.photo[-1].file_id)
+        except Exception as e:
+            print(f"[QR] Не удалось подготовить QR {event_id}/{user_id}: {e}")
+        finally:
+            CHECKIN_QR_QUEUE.task_done()
+
+
+async def backfill_checkin_qr():
+    # После перезапуска догружаем QR для предстоящих мероприятий
+    if not QR_CACHE_CHAT_ID:
+        return
+    async with aiosqlite.connect(DB_PATH) as db:
+        cursor = await db.execute("""
+            SELECT r.user_id, r.event_id FROM registrations r
+            JOIN events e ON e.id = r.event_id
+            WHERE r.qr_file_id IS NULL
+              AND datetime(e.event_datetime) > datetime('now', 'localtime')
+        """)
+        async for user_id, event_id in cursor:
+            enqueue_checkin_qr(user_id, event_id)
+
+
+# === Регистрация на мероприятия ===
+
+@dp.message(Command("set_capacity"))
+async def cmd_set_capacity(message: types.Message):
+    if not await has_admin_access(message.from_user.id):
+        await message.answer("⚠️ Только модератор.")
+        return
+
+    args = (message.text or "").split()
+    if len(args) < 3 or not args[1].isdigit() or not (args[2].isdigit() or args[2] == "off"):
+        await message.answer(
+            "Используйте: <code>/set_capacity ID_мероприятия число [waitlist]</code>\n"
+            "или <code>/set_capacity ID_мероприятия off</code>, чтобы снять ограничение.",
+            parse_mode="HTML"
+        )
+        return
+
+    event_id = int(args[1])
+    capacity = None if args[2] == "off" else int(args[2])
+    waitlist = "waitlist" in args[3:]
+
+    if not await repo.set_capacity(event_id, capacity, waitlist):
+        await message.answer("❌ Мероприятие не найдено.")
+        return
+    event_cache.invalidate(event_id)
+
+    promoted = await repo.promote_waitlist(event_id)
+    if promoted:
+        payload = {
+            "type": "text",
+            "text": "🎉 Освободилось место — ваша регистрация на мероприятие подтверждена!",
+            "parse_mode": "HTML",
+        }
+        spawn(send_batch(promoted, payload))
+        for tg_id in promoted:
+            enqueue_checkin_qr(tg_id, event_id)
+
+    limit_text = "без ограничения" if capacity is None else f"{capacity} мест"
+    await message.answer(
+        f"✅ Вместимость мероприятия {event_id}: {limit_text}"
+        f"{', лист ожидания включён' if waitlist and capacity is not None else ''}.\n"
+        f"Переведено из листа ожидания: {len(promoted)}"
+    )
+
+
 # === Клавиатуры ===
 
 def main_menu_kb() -> InlineKeyboardMarkup:
@@ -306,7 +1782,8 @@ def main_menu_kb() -> InlineKeyboardMarkup:
     builder.button(text="📅 Мероприятия", callback_data="events_hub")
     builder.button(text="📩 Обратная связь", callback_data="feedback_menu")
     builder.button(text="🔔 Настройки уведомлений", callback_data="notif_settings")
-    builder.adjust(2, 1, 1, 1, 1)
+    builder.button(text="🧭 Ближайшие точки кампуса", callback_data="nearby_locations")
+    builder.adjust(2, 1, 1, 1, 1, 1)
     return builder.as_markup()
 
 
@@ -335,6 +1812,7 @@ def moder_menu_kb() -> InlineKeyboardMarkup:
     builder.button(text="👤 Назначить роль", callback_data="mod_set_role")
     builder.button(text="📨 Рассылка", callback_data="mod_broadcast")
     builder.button(text="🔍 Найти пользователя", callback_data="mod_search_user")
+    builder.button(text="🔬 Профилирование", callback_data="mod_profile")
     builder.adjust(1)
     return builder.as_markup()
 
@@ -345,6 +1823,12 @@ def back_kb() -> InlineKeyboardMarkup:
     return builder.as_markup()
 
 
+def back_to_hub_kb() -> InlineKeyboardMarkup:
+    builder = InlineKeyboardBuilder()
+    builder.button(text="⬅️ Назад", callback_data="events_hub")
+    return builder.as_markup()
+
+
 def back_to_moder_kb() -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     builder.button(text="⬅️ Назад", callback_data="back_to_moder")
@@ -378,7 +1862,14 @@ def event_registered_kb() -> InlineKeyboardMarkup:
     return builder.as_markup()
 
 
-def notif_toggle_kb(events_on: bool, news_on: bool) -> InlineKeyboardMarkup:
+def event_waitlisted_kb() -> InlineKeyboardMarkup:
+    builder = InlineKeyboardBuilder()
+    builder.button(text="⏳ В листе ожидания", callback_data="noop")
+    builder.button(text="⤴️ К списку", callback_data="events_hub")
+    return builder.as_markup()
+
+
+def notif_toggle_kb(events_on: bool, news_on: bool, news_mode: str = "immediate") -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     
     events_status = "✅ Включены" if events_on else "❌ Выключены"
@@ -386,11 +1877,288 @@ def notif_toggle_kb(events_on: bool, news_on: bool) -> InlineKeyboardMarkup:
     
     builder.button(text=f"Мероприятия: {events_status}", callback_data="toggle_events")
     builder.button(text=f"Новости: {news_status}", callback_data="toggle_news")
+    if news_on:
+        builder.button(text=f"Доставка новостей: {NEWS_MODES.get(news_mode, NEWS_MODES['immediate'])}",
+                       callback_data="cycle_news_mode")
+    if news_on and len(NEWS_FEEDS) > 1:
+        builder.button(text="📰 Источники новостей", callback_data="news_feeds")
     builder.button(text="⬅️ Назад", callback_data="back_to_main")
     builder.adjust(1)
     return builder.as_markup()
 
 
+def news_feeds_kb(optouts: set[int]) -> InlineKeyboardMarkup:
+    builder = InlineKeyboardBuilder()
+    for feed in NEWS_FEEDS.values():
+        mark = "❌" if feed.id in optouts else "✅"
+        builder.button(text=f"{mark} {feed.name}", callback_data=f"toggle_feed_{feed.id}")
+    builder.button(text="⬅️ Назад", callback_data="notif_settings")
+    builder.adjust(1)
+    return builder.as_markup()
+
+
+# === Кэш отрисованных экранов ===
+
+RENDER_CACHE_SIZE = int(os.getenv("RENDER_CACHE_SIZE", "5000"))
+
+
+class RenderCache:
+    # Для каждого сообщения (чат, id) помним хэши последнего экрана: медиа,
+    # подпись и клавиатуру. Экран без изменений не отправляется вовсе, а если
+    # поменялась только клавиатура или только подпись — уходит один узкий
+    # вызов вместо edit_media. None в части экрана — «неизвестно», такая часть
+    # никогда не совпадает (например, медиа из загружаемого файла).
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.screens: OrderedDict = OrderedDict()
+        self.stats = {"edits": 0, "caption_only": 0, "markup_only": 0, "skipped": 0, "not_modified": 0}
+
+    @staticmethod
+    def markup_hash(reply_markup) -> int:
+        return hash(reply_markup.model_dump_json(exclude_none=True) if reply_markup else "")
+
+    def remember(self, key, screen: tuple):
+        self.screens[key] = screen
+        self.screens.move_to_end(key)
+        if len(self.screens) > self.max_size:
+            self.screens.popitem(last=False)
+
+    async def send(self, key, screen: tuple, request):
+        try:
+            result = await request
+        except TelegramBadRequest as e:
+            if "message is not modified" not in str(e):
+                # Сообщение могло быть удалено или изменено в обход кэша
+                self.screens.pop(key, None)
+                raise
+            self.stats["not_modified"] += 1
+            result = None
+        self.remember(key, screen)
+        return result
+
+    async def send_markup(self, message, key, screen: tuple, reply_markup):
+        if self.screens[key][2] == screen[2]:
+            self.stats["skipped"] += 1
+            self.screens.move_to_end(key)
+            return None
+        self.stats["markup_only"] += 1
+        return await self.send(key, screen, message.edit_reply_markup(reply_markup=reply_markup))
+
+    async def edit_media(self, message, media, reply_markup=None, **kwargs):
+        key = (message.chat.id, message.message_id)
+        old = self.screens.get(key)
+        media_part = hash((media.type, media.media)) if isinstance(media.media, str) else None
+        caption_part = hash((media.caption, str(media.parse_mode)))
+        screen = (media_part, caption_part, self.markup_hash(reply_markup))
+
+        if old and media_part is not None and old[0] == media_part:
+            if old[1] == caption_part:
+                return await self.send_markup(message, key, screen, reply_markup)
+            self.stats["caption_only"] += 1
+            return await self.send(key, screen, message.edit_caption(
+                caption=media.caption, parse_mode=media.parse_mode, reply_markup=reply_markup
+            ))
+
+        self.stats["edits"] += 1
+        return await self.send(key, screen, message.edit_media(media=media, reply_markup=reply_markup, **kwargs))
+
+    async def edit_text(self, message, text: str, reply_markup=None, parse_mode=None, **kwargs):
+        key = (message.chat.id, message.message_id)
+        old = self.screens.get(key)
+        screen = (hash("text"), hash((text, str(parse_mode))), self.markup_hash(reply_markup))
+
+        if old and old[:2] == screen[:2]:
+            return await self.send_markup(message, key, screen, reply_markup)
+
+        self.stats["edits"] += 1
+        return await self.send(key, screen, message.edit_text(
+            text=text, reply_markup=reply_markup, parse_mode=parse_mode, **kwargs
+        ))
+
+    async def edit_caption(self, message, caption: str, reply_markup=None, parse_mode=None, **kwargs):
+        key = (message.chat.id, message.message_id)
+        old = self.screens.get(key)
+        screen = (old[0] if old else None, hash((caption, str(parse_mode))), self.markup_hash(reply_markup))
+
+        if old and old[1] == screen[1]:
+            return await self.send_markup(message, key, screen, reply_markup)
+
+        self.stats["caption_only"] += 1
+        return await self.send(key, screen, message.edit_caption(
+            caption=caption, reply_markup=reply_markup, parse_mode=parse_mode, **kwargs
+        ))
+
+    async def edit_reply_markup(self, message, reply_markup=None):
+        key = (message.chat.id, message.message_id)
+        old = self.screens.get(key)
+        screen = (old[0], old[1], self.markup_hash(reply_markup)) if old else (None, None, self.markup_hash(reply_markup))
+
+        if old:
+            return await self.send_markup(message, key, screen, reply_markup)
+
+        self.stats["markup_only"] += 1
+        return await self.send(key, screen, message.edit_reply_markup(reply_markup=reply_markup))
+
+
+render_cache = RenderCache(RENDER_CACHE_SIZE)
+
+
+# === Экраны меню ===
+
+WELCOME_CAPTION = (
+    "🎓 Добро пожаловать в бот поддержки абитуриентов и студентов ВГУ!\n\n"
+    "Здесь вы можете:\n"
+    "• Получить персональный QR-код\n"
+    "• Зарегистрироваться на мероприятия\n"
+    "• Настроить уведомления"
+)
+
+
+class Screen:
+    # Экран меню: ключ фонового видео, подпись и клавиатура. Статичные части
+    # задаются здесь; динамический экран оставляет их пустыми и передаёт при показе
+    def __init__(self, media_key: str, caption: str | None = None, keyboard=None):
+        self.media_key = media_key
+        self.caption = caption
+        self.keyboard = keyboard
+        self.file_id: str | None = None
+        self.media: InputMediaAnimation | None = None
+        self.markup: InlineKeyboardMarkup | None = None
+
+    def compile(self, file_id: str | None):
+        # Готовые объекты для отправки: при показе статичного экрана ничего не собирается
+        self.file_id = file_id
+        self.markup = self.keyboard() if self.keyboard else None
+        self.media = None
+        if file_id and self.caption is not None:
+            self.media = InputMediaAnimation(media=file_id, caption=self.caption, parse_mode="HTML")
+
+
+SCREENS = {
+    "main": Screen("welcome", WELCOME_CAPTION, main_menu_kb),
+    "about": Screen("about", (
+        "ℹ️ <b>Бот абитуриента и студента ВГУ</b>\n\n"
+        "• Помогает ориентироваться в университете и регистрироваться на мероприятия. \n"
+        "• Бот центра адаптации абитуриентов Воронежского государственного университета"
+    ), back_kb),
+    "events_hub": Screen("hub", "📅 <b>Мероприятия</b>\n\nВыберите раздел:", events_hub_kb),
+    "feedback_menu": Screen("reverse", (
+        "📩 <b>Обратная связь</b>\n\n"
+        "Выберите тип обращения:\n"
+        "• <b>Ошибка</b> — если бот работает неправильно\n"
+        "• <b>Помощь</b> — если нужна поддержка по мероприятию"
+    ), feedback_menu_kb),
+    "no_active_events": Screen("actives", "📭 Нет мероприятий с открытой регистрацией.", back_to_hub_kb),
+    "no_registrations": Screen("select", "📭 Вы не записаны ни на одно мероприятие.", back_to_hub_kb),
+    "moder": Screen("moder", "🛠 <b>Панель модератора</b>", moder_menu_kb),
+    "mod_stats": Screen("moder", keyboard=back_to_moder_kb),
+    "notif_settings": Screen("notifications", "🔔 <b>Настройки уведомлений</b>"),
+    "profile": Screen("profile", keyboard=profile_kb),
+    "news": Screen("news", keyboard=back_kb),
+    "select_checkin": Screen("select"),
+}
+
+
+def compile_screens():
+    # Вызывается после загрузки media_assets и после каждого /set_video
+    for screen in SCREENS.values():
+        screen.compile((MEDIA_CACHE or {}).get(screen.media_key))
+
+
+async def show_screen(message: types.Message, name: str, caption: str | None = None, reply_markup=None):
+    # Редактирует текущее сообщение в экран name. Без видео меняется только текст:
+    # подпись у сообщения с медиа, текст у текстового
+    if MEDIA_CACHE is None:
+        await load_media_cache()
+    screen = SCREENS[name]
+    if caption is None:
+        caption = screen.caption
+    if reply_markup is None:
+        reply_markup = screen.markup
+
+    if screen.file_id:
+        media = screen.media if caption is screen.caption and screen.media else \
+            InputMediaAnimation(media=screen.file_id, caption=caption, parse_mode="HTML")
+        return await render_cache.edit_media(message, media, reply_markup=reply_markup)
+    if message.text is None:
+        return await render_cache.edit_caption(message, caption=caption, reply_markup=reply_markup, parse_mode="HTML")
+    return await render_cache.edit_text(message, text=caption, reply_markup=reply_markup, parse_mode="HTML")
+
+
+async def send_screen(message: types.Message, name: str):
+    # Статичный экран новым сообщением (/start, /moder)
+    if MEDIA_CACHE is None:
+        await load_media_cache()
+    screen = SCREENS[name]
+    if screen.file_id:
+        await message.answer_animation(
+            animation=screen.file_id, caption=screen.caption, reply_markup=screen.markup, parse_mode="HTML"
+        )
+    else:
+        await message.answer(screen.caption, reply_markup=screen.markup, parse_mode="HTML")
+
+
+# === Антифлуд для кнопок ===
+
+CALLBACK_RATE = float(os.getenv("CALLBACK_RATE", "2"))    # нажатий в секунду на пользователя
+CALLBACK_BURST = float(os.getenv("CALLBACK_BURST", "5"))  # допустимая серия нажатий
+THROTTLE_MAX_USERS = 10_000
+
+THROTTLE_STATS = {"passed": 0, "coalesced": 0, "throttled": 0}
+
+
+class CallbackThrottleMiddleware(BaseMiddleware):
+    # Token bucket на пользователя + склейка одинаковых нажатий, пока первое ещё обрабатывается
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.buckets: OrderedDict[int, tuple[float, float]] = OrderedDict()
+        self.in_flight: set[tuple] = set()
+
+    def take_token(self, user_id: int) -> bool:
+        now = time.monotonic()
+        tokens, updated = self.buckets.pop(user_id, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        self.buckets[user_id] = (tokens, now)
+        if len(self.buckets) > THROTTLE_MAX_USERS:
+            self.buckets.popitem(last=False)
+        return allowed
+
+    async def __call__(self, handler, event: types.CallbackQuery, data: dict):
+        message_id = event.message.message_id if event.message else event.inline_message_id
+        key = (event.from_user.id, message_id, event.data)
+
+        if key in self.in_flight:
+            THROTTLE_STATS["coalesced"] += 1
+            await self.answer_quietly(event)
+            return None
+
+        if not self.take_token(event.from_user.id):
+            THROTTLE_STATS["throttled"] += 1
+            await self.answer_quietly(event, "⏳ Слишком много нажатий, подождите секунду.")
+            return None
+
+        THROTTLE_STATS["passed"] += 1
+        self.in_flight.add(key)
+        try:
+            return await handler(event, data)
+        finally:
+            self.in_flight.discard(key)
+
+    @staticmethod
+    async def answer_quietly(event: types.CallbackQuery, text: str | None = None):
+        try:
+            await event.answer(text)
+        except TelegramBadRequest:
+            pass  # запрос устарел
+
+
+dp.callback_query.outer_middleware(CallbackThrottleMiddleware(CALLBACK_RATE, CALLBACK_BURST))
+
+
 # === Обработчики ===
 
 @dp.message(Command("cancel"))
@@ -408,16 +2176,8 @@ async def cmd_cancel(message: types.Message, state: FSMContext):
 async def cmd_start(message: types.Message):
     user = message.from_user
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
-            INSERT INTO users (tg_id, full_name, username)
-            VALUES (?, ?, ?)
-            ON CONFLICT(tg_id) DO UPDATE SET
-                full_name = excluded.full_name,
-                username = excluded.username
-        """, (user.id, user.full_name, user.username))
-        await db.execute("INSERT OR IGNORE INTO notification_prefs (user_id) VALUES (?)", (user.id,))
-        await db.commit()
+    await repo.upsert_user(user.id, user.full_name, user.username)
+    subscribers.user_started(user.id)
 
     payload = None
     if message.text and len(message.text) > 6:
@@ -439,29 +2199,15 @@ async def cmd_start(message: types.Message):
             await message.answer("⚠️ Только модератор может ставить отметки о посещении.")
             return
 
-        # Проверяем: зарегистрирован ли attendee на это мероприятие?
-        async with aiosqlite.connect(DB_PATH) as db:
-            cursor = await db.execute("""
-                SELECT 1 FROM registrations
-                WHERE user_id = ? AND event_id = ?
-            """, (attendee_id, event_id))
-            if not await cursor.fetchone():
-                await message.answer("❌ Пользователь не зарегистрирован на это мероприятие.")
-                return
-
-            # Ставим attended = 1
-            await db.execute("""
-                UPDATE registrations
-                SET attended = 1
-                WHERE user_id = ? AND event_id = ?
-            """, (attendee_id, event_id))
-            await db.commit()
+        if not await repo.mark_attended(attendee_id, event_id):
+            await message.answer("❌ Пользователь не зарегистрирован на это мероприятие.")
+            return
 
-            # Получаем имена для отчёта
-            cursor = await db.execute("SELECT full_name FROM users WHERE tg_id = ?", (attendee_id,))
-            attendee_name = (await cursor.fetchone())[0] if cursor else f"ID{attendee_id}"
-            cursor = await db.execute("SELECT title FROM events WHERE id = ?", (event_id,))
-            event_title = (await cursor.fetchone())[0] if cursor else f"Мероприятие {event_id}"
+        # Получаем имена для отчёта
+        attendee = await repo.get_user(attendee_id)
+        attendee_name = attendee["full_name"] if attendee else f"ID{attendee_id}"
+        event = await event_cache.get(event_id)
+        event_title = event["title"] if event else f"Мероприятие {event_id}"
 
         await message.answer(
             f"✅ Отметка о посещении проставлена!\n\n"
@@ -479,25 +2225,17 @@ async def cmd_start(message: types.Message):
             return
 
         # Загружаем данные о локации
-        async with aiosqlite.connect(DB_PATH) as db:
-            cursor = await db.execute("""
-                SELECT name, description, photo_file_id 
-                FROM locations 
-                WHERE id = ?
-            """, (loc_id,))
-            row = await cursor.fetchone()
-
-            if not row:
-                await message.answer("📍 Локация не найдена.")
-                return
+        location = await location_cache.get(loc_id)
+        if not location:
+            await message.answer("📍 Локация не найдена.")
+            return
 
-            name, description, photo_file_id = row
-            text = f"🏛 <b>{name}</b>\n\n{description}"
+        text = f"🏛 <b>{location['name']}</b>\n\n{location['description']}"
 
-            if photo_file_id:
-                await message.answer_photo(photo=photo_file_id, caption=text, parse_mode="HTML")
-            else:
-                await message.answer(text, parse_mode="HTML")
+        if location["photo_file_id"]:
+            await message.answer_photo(photo=location["photo_file_id"], caption=text, parse_mode="HTML")
+        else:
+            await message.answer(text, parse_mode="HTML")
 
         # Можно добавить кнопку "Посмотреть на карте" или "Ближайшие мероприятия"
         return
@@ -507,51 +2245,27 @@ async def cmd_start(message: types.Message):
         if target_id == user.id:
             await message.answer("✅ Вы перешли по своей QR-визитке!")
         else:
-            async with aiosqlite.connect(DB_PATH) as db:
-                cursor = await db.execute("SELECT full_name, username, role FROM users WHERE tg_id = ?", (target_id,))
-                row = await cursor.fetchone()
-                if not row:
-                    await message.answer("❌ Пользователь не найден.")
+            target = await repo.get_user(target_id)
+            if not target:
+                await message.answer("❌ Пользователь не найден.")
+            else:
+                role_name = {"applicant": "Абитуриент", "moderator": "Модератор"}.get(target["role"], target["role"])
+                text = f"👤 <b>Профиль пользователя</b> (ID: {target_id})\n\nИмя: {target['full_name']}\nРоль: {role_name}"
+
+                events = await repo.user_event_history(target_id)
+                if events:
+                    text += "\n\n✅ Зарегистрирован на:\n" + "\n".join(f"• {title} ({dt})" for title, dt in events)
                 else:
-                    full_name, username, role = row
-                    role_name = {"applicant": "Абитуриент", "moderator": "Модератор"}.get(role, role)
-                    text = f"👤 <b>Профиль пользователя</b> (ID: {target_id})\n\nИмя: {full_name}\nРоль: {role_name}"
-
-                    cursor = await db.execute("""
-                        SELECT e.title, e.event_datetime FROM events e
-                        JOIN registrations r ON e.id = r.event_id
-                        WHERE r.user_id = ?
-                    """, (target_id,))
-                    events = await cursor.fetchall()
-
-                    if events:
-                        text += "\n\n✅ Зарегистрирован на:\n" + "\n".join(f"• {title} ({dt})" for title, dt in events)
-                    else:
-                        text += "\n\n📭 Не зарегистрирован ни на одно мероприятие."
-
-                    await message.answer(text, parse_mode="HTML")
+                    text += "\n\n📭 Не зарегистрирован ни на одно мероприятие."
+
+                attendance = await repo.attendance(target_id)
+                if attendance["archived_total"]:
+                    text += (f"\n🗄 Прошлые мероприятия: {attendance['archived_visited']} "
+                             f"из {attendance['archived_total']} посещено")
+
+                await message.answer(text, parse_mode="HTML")
     else:
-        welcome_file_id = await get_media_asset("welcome")
-        caption = (
-            "🎓 Добро пожаловать в бот поддержки абитуриентов и студентов ВГУ!\n\n"
-            "Здесь вы можете:\n"
-            "• Получить персональный QR-код\n"
-            "• Зарегистрироваться на мероприятия\n"
-            "• Настроить уведомления"
-        )
-        if welcome_file_id:
-            await message.answer_animation(
-                animation=welcome_file_id,
-                caption=caption,
-                reply_markup=main_menu_kb(),
-                parse_mode="HTML"
-            )
-        else:
-            # fallback: текст без видео
-            await message.answer(
-                caption,
-                reply_markup=main_menu_kb()
-            )
+        await send_screen(message, "main")
 
 # === Команды модератора (без изменений) ===
 
@@ -656,15 +2370,10 @@ async def process_reg_deadline(message: types.Message, state: FSMContext):
     photo_file_id = data.get("photo_file_id")
     creator_id = message.from_user.id
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("""
-            INSERT INTO events (
-                title, description, event_datetime, registration_deadline,
-                location, photo_file_id, created_by
-            ) VALUES (?, ?, ?, ?, ?, ?, ?)
-        """, (title, description, event_datetime, reg_deadline, location, photo_file_id, creator_id))
-        event_id = cursor.lastrowid
-        await db.commit()
+    event_id = await repo.create_event(
+        title, description, event_datetime, reg_deadline, location, photo_file_id, creator_id
+    )
+    event_cache.invalidate(event_id)
 
     # Отправляем пост
     event_tag = f"#event_{event_id}"
@@ -689,34 +2398,16 @@ async def process_reg_deadline(message: types.Message, state: FSMContext):
 
     await sent_msg.edit_reply_markup(reply_markup=event_register_kb(event_id))
 
-    # Рассылка
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("""
-            SELECT u.tg_id FROM users u
-            JOIN notification_prefs np ON u.tg_id = np.user_id
-            WHERE np.events_enabled = 1
-        """)
-        users = await cursor.fetchall()
+    # Рассылка подписчикам на мероприятия
+    if photo_file_id:
+        payload = {"type": "photo", "file_id": photo_file_id,
+                   "caption": f"📬 <b>Новое мероприятие!</b>\n\n{post_text}", "parse_mode": "HTML"}
+    else:
+        payload = {"type": "text", "text": f"📬 <b>Новое мероприятие!</b>\n\n{post_text}", "parse_mode": "HTML"}
+    payload["reply_markup"] = event_register_kb(event_id)
+    await deliver_to_segment({"pref": "events", "kind": "all", "value": None}, payload)
 
-    for (tg_id,) in users:
-        try:
-            if photo_file_id:
-                await bot.send_photo(
-                    tg_id,
-                    photo=photo_file_id,
-                    caption=f"📬 <b>Новое мероприятие!</b>\n\n{post_text}",
-                    parse_mode="HTML",
-                    reply_markup=event_register_kb(event_id)
-                )
-            else:
-                await bot.send_message(
-                    tg_id,
-                    f"📬 <b>Новое мероприятие!</b>\n\n{post_text}",
-                    parse_mode="HTML",
-                    reply_markup=event_register_kb(event_id)
-                )
-        except Exception:
-            pass
+    reminder_scheduler.add_event(event_id, event_datetime, reg_deadline)
 
     await message.answer(f"✅ Мероприятие создано! ID: {event_id}")
     await state.clear()
@@ -727,20 +2418,7 @@ async def cmd_moder(message: types.Message):
     if not await has_admin_access(message.from_user.id):
         return
 
-    moder_file_id = await get_media_asset("moder")
-    if moder_file_id:
-        await message.answer_animation(
-            animation=moder_file_id,
-            caption="🛠 <b>Панель модератора</b>",
-            reply_markup=moder_menu_kb(),
-            parse_mode="HTML"
-        )
-    else:
-        # fallback: текст без видео
-        await message.answer(
-            "Панель модератора (Видео не задано)",
-            reply_markup=moder_menu_kb()
-        )
+    await send_screen(message, "moder")
 
 
 @dp.message(Command("set_role"))
@@ -759,14 +2437,12 @@ async def process_user_id(message: types.Message, state: FSMContext):
         await message.answer("❌ Некорректный ID. Попробуйте снова:")
         return
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("SELECT 1 FROM users WHERE tg_id = ?", (user_id,))
-        if not await cursor.fetchone():
-            await message.answer(
-                "❌ Пользователь не найден. Убедитесь, что он писал боту /start.\n"
-                "Попробуйте снова:"
-            )
-            return
+    if not await repo.get_user(user_id):
+        await message.answer(
+            "❌ Пользователь не найден. Убедитесь, что он писал боту /start.\n"
+            "Попробуйте снова:"
+        )
+        return
 
     await state.update_data(target_user_id=user_id)
     await message.answer(
@@ -791,9 +2467,7 @@ async def process_role(message: types.Message, state: FSMContext):
     data = await state.get_data()
     target_id = data["target_user_id"]
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("UPDATE users SET role = ? WHERE tg_id = ?", (role, target_id))
-        await db.commit()
+    await repo.set_role(target_id, role)
 
     role_name = {
         "applicant": "Абитуриент",
@@ -817,55 +2491,33 @@ async def cmd_broadcast_start(message: types.Message, state: FSMContext):
 @dp.message(Broadcast.waiting_for_message)
 async def process_broadcast_message(message: types.Message, state: FSMContext):
     # Сохраняем исходное сообщение как шаблон
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("""
-            SELECT u.tg_id FROM users u
-            JOIN notification_prefs np ON u.tg_id = np.user_id
-            WHERE np.events_enabled = 1 OR np.news_enabled = 1
-        """)
-        recipients = await cursor.fetchall()
+    await state.update_data(broadcast_payload=message_payload(message))
+    await message.answer(SEGMENT_HELP, parse_mode="HTML")
+    await state.set_state(Broadcast.waiting_for_segment)
 
-    success_count = 0
-    total = len(recipients)
 
-    for (tg_id,) in recipients:
-        try:
-            # Пересылаем точно такое же сообщение
-            if message.text:
-                await bot.send_message(
-                    tg_id,
-                    message.text,
-                    parse_mode="HTML" if "<" in message.text else None
-                )
-            elif message.photo:
-                await bot.send_photo(
-                    tg_id,
-                    photo=message.photo[-1].file_id,
-                    caption=message.caption,
-                    parse_mode="HTML" if message.caption and "<" in message.caption else None
-                )
-            elif message.video:
-                await bot.send_video(
-                    tg_id,
-                    video=message.video.file_id,
-                    caption=message.caption,
-                    parse_mode="HTML" if message.caption and "<" in message.caption else None
-                )
-            elif message.animation:
-                await bot.send_animation(
-                    tg_id,
-                    animation=message.animation.file_id,
-                    caption=message.caption,
-                    parse_mode="HTML" if message.caption and "<" in message.caption else None
-                )
-            else:
-                await bot.send_message(tg_id, message.text or "Сообщение от модератора")
-            success_count += 1
-        except Exception:
-            pass  # пользователь заблокировал или удалил чат
+@dp.message(Broadcast.waiting_for_segment)
+async def process_broadcast_segment(message: types.Message, state: FSMContext):
+    segment = parse_segment(message.text or "")
+    if not segment:
+        await message.answer("❌ Не удалось разобрать сегмент. Попробуйте снова:\n\n" + SEGMENT_HELP, parse_mode="HTML")
+        return
 
-    await message.answer(f"📤 Рассылка отправлена {success_count} из {total} пользователей.")
-    await state.clear()
+    total = await count_segment(segment)
+    await state.update_data(broadcast_segment=segment)
+
+    builder = InlineKeyboardBuilder()
+    builder.button(text=f"📤 Отправить ({total})", callback_data="bc_confirm")
+    builder.button(text="❌ Отмена", callback_data="bc_cancel")
+    builder.adjust(1)
+    await message.answer(
+        f"🎯 Сегмент: {describe_segment(segment)}\n"
+        f"👥 Получателей: <b>{total}</b>\n\n"
+        "Подтвердите рассылку:",
+        reply_markup=builder.as_markup(),
+        parse_mode="HTML"
+    )
+    await state.set_state(Broadcast.waiting_for_confirm)
 
 
 @dp.message(Command("search_user"))
@@ -880,16 +2532,7 @@ async def cmd_search_user_start(message: types.Message, state: FSMContext):
 async def process_user_search(message: types.Message, state: FSMContext):
     query = message.text.strip()
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        if query.isdigit():
-            cursor = await db.execute(
-                "SELECT tg_id, full_name, username, role FROM users WHERE tg_id = ?", (int(query),)
-            )
-        else:
-            cursor = await db.execute(
-                "SELECT tg_id, full_name, username, role FROM users WHERE full_name LIKE ?", (f"%{query}%",)
-            )
-        users = await cursor.fetchall()
+    users = await repo.search_users(query)
 
     if not users:
         await message.answer("❌ Пользователи не найдены.")
@@ -929,13 +2572,11 @@ async def cmd_set_video(message: types.Message):
         await message.answer("Отправьте видео или анимацию вместе с командой (в подписи).")
         return
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
-            INSERT INTO media_assets (key, file_id, description)
-            VALUES (?, ?, ?)
-            ON CONFLICT(key) DO UPDATE SET file_id = excluded.file_id
-        """, (key, file_id, f"Видео для {key}"))
-        await db.commit()
+    await repo.set_media_asset(key, file_id, f"Видео для {key}")
+
+    if MEDIA_CACHE is not None:
+        MEDIA_CACHE[key] = file_id
+        compile_screens()
 
     await message.answer(f"✅ Видео для '{key}' сохранено!")
 
@@ -969,13 +2610,211 @@ async def process_status_text(message: types.Message, state: FSMContext):
     data = await state.get_data()
     target_id = data["target_user_id"]
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("UPDATE users SET status = ? WHERE tg_id = ?", (status, target_id))
-        await db.commit()
+    await repo.set_status(target_id, status)
 
     await message.answer(f"✅ Статус пользователя {target_id} обновлён: {status}")
     await state.clear()
 
+# === Массовое обновление статусов и ролей ===
+
+BULK_NOTIFY_CHUNK = 500
+
+
+def iter_table_rows(data: bytes, filename: str):
+    # Строки читаются по одной: ни CSV, ни XLSX не разворачиваются в память целиком
+    if filename.lower().endswith(".xlsx"):
+        from openpyxl import load_workbook  # опциональная зависимость, нужна только для XLSX
+
+        workbook = load_workbook(BytesIO(data), read_only=True, data_only=True)
+        try:
+            for row in workbook.active.iter_rows(values_only=True):
+                cells = []
+                for value in row:
+                    if isinstance(value, float) and value.is_integer():
+                        value = int(value)
+                    cells.append("" if value is None else str(value).strip())
+                yield cells
+        finally:
+            workbook.close()
+        return
+
+    text = io.TextIOWrapper(BytesIO(data), encoding="utf-8-sig", newline="")
+    header = text.readline()
+    # Excel в русской локали сохраняет CSV через «;»
+    delimiter = ";" if header.count(";") > header.count(",") else ","
+    for row in csv.reader(itertools.chain([header], text), delimiter=delimiter):
+        yield [cell.strip() for cell in row]
+
+
+def parse_bulk_rows(rows) -> tuple[dict[int, tuple[str | None, str | None]], list[int]]:
+    rows = iter(rows)
+    header = [cell.lower() for cell in next(rows, [])]
+    if "tg_id" not in header or not {"status", "role"} & set(header):
+        raise ValueError("Нужны колонки tg_id и status и/или role")
+
+    id_col = header.index("tg_id")
+    status_col = header.index("status") if "status" in header else None
+    role_col = header.index("role") if "role" in header else None
+
+    updates, invalid = {}, []
+    for line_no, row in enumerate(rows, start=2):
+        if not any(row):
+            continue
+
+        def cell(col):
+            return row[col] if col is not None and col < len(row) and row[col] else None
+
+        tg_id, status, role = cell(id_col), cell(status_col), cell(role_col)
+        if not tg_id or not tg_id.lstrip("-").isdigit() or not (status or role):
+            invalid.append(line_no)
+            continue
+        if role and role not in ("applicant", "student", "curator", "moderator"):
+            invalid.append(line_no)
+            continue
+        # При повторе ID побеждает последняя строка
+        updates[int(tg_id)] = (status, role)
+
+    return updates, invalid
+
+
+async def apply_bulk_updates(updates: dict[int, tuple[str | None, str | None]]) -> tuple[list[int], list[int]]:
+    ids = list(updates)
+    known = await repo.bulk_update_users(updates)
+    applied = [tg_id for tg_id in ids if tg_id in known]
+    unknown = [tg_id for tg_id in ids if tg_id not in known]
+    return applied, unknown
+
+
+async def notify_bulk_updates(updates: dict[int, tuple[str | None, str | None]], applied: list[int]):
+    role_names = {"applicant": "Абитуриент", "student": "Студент", "curator": "Куратор", "moderator": "Модератор"}
+
+    # Одинаковые изменения отправляются одним payload через общий лимитер
+    groups: dict[tuple[str | None, str | None], list[int]] = {}
+    for tg_id in applied:
+        groups.setdefault(updates[tg_id], []).append(tg_id)
+
+    sent = 0
+    for (status, role), tg_ids in groups.items():
+        lines = ["🔔 <b>Ваши данные обновлены</b>\n"]
+        if status:
+            lines.append(f"🔖 Статус: {status}")
+        if role:
+            lines.append(f"🎭 Роль: {role_names[role]}")
+        payload = {"type": "text", "text": "\n".join(lines), "parse_mode": "HTML"}
+        for i in range(0, len(tg_ids), BULK_NOTIFY_CHUNK):
+            success_count, _ = await send_batch(tg_ids[i:i + BULK_NOTIFY_CHUNK], payload)
+            sent += success_count
+    print(f"[Bulk] Уведомлено {sent} из {len(applied)} пользователей")
+
+
+@dp.message(Command("bulk_update"))
+async def cmd_bulk_update(message: types.Message):
+    if not await has_admin_access(message.from_user.id):
+        await message.answer("⚠️ Только модератор.")
+        return
+
+    if not message.document:
+        await message.answer(
+            "📄 Отправьте CSV или XLSX файл с подписью <code>/bulk_update</code> "
+            "(или <code>/bulk_update notify</code>, чтобы уведомить пользователей).\n\n"
+            "Колонки: <code>tg_id</code>, <code>status</code> и/или <code>role</code>.",
+            parse_mode="HTML"
+        )
+        return
+
+    notify = "notify" in (message.caption or "").split()[1:]
+    filename = message.document.file_name or ""
+    data = (await bot.download(message.document)).getvalue()
+
+    try:
+        updates, invalid = parse_bulk_rows(iter_table_rows(data, filename))
+    except ImportError:
+        await message.answer("❌ Для XLSX нужен пакет openpyxl. Сохраните таблицу как CSV.")
+        return
+    except (ValueError, UnicodeDecodeError, csv.Error) as e:
+        await message.answer(f"❌ Не удалось прочитать файл: {e}")
+        return
+
+    try:
+        applied, unknown = await apply_bulk_updates(updates)
+    except Exception as e:
+        print(f"[Bulk] Ошибка применения: {e}")
+        await message.answer(f"❌ Изменения не применены, ни одна строка не обновлена: {e}")
+        return
+
+    text = (
+        f"✅ Обновлено: {len(applied)}\n"
+        f"❓ Не найдены в боте: {len(unknown)}\n"
+        f"❌ Некорректные строки: {len(invalid)}"
+    )
+    if unknown:
+        text += "\n\nНеизвестные ID: " + ", ".join(map(str, unknown[:20])) + ("…" if len(unknown) > 20 else "")
+    if invalid:
+        text += "\nСтроки с ошибками: " + ", ".join(map(str, invalid[:20])) + ("…" if len(invalid) > 20 else "")
+    if notify and applied:
+        spawn(notify_bulk_updates(updates, applied))
+        text += "\n\n📨 Уведомления поставлены в очередь."
+    await message.answer(text)
+
+
+# === Выгрузка регистраций ===
+
+EXPORT_CHUNK_SIZE = 1000
+
+
+async def export_event_registrations(event_id: int) -> tuple[str, bytes, int, int] | None:
+    buffer = BytesIO()
+    # utf-8-sig и «;» — чтобы файл корректно открывался в Excel
+    text = io.TextIOWrapper(buffer, encoding="utf-8-sig", newline="")
+    writer = csv.writer(text, delimiter=";")
+    writer.writerow([
+        "tg_id", "full_name", "username", "role", "status",
+        "registration_status", "registered_at", "attended"
+    ])
+    total = attended = 0
+
+    event = await repo.get_event(event_id)
+    if not event:
+        return None
+
+    # Читаем пачками, чтобы не поднимать в память всю выборку разом
+    async for rows in repo.event_registrations(event_id, EXPORT_CHUNK_SIZE):
+        for row in rows:
+            total += 1
+            attended += bool(row[7])
+            writer.writerow([*row[:7], "да" if row[7] else "нет"])
+
+    text.flush()
+    data = buffer.getvalue()
+    text.detach()
+    return event["title"], data, total, attended
+
+
+@dp.message(Command("export_event"))
+async def cmd_export_event(message: types.Message):
+    if not await has_admin_access(message.from_user.id):
+        await message.answer("⚠️ Только модератор.")
+        return
+
+    args = (message.text or "").split()
+    if len(args) < 2 or not args[1].isdigit():
+        await message.answer("Используйте: <code>/export_event ID</code>", parse_mode="HTML")
+        return
+
+    event_id = int(args[1])
+    result = await export_event_registrations(event_id)
+    if not result:
+        await message.answer("❌ Мероприятие не найдено.")
+        return
+
+    title, data, total, attended = result
+    await message.answer_document(
+        document=BufferedInputFile(data, filename=f"event_{event_id}_registrations.csv"),
+        caption=f"📋 <b>{title}</b>\n\nРегистраций: {total}\nПосетили: {attended}",
+        parse_mode="HTML"
+    )
+
+
 @dp.message(Feedback.bug)
 async def process_bug_report(message: types.Message, state: FSMContext):
     await send_feedback_to_moderators(
@@ -1065,28 +2904,277 @@ async def process_loc_photo(message: types.Message, state: FSMContext):
     photo_file_id = message.photo[-1].file_id if message.photo else None
     data = await state.get_data()
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
-            INSERT INTO locations (id, name, description, photo_file_id)
-            VALUES (?, ?, ?, ?)
-            ON CONFLICT(id) DO UPDATE SET
-                name = excluded.name,
-                description = excluded.description,
-                photo_file_id = excluded.photo_file_id
-        """, (data["location_id"], data["name"], data["description"], photo_file_id))
-        await db.commit()
+    await repo.save_location(data["location_id"], data["name"], data["description"], photo_file_id)
+    location_cache.invalidate(data["location_id"])
+    await rebuild_location_index()
 
     # Генерируем QR-код для этой локации
     deeplink = f"https://t.me/{BOT_USERNAME}?start=location_{data['location_id']}"
-    qr_png = generate_qr(deeplink)
+    qr_png = await asyncio.to_thread(generate_qr, deeplink)
     qr_file = BufferedInputFile(qr_png.getvalue(), filename=f"qr_loc_{data['location_id']}.png")
 
-    await message.answer_photo(
-        photo=qr_file,
-        caption=f"✅ Локация сохранена!\n\n🔗 Ссылка: <code>{deeplink}</code>",
-        parse_mode="HTML"
+    await message.answer_photo(
+        photo=qr_file,
+        caption=f"✅ Локация сохранена!\n\n🔗 Ссылка: <code>{deeplink}</code>",
+        parse_mode="HTML"
+    )
+    await state.clear()
+
+
+# === Ближайшие точки кампуса ===
+
+NEAREST_LOCATIONS_LIMIT = 3
+EARTH_RADIUS_M = 6_371_000
+
+
+def to_unit_vector(lat: float, lon: float) -> tuple[float, float, float]:
+    lat, lon = math.radians(lat), math.radians(lon)
+    return (math.cos(lat) * math.cos(lon), math.cos(lat) * math.sin(lon), math.sin(lat))
+
+
+class LocationIndex:
+    # k-d дерево по точкам на единичной сфере: евклидова хорда монотонна
+    # расстоянию по поверхности, поэтому ближайшие по хорде — ближайшие на местности
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def build(self, rows: list[tuple[str, str, float, float]]):
+        points = [(to_unit_vector(lat, lon), (loc_id, name, lat, lon)) for loc_id, name, lat, lon in rows]
+        self.root = self._build(points, 0)
+        self.size = len(points)
+
+    def _build(self, points: list, depth: int):
+        if not points:
+            return None
+        axis = depth % 3
+        points.sort(key=lambda point: point[0][axis])
+        median = len(points) // 2
+        vector, payload = points[median]
+        return (vector, payload, axis,
+                self._build(points[:median], depth + 1),
+                self._build(points[median + 1:], depth + 1))
+
+    def nearest(self, lat: float, lon: float, limit: int) -> list[tuple[float, tuple]]:
+        target = to_unit_vector(lat, lon)
+        best: list[tuple[float, int, tuple]] = []  # max-heap по -квадрату хорды
+
+        def visit(node):
+            if node is None:
+                return
+            vector, payload, axis, left, right = node
+            dist2 = sum((a - b) ** 2 for a, b in zip(vector, target))
+            if len(best) < limit:
+                heapq.heappush(best, (-dist2, id(node), payload))
+            elif dist2 < -best[0][0]:
+                heapq.heapreplace(best, (-dist2, id(node), payload))
+
+            diff = target[axis] - vector[axis]
+            near, far = (left, right) if diff < 0 else (right, left)
+            visit(near)
+            if len(best) < limit or diff * diff < -best[0][0]:
+                visit(far)
+
+        visit(self.root)
+        result = []
+        for neg_dist2, _, payload in sorted(best, reverse=True):
+            chord = math.sqrt(-neg_dist2)
+            result.append((2 * EARTH_RADIUS_M * math.asin(min(chord / 2, 1.0)), payload))
+        return result
+
+
+location_index = LocationIndex()
+
+
+async def rebuild_location_index():
+    location_index.build(await repo.location_points())
+
+
+def format_distance(meters: float) -> str:
+    return f"{meters / 1000:.1f} км" if meters >= 1000 else f"{meters:.0f} м"
+
+
+def request_location_kb() -> ReplyKeyboardMarkup:
+    return ReplyKeyboardMarkup(
+        keyboard=[[KeyboardButton(text="📍 Отправить геолокацию", request_location=True)]],
+        resize_keyboard=True,
+        one_time_keyboard=True
+    )
+
+
+class LocationCoords(StatesGroup):
+    waiting_for_point = State()
+
+
+async def save_location_coords(loc_id: str, lat: float, lon: float) -> bool:
+    updated = await repo.set_location_coords(loc_id, lat, lon)
+    if updated:
+        location_cache.invalidate(loc_id)
+        await rebuild_location_index()
+    return bool(updated)
+
+
+def parse_coords(text: str) -> tuple[float, float] | None:
+    try:
+        lat, lon = (float(part) for part in text.replace(",", " ").split())
+    except ValueError:
+        return None
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        return None
+    return lat, lon
+
+
+@dp.message(Command("set_coords"))
+async def cmd_set_coords(message: types.Message, state: FSMContext):
+    if not await has_admin_access(message.from_user.id):
+        await message.answer("⚠️ Только модератор.")
+        return
+
+    args = (message.text or "").split(maxsplit=2)
+    if len(args) < 2:
+        await message.answer(
+            "Используйте: <code>/set_coords ID_локации</code> и затем отправьте геолокацию,\n"
+            "или <code>/set_coords ID_локации 51.6567 39.2059</code>",
+            parse_mode="HTML"
+        )
+        return
+
+    loc_id = args[1]
+    if len(args) == 3:
+        coords = parse_coords(args[2])
+        if not coords:
+            await message.answer("❌ Некорректные координаты.")
+            return
+        if await save_location_coords(loc_id, *coords):
+            await message.answer(f"✅ Координаты локации {loc_id} сохранены.")
+        else:
+            await message.answer("📍 Локация не найдена.")
+        return
+
+    await state.update_data(location_id=loc_id)
+    await message.answer(
+        "📍 Отправьте геолокацию точки (скрепка → Геопозиция) или координаты текстом: <code>51.6567 39.2059</code>",
+        parse_mode="HTML"
+    )
+    await state.set_state(LocationCoords.waiting_for_point)
+
+
+@dp.message(LocationCoords.waiting_for_point)
+async def process_location_point(message: types.Message, state: FSMContext):
+    if message.location:
+        coords = (message.location.latitude, message.location.longitude)
+    else:
+        coords = parse_coords(message.text or "")
+    if not coords:
+        await message.answer("❌ Не удалось разобрать координаты. Попробуйте снова:")
+        return
+
+    loc_id = (await state.get_data())["location_id"]
+    if await save_location_coords(loc_id, *coords):
+        await message.answer(f"✅ Координаты локации {loc_id} сохранены.")
+    else:
+        await message.answer("📍 Локация не найдена.")
+    await state.clear()
+
+
+@dp.message(F.location)
+async def handle_user_location(message: types.Message):
+    # Сообщение с inline-кнопками не может убрать reply-клавиатуру, поэтому её снимает статус до поиска
+    await message.answer("🔎 Ищу ближайшие точки…", reply_markup=ReplyKeyboardRemove())
+    nearest = location_index.nearest(
+        message.location.latitude, message.location.longitude, NEAREST_LOCATIONS_LIMIT
+    )
+    if not nearest:
+        await message.answer("📍 Точки кампуса с координатами пока не добавлены.")
+        return
+
+    text = "🧭 <b>Ближайшие точки кампуса</b>\n\n" + "\n".join(
+        f"• {name} — {format_distance(distance)}" for distance, (_, name, _, _) in nearest
+    )
+    builder = InlineKeyboardBuilder()
+    for _, (loc_id, name, _, _) in nearest:
+        builder.button(text=f"📍 {name[:30]}", callback_data=f"show_loc_{loc_id}")
+    builder.adjust(1)
+    await message.answer(text, reply_markup=builder.as_markup(), parse_mode="HTML")
+
+
+# === Печать QR-кодов локаций ===
+
+QR_FONT_PATH = os.getenv("QR_FONT_PATH", "DejaVuSans.ttf")
+QR_RENDER_WORKERS = int(os.getenv("QR_RENDER_WORKERS", "0")) or os.cpu_count() or 1
+# Рендер идёт в отдельных процессах python -m qr_sheets: fork+exec не копирует потоки
+# бота, а воркер не импортирует main.py с aiogram — только qrcode и Pillow
+QR_RENDER_SLOTS = asyncio.Semaphore(QR_RENDER_WORKERS)
+
+
+async def run_qr_render(command: str, job: dict) -> bytes:
+    async with QR_RENDER_SLOTS:
+        proc = await asyncio.create_subprocess_exec(
+            sys.executable, "-m", "qr_sheets", command,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        )
+        out, err = await proc.communicate(json.dumps(job).encode())
+    if proc.returncode != 0:
+        raise RuntimeError(f"qr_sheets {command}: {err.decode(errors='replace').strip()[-500:]}")
+    return out
+
+
+@dp.message(Command("qr_sheets"))
+async def cmd_qr_sheets(message: types.Message):
+    if not await has_admin_access(message.from_user.id):
+        await message.answer("⚠️ Только модератор.")
+        return
+
+    args = (message.text or "").split()[1:]
+    as_pdf = "pdf" in args
+    loc_ids = [arg for arg in args if arg != "pdf"]
+
+    locations = await repo.list_locations(loc_ids)
+
+    if not locations:
+        await message.answer(
+            "📍 Локации не найдены.\n\n"
+            "Используйте: <code>/qr_sheets [pdf] [ID локаций через пробел]</code>",
+            parse_mode="HTML"
+        )
+        return
+
+    started = time.perf_counter()
+    per_sheet = qr_sheets.PER_SHEET
+
+    # Каждый лист рендерится в своём процессе, event loop остаётся свободным
+    sheets = await asyncio.gather(*(
+        run_qr_render("sheet", {
+            "locations": locations[i:i + per_sheet],
+            "bot_username": BOT_USERNAME,
+            "font_path": QR_FONT_PATH,
+        })
+        for i in range(0, len(locations), per_sheet)
+    ))
+    if as_pdf:
+        pdf = await run_qr_render("pdf", {"sheets": [base64.b64encode(sheet).decode() for sheet in sheets]})
+        documents = [("qr_locations.pdf", pdf)]
+    else:
+        documents = [(f"qr_locations_{n}.png", sheet) for n, sheet in enumerate(sheets, start=1)]
+    elapsed = time.perf_counter() - started
+
+    for i in range(0, len(documents), 10):
+        group = [
+            InputMediaDocument(media=BufferedInputFile(data, filename=filename))
+            for filename, data in documents[i:i + 10]
+        ]
+        if len(group) == 1:
+            await message.answer_document(document=group[0].media)
+        else:
+            await message.answer_media_group(media=group)
+
+    await message.answer(
+        f"🖨 QR-кодов: {len(locations)}, листов: {len(sheets)}\n"
+        f"⏱ {elapsed:.2f} с ({len(locations) / elapsed:.0f} QR/с)"
     )
-    await state.clear()
 
 
 # === Обработчик кнопок — ТОЛЬКО edit_caption! ===
@@ -1103,129 +3191,104 @@ async def handle_callback(callback: types.CallbackQuery, state: FSMContext):
             await callback.answer("❌ Некорректный ID мероприятия.", show_alert=True)
             return
 
-        async with aiosqlite.connect(DB_PATH) as db:
-            cursor = await db.execute("SELECT title FROM events WHERE id = ?", (event_id,))
-            event = await cursor.fetchone()
-            if not event:
-                await callback.answer("❌ Мероприятие не найдено.", show_alert=True)
-                return
+        # Несуществующие ID отсекаем по кэшу, не занимая писателя
+        if not await event_cache.get(event_id):
+            await callback.answer("❌ Мероприятие не найдено.", show_alert=True)
+            return
 
-            cursor = await db.execute(
-                "SELECT 1 FROM registrations WHERE user_id = ? AND event_id = ?",
-                (user.id, event_id)
-            )
-            if await cursor.fetchone():
-                await callback.answer("✅ Вы уже зарегистрированы!", show_alert=True)
-                return
+        result = await repo.register(user.id, event_id)
+        if result == "not_found":
+            await callback.answer("❌ Мероприятие не найдено.", show_alert=True)
+            return
+        if result == "already_confirmed":
+            await callback.answer("✅ Вы уже зарегистрированы!", show_alert=True)
+            return
+        if result == "already_waitlist":
+            await callback.answer("⏳ Вы уже в листе ожидания.", show_alert=True)
+            return
+        if result == "full":
+            await callback.answer("😔 Свободных мест не осталось.", show_alert=True)
+            return
+        if result == "waitlist":
+            await render_cache.edit_reply_markup(callback.message, reply_markup=event_waitlisted_kb())
+            await callback.answer("⏳ Мест нет — вы в листе ожидания. Мы сообщим, если место освободится.", show_alert=True)
+            return
 
-            await db.execute(
-                "INSERT INTO registrations (user_id, event_id) VALUES (?, ?)",
-                (user.id, event_id)
-            )
-            await db.commit()
+        # QR для входа готовим заранее, чтобы у двери не рендерить его всем одновременно
+        enqueue_checkin_qr(user.id, event_id)
 
-        await callback.message.edit_reply_markup(reply_markup=event_registered_kb())
+        await render_cache.edit_reply_markup(callback.message, reply_markup=event_registered_kb())
         await callback.answer("✅ Регистрация подтверждена! Вы можете найти QR-код для входа на мероприятие в своих регистрациях.", show_alert=True)
         return
 
-    if data == "noop":
+    if data == "nearby_locations":
+        await callback.message.answer(
+            "📍 Отправьте свою геолокацию — покажу ближайшие точки кампуса.",
+            reply_markup=request_location_kb()
+        )
         await callback.answer()
         return
 
-    if data == "about_bot":
-        about_video_id = await get_media_asset("about")
-        text = "ℹ️ <b>Бот абитуриента и студента ВГУ</b>\n\n• Помогает ориентироваться в университете и регистрироваться на мероприятия. \n• Бот центра адаптации абитуриентов Воронежского государственного университета"
-
-        media = InputMediaAnimation(
-            media=about_video_id,
-            caption=text,
-            parse_mode="HTML"
+    if data.startswith("show_loc_"):
+        loc_id = data.removeprefix("show_loc_")
+        location = await location_cache.get(loc_id)
+        if not location or location["latitude"] is None:
+            await callback.answer("📍 Локация не найдена.", show_alert=True)
+            return
+        await callback.message.answer_venue(
+            latitude=location["latitude"], longitude=location["longitude"],
+            title=location["name"], address=(location["description"] or location["name"])[:100]
         )
+        await callback.answer()
+        return
 
-        if about_video_id:
-            await callback.message.edit_media(
-                media=media,
-                reply_markup=back_kb(),
-                parse_mode="HTML"
-            )
-        else:
-            await callback.message.edit_caption(
-                text,
-                reply_markup=back_kb(),
-                parse_mode="HTML"
-            )
+    if data == "noop":
+        await callback.answer()
+        return
+
+    if data == "about_bot":
+        await show_screen(callback.message, "about")
         await callback.answer()
         return
 
     if data == "my_profile":
-        profile_video_id = await get_media_asset("profile")
-        
-        async with aiosqlite.connect(DB_PATH) as db:
-            cursor = await db.execute(
-                "SELECT full_name, username, role, status FROM users WHERE tg_id = ?",
-                (user.id,)
-            )
-            row = await cursor.fetchone()
-            if not row:
-                text = "❌ Профиль не найден. Напишите /start."
-            else:
-                full_name, username, role, status = row
-                role_name = {
-                    "applicant": "Абитуриент",
-                    "student": "Студент",
-                    "curator": "Куратор",
-                    "moderator": "Модератор"
-                }.get(role, role)
-
-                # Метрики по мероприятиям
-                cursor = await db.execute("""
-                    SELECT 
-                        COUNT(*) AS total,
-                        COUNT(*) FILTER (WHERE attended = 1) AS visited
-                    FROM registrations r
-                    JOIN events e ON r.event_id = e.id
-                    WHERE r.user_id = ?
-                """, (user.id,))
-                total, visited = await cursor.fetchone()
-
-                # Формируем текст профиля
-                text = f"👤 <b>{full_name}</b>\n\n"
-                text += f"🆔 ID: <code>{user.id}</code>\n"
-                text += f"🎭 Роль: {role_name}\n"
-                if status:
-                    text += f"🔖 Статус: {status}\n"
-                text += f"📊 Мероприятия: {visited} из {total} посещено\n"
-
-                # Дополнительно: если пользователь — абитуриент, даем совет
-                if role == "applicant":
-                    text += "\n💡 <i>Подайте документы заранее и посещайте дни открытых дверей!</i>"
-
-        # Отправляем
-        if profile_video_id:
-            media = InputMediaAnimation(
-                media=profile_video_id,
-                caption=text,
-                parse_mode="HTML"
-            )
-            await callback.message.edit_media(
-                media=media,
-                reply_markup=profile_kb(),
-                parse_mode="HTML"
-            )
+        profile = await repo.get_user(user.id)
+        if not profile:
+            text = "❌ Профиль не найден. Напишите /start."
         else:
-            # ВАЖНО: используем edit_text, а не edit_caption, чтобы избежать ошибок!
-            await callback.message.edit_text(
-                text=text,
-                reply_markup=profile_kb(),
-                parse_mode="HTML"
-            )
+            role = profile["role"]
+            role_name = {
+                "applicant": "Абитуриент",
+                "student": "Студент",
+                "curator": "Куратор",
+                "moderator": "Модератор"
+            }.get(role, role)
+
+            # Метрики по мероприятиям, включая архив прошлых сезонов
+            attendance = await repo.attendance(user.id)
+            total = attendance["total"] + attendance["archived_total"]
+            visited = attendance["visited"] + attendance["archived_visited"]
+
+            # Формируем текст профиля
+            text = f"👤 <b>{profile['full_name']}</b>\n\n"
+            text += f"🆔 ID: <code>{user.id}</code>\n"
+            text += f"🎭 Роль: {role_name}\n"
+            if profile["status"]:
+                text += f"🔖 Статус: {profile['status']}\n"
+            text += f"📊 Мероприятия: {visited} из {total} посещено\n"
+
+            # Дополнительно: если пользователь — абитуриент, даем совет
+            if role == "applicant":
+                text += "\n💡 <i>Подайте документы заранее и посещайте дни открытых дверей!</i>"
+
+        await show_screen(callback.message, "profile", caption=text)
         await callback.answer()
         return
 
     if data == "my_qr_card":
         # QR — отдельное сообщение (не редактируем текущее)
         deeplink_url = f"https://t.me/{BOT_USERNAME}?start={user.id}"
-        qr_gif = generate_qr(deeplink_url)
+        qr_gif = await asyncio.to_thread(generate_qr, deeplink_url)
         gif_file = BufferedInputFile(qr_gif.getvalue(), filename="qr_vizitka.gif")
         caption = (
             "🎫 <b>Ваш персональный QR-код</b>\n\n"
@@ -1237,65 +3300,19 @@ async def handle_callback(callback: types.CallbackQuery, state: FSMContext):
             caption=caption,
             parse_mode="HTML"
         )
-        builder = InlineKeyboardBuilder()
-        builder.button(text="⬅️ Назад", callback_data="my_profile")
-
-        await callback.message.edit_media(media=media, reply_markup=back_kb(), parse_mode="HTML")
+        await render_cache.edit_media(callback.message, media=media, reply_markup=back_kb(), parse_mode="HTML")
         await callback.answer()
         return
 
 
     if data == "notif_settings":
-        async with aiosqlite.connect(DB_PATH) as db:
-            cursor = await db.execute(
-                "SELECT events_enabled, news_enabled FROM notification_prefs WHERE user_id = ?",
-                (user.id,)
-            )
-            row = await cursor.fetchone()
-        
-        # Если настроек нет (маловероятно, но на всякий случай)
-        if row:
-            events_on, news_on = bool(row[0]), bool(row[1])
-        else:
-            events_on, news_on = True, True
-
-        text = "🔔 <b>Настройки уведомлений</b>"
-        notif_video_id = await get_media_asset("notifications")
-
-        if notif_video_id:
-            media = InputMediaAnimation(
-                media=notif_video_id,
-                caption=text,
-                parse_mode="HTML"
-            )
-            await callback.message.edit_media(
-                media=media,
-                reply_markup=notif_toggle_kb(events_on, news_on),
-                parse_mode="HTML"
-            )
-        else:
-            await callback.message.edit_text(
-                text=text,
-                reply_markup=notif_toggle_kb(events_on, news_on),
-                parse_mode="HTML"
-            )
+        events_on, news_on, news_mode = await subscribers.get_prefs(user.id)
+        await show_screen(callback.message, "notif_settings", reply_markup=notif_toggle_kb(events_on, news_on, news_mode))
         await callback.answer()
         return
 
     if data == "feedback_menu":
-        text = (
-            "📩 <b>Обратная связь</b>\n\n"
-            "Выберите тип обращения:\n"
-            "• <b>Ошибка</b> — если бот работает неправильно\n"
-            "• <b>Помощь</b> — если нужна поддержка по мероприятию"
-        )
-        reverse_media = await get_media_asset("reverse")
-        media = InputMediaAnimation(
-                media=reverse_media,
-                caption=text,
-                parse_mode="HTML"
-            )
-        await callback.message.edit_media(media=media, reply_markup=feedback_menu_kb(), parse_mode="HTML")
+        await show_screen(callback.message, "feedback_menu")
         await callback.answer()
         return
 
@@ -1313,92 +3330,57 @@ async def handle_callback(callback: types.CallbackQuery, state: FSMContext):
 
     if data == "toggle_events":
         # Переключаем events_enabled
-        async with aiosqlite.connect(DB_PATH) as db:
-            await db.execute("UPDATE notification_prefs SET events_enabled = 1 - events_enabled WHERE user_id = ?", (user.id,))
-            await db.commit()
-
-        # Получаем ОБА текущих значения — и для мероприятий, и для новостей
-        async with aiosqlite.connect(DB_PATH) as db:
-            cursor = await db.execute(
-                "SELECT events_enabled, news_enabled FROM notification_prefs WHERE user_id = ?",
-                (user.id,)
-            )
-            row = await cursor.fetchone()
-            events_on = bool(row[0]) if row else True
-            news_on = bool(row[1]) if row else True
+        events_on, news_on, news_mode = await repo.toggle_pref(user.id, "events_enabled")
+        subscribers.set_prefs(user.id, events_on, news_on, news_mode)
 
-        caption = "🔔 <b>Настройки уведомлений</b>"
-        await callback.message.edit_caption(
-            caption=caption,
-            reply_markup=notif_toggle_kb(events_on, news_on),
-            parse_mode="HTML"
-        )
+        await show_screen(callback.message, "notif_settings", reply_markup=notif_toggle_kb(events_on, news_on, news_mode))
         await callback.answer()
         return
 
     if data == "toggle_news":
-        async with aiosqlite.connect(DB_PATH) as db:
-            await db.execute("UPDATE notification_prefs SET news_enabled = 1 - news_enabled WHERE user_id = ?", (user.id,))
-            await db.commit()
-        
-        # Получаем актуальные значения
-        async with aiosqlite.connect(DB_PATH) as db:
-            cursor = await db.execute(
-                "SELECT events_enabled, news_enabled FROM notification_prefs WHERE user_id = ?",
-                (user.id,)
-            )
-            row = await cursor.fetchone()
-            events_on = bool(row[0]) if row else True
-            news_on = bool(row[1]) if row else True
+        events_on, news_on, news_mode = await repo.toggle_pref(user.id, "news_enabled")
+        subscribers.set_prefs(user.id, events_on, news_on, news_mode)
 
-        caption = "🔔 <b>Настройки уведомлений</b>"
-        await callback.message.edit_caption(
-            caption=caption,
-            reply_markup=notif_toggle_kb(events_on, news_on),
-            parse_mode="HTML"
-        )
+        await show_screen(callback.message, "notif_settings", reply_markup=notif_toggle_kb(events_on, news_on, news_mode))
+        await callback.answer()
+        return
+
+    if data == "cycle_news_mode":
+        events_on, news_on, news_mode = await repo.cycle_news_mode(user.id)
+        subscribers.set_prefs(user.id, events_on, news_on, news_mode)
+        await render_cache.edit_reply_markup(callback.message, reply_markup=notif_toggle_kb(events_on, news_on, news_mode))
+        await callback.answer(f"Доставка новостей: {NEWS_MODES[news_mode]}")
+        return
+
+    if data == "news_feeds":
+        optouts = await subscribers.get_feed_optouts(user.id)
+        await render_cache.edit_reply_markup(callback.message, reply_markup=news_feeds_kb(optouts))
         await callback.answer()
         return
 
+    if data.startswith("toggle_feed_"):
+        feed_id = int(data.split("_")[-1])
+        if feed_id not in NEWS_FEEDS:
+            await callback.answer("❌ Источник больше не доступен.", show_alert=True)
+            return
+        subscribed = await repo.toggle_feed_optout(user.id, feed_id)
+        subscribers.set_feed_optout(user.id, feed_id, subscribed)
+        optouts = await subscribers.get_feed_optouts(user.id)
+        await render_cache.edit_reply_markup(callback.message, reply_markup=news_feeds_kb(optouts))
+        await callback.answer("✅ Подписка включена" if subscribed else "❌ Подписка отключена")
+        return
+
     if data == "events_hub":
-        text = "📅 <b>Мероприятия</b>\n\nВыберите раздел:"
-        notif_video_id = await get_media_asset("hub")
-        media = InputMediaAnimation(
-                media=notif_video_id,
-                caption=text,
-                parse_mode="HTML"
-            )
-        await callback.message.edit_media(
-            media=media,
-            reply_markup=events_hub_kb(),
-            parse_mode="HTML"
-        )
+        await show_screen(callback.message, "events_hub")
         await callback.answer()
         return
 
     if data == "qr_for_checkin":
         # Получаем список мероприятий
-        async with aiosqlite.connect(DB_PATH) as db:
-            cursor = await db.execute("""
-                SELECT e.id, e.title FROM events e
-                JOIN registrations r ON e.id = r.event_id
-                WHERE r.user_id = ?
-            """, (user.id,))
-            events = await cursor.fetchall()
-
-        select_media_file_id = await get_media_asset("select")
+        events = await repo.confirmed_events(user.id)
 
         if not events:
-            # Показываем ошибку через edit_media (не edit_text!)
-            error_caption = "📭 Вы не записаны ни на одно мероприятие."
-            fallback_media = InputMediaAnimation(
-                media=select_media_file_id,
-                caption=error_caption,
-                parse_mode="HTML"
-            )
-            builder = InlineKeyboardBuilder()
-            builder.button(text="⬅️ Назад", callback_data="events_hub")
-            await callback.message.edit_media(media=fallback_media, reply_markup=builder.as_markup())
+            await show_screen(callback.message, "no_registrations")
             await callback.answer()
             return
 
@@ -1408,12 +3390,6 @@ async def handle_callback(callback: types.CallbackQuery, state: FSMContext):
         )
         caption = f"Выберите мероприятие для генерации QR:\n\n{event_list}"
 
-        select_media = InputMediaAnimation(
-            media=select_media_file_id,
-            caption=caption,
-            parse_mode="HTML"
-        )
-
         # Клавиатура с кнопками на каждое мероприятие
         builder = InlineKeyboardBuilder()
         for event_id, title in events:
@@ -1424,62 +3400,44 @@ async def handle_callback(callback: types.CallbackQuery, state: FSMContext):
         builder.button(text="⬅️ Назад", callback_data="events_hub")
         builder.adjust(1)
 
-        await callback.message.edit_media(
-            media=select_media,
-            reply_markup=builder.as_markup()
-        )
+        await show_screen(callback.message, "select_checkin", caption=caption, reply_markup=builder.as_markup())
         await callback.answer()
         return
 
     if data.startswith("gen_qr_checkin_"):
         event_id = int(data.split("_")[-1])
-        deeplink = f"https://t.me/{BOT_USERNAME}?start=checkin_{event_id}_{user.id}"
-        qr_gif = generate_qr(deeplink)
+        caption = "🎫 QR для отметки на мероприятии\n\nПокажите его модератору при входе."
+
+        # Заранее загруженный QR отправляется одним edit_media без рендера и загрузки
+        qr_file_id = await repo.get_checkin_qr(user.id, event_id)
+        if qr_file_id:
+            qr_media = qr_file_id
+        else:
+            qr_gif = await asyncio.to_thread(generate_qr, checkin_deeplink(event_id, user.id))
+            qr_media = BufferedInputFile(qr_gif.getvalue(), filename=f"qr_checkin_{event_id}.gif")
 
         media = InputMediaPhoto(
-                media=BufferedInputFile(qr_gif.getvalue(), filename=f"qr_checkin_{event_id}.gif"),
-                caption=f"🎫 QR для отметки на мероприятии\n\nПокажите его модератору при входе.",
+                media=qr_media,
+                caption=caption,
                 parse_mode="HTML"
             )
 
-        await callback.message.edit_media(
+        edited = await render_cache.edit_media(
+            callback.message,
             media=media,
             reply_markup=qr_code_checkin_kb(),
             parse_mode="HTML"
         )
+        if not qr_file_id and isinstance(edited, types.Message) and edited.photo:
+            await repo.save_checkin_qr(user.id, event_id, edited.photo[-1].file_id)
         await callback.answer()
         return
 
     if data == "active_events":
-        user_id = callback.from_user.id
-
-        async with aiosqlite.connect(DB_PATH) as db:
-            cursor = await db.execute("""
-                SELECT e.id, e.title, e.registration_deadline, e.photo_file_id
-                FROM events e
-                WHERE datetime(e.registration_deadline) >= datetime('now')
-                AND NOT EXISTS (
-                    SELECT 1 FROM registrations r
-                    WHERE r.user_id = ? AND r.event_id = e.id
-                )
-                ORDER BY e.registration_deadline
-            """, (user_id,))
-            events = await cursor.fetchall()
+        events = await repo.open_events(callback.from_user.id)
 
         if not events:
-            builder = InlineKeyboardBuilder()
-            builder.button(text="⬅️ Назад", callback_data="events_hub")
-            active_video = await get_media_asset("actives")
-            media = InputMediaAnimation(
-                media=active_video,
-                caption="📭 Нет мероприятий с открытой регистрацией.",
-                parse_mode="HTML"
-            )
-            await callback.message.edit_media(
-                media=media,
-                reply_markup=builder.as_markup(),
-                parse_mode="HTML"
-            )
+            await show_screen(callback.message, "no_active_events")
             await callback.answer()
             return
 
@@ -1510,17 +3468,13 @@ async def handle_callback(callback: types.CallbackQuery, state: FSMContext):
 
     if data == "latest_news":
         try:
-            import feedparser
-            feed = feedparser.parse("https://www.vsu.ru/ru/news/rss")
-            if not feed.entries:
+            # Ленты уже опрашиваются в фоне — берём 3 свежие новости из БД, без запроса к сайту
+            entries = await repo.latest_news(3)
+            if not entries:
                 raise Exception("Нет новостей")
 
-            # Берём 3 свежие новости
-            entries = feed.entries[:3]
             text = "📰 <b>Последние новости ВГУ</b>\n\n"
-            for entry in entries:
-                title = entry.title.strip()
-                link = entry.link
+            for title, link in entries:
                 # Обрезаем длинные заголовки
                 if len(title) > 60:
                     title = title[:57] + "..."
@@ -1530,32 +3484,22 @@ async def handle_callback(callback: types.CallbackQuery, state: FSMContext):
         except Exception as e:
             text = "📭 Новости временно недоступны.\nПопробуйте позже."
 
-        # Попробуем загрузить видео для фона (опционально)
-        news_video_id = await get_media_asset("news")
-        if news_video_id:
-            media = InputMediaAnimation(
-                media=news_video_id,
-                caption=text,
-                parse_mode="HTML"
-            )
-            await callback.message.edit_media(media=media, reply_markup=back_kb())
-        else:
-            await callback.message.edit_text(text=text, reply_markup=back_kb(), parse_mode="HTML")
+        await show_screen(callback.message, "news", caption=text)
         await callback.answer()
         return
 
     # === Модераторка ===
 
     if data == "mod_stats":
-        async with aiosqlite.connect(DB_PATH) as db:
-            cursor = await db.execute("SELECT COUNT(*) FROM users")
-            users = (await cursor.fetchone())[0]
-            cursor = await db.execute("SELECT COUNT(*) FROM events")
-            events = (await cursor.fetchone())[0]
-            cursor = await db.execute("SELECT COUNT(*) FROM registrations")
-            regs = (await cursor.fetchone())[0]
-        caption = f"📊 <b>Статистика</b>\n\nПользователей: {users}\nМероприятий: {events}\nРегистраций: {regs}"
-        await callback.message.edit_caption(caption=caption, reply_markup=back_to_moder_kb(), parse_mode="HTML")
+        stats = await repo.stats()
+        caption = (
+            f"📊 <b>Статистика</b>\n\nПользователей: {stats['users']}\nМероприятий: {stats['events']}\n"
+            f"Регистраций: {stats['registrations']}\n"
+            f"В архиве мероприятий: {stats['archived']}\n"
+            f"Неактивных (заблокировали бота): {stats['inactive']}\n"
+            f"Пропущено отправок с запуска: {SUPPRESSION_STATS['suppressed']}"
+        )
+        await show_screen(callback.message, "mod_stats", caption=caption)
         await callback.answer()
         return
 
@@ -1602,47 +3546,718 @@ async def handle_callback(callback: types.CallbackQuery, state: FSMContext):
         await callback.answer()
         return
 
-    if data == "back_to_moder":
-        caption = "🛠 <b>Панель модератора</b>"
-        await callback.message.edit_caption(
-            caption=caption,
-            reply_markup=moder_menu_kb(),
-            parse_mode="HTML"
+    if data == "bc_confirm":
+        if not await has_admin_access(callback.from_user.id):
+            await callback.answer("Доступ запрещён", show_alert=True)
+            return
+        if await state.get_state() != Broadcast.waiting_for_confirm.state:
+            await callback.answer("❌ Рассылка уже отправлена или отменена.", show_alert=True)
+            return
+
+        state_data = await state.get_data()
+        await state.clear()
+        await render_cache.edit_reply_markup(callback.message, reply_markup=None)
+        await callback.answer("📤 Рассылка запущена")
+
+        status_message = await callback.message.answer("📤 <b>Подготовка рассылки…</b>", parse_mode="HTML")
+        job = BroadcastJob(state_data["broadcast_segment"], state_data["broadcast_payload"], status_message)
+        spawn(job.run())
+        return
+
+    if data.startswith("bcjob_"):
+        if not await has_admin_access(callback.from_user.id):
+            await callback.answer("Доступ запрещён", show_alert=True)
+            return
+        _, action, job_id = data.split("_", 2)
+        job = BROADCAST_JOBS.get(int(job_id))
+        if not job:
+            await callback.answer("Рассылка уже завершена.", show_alert=True)
+            return
+
+        if action == "pause":
+            job.pause()
+            await callback.answer("⏸ Пауза после текущей пачки")
+        elif action == "resume":
+            job.resume()
+            await callback.answer("▶️ Рассылка продолжается")
+        elif action == "cancel":
+            job.cancel()
+            await callback.answer("⏹ Рассылка будет остановлена после текущей пачки")
+        await job.render(force=True)
+        return
+
+    if data == "mod_profile":
+        if not await has_admin_access(callback.from_user.id):
+            await callback.answer("Доступ запрещён", show_alert=True)
+            return
+        error = start_profile_session(callback.message.chat.id, PROFILE_DEFAULT_SECONDS, use_yappi=False)
+        await callback.answer(
+            error or f"🔬 Профилирую {PROFILE_DEFAULT_SECONDS} с, отчёт придёт файлом.", show_alert=True
         )
+        return
+
+    if data == "bc_cancel":
+        await state.clear()
+        await render_cache.edit_reply_markup(callback.message, reply_markup=None)
+        await callback.answer("❌ Рассылка отменена")
+        return
+
+    if data == "back_to_moder":
+        await show_screen(callback.message, "moder")
         await callback.answer()
         return
 
     if data == "back_to_main":
-        welcome_file_id = await get_media_asset("welcome")
-        caption = (
-            "🎓 Добро пожаловать в бот поддержки абитуриентов и студентов ВГУ!\n\n"
-            "Здесь вы можете:\n"
-            "• Получить персональный QR-код\n"
-            "• Зарегистрироваться на мероприятия\n"
-            "• Настроить уведомления"
-        )
-        media = InputMediaAnimation(
-            media=welcome_file_id,
-            caption=caption,
-            parse_mode="HTML"
-        )
-
-        await callback.message.edit_media(media=media, reply_markup=main_menu_kb(), parse_mode="HTML")
+        await show_screen(callback.message, "main")
         await callback.answer()
         return
 
     await callback.answer()
 
 
+# === Задержка event loop ===
+
+LAG_CHECK_INTERVAL = float(os.getenv("LAG_CHECK_INTERVAL", "0.05"))
+LAG_THRESHOLD_MS = float(os.getenv("LAG_THRESHOLD_MS", "100"))
+# Окно для перцентилей: 6000 замеров по 50 мс — последние пять минут
+LAG_WINDOW = int(os.getenv("LAG_WINDOW", "6000"))
+LAG_STACK_DEPTH = 12
+# Запуск на uvloop (pip install uvloop), см. run_event_loop()
+USE_UVLOOP = os.getenv("USE_UVLOOP", "0") == "1"
+
+
+class LoopLagWatchdog:
+    # Корутина просыпается каждые interval и меряет, насколько позже срока её
+    # разбудили, — это задержка планирования. Пока цикл заблокирован, корутина
+    # ничего не может, поэтому стек снимает поток-наблюдатель: если отметка
+    # корутины не обновлялась дольше порога, он печатает стек потока цикла
+    def __init__(self, interval: float, threshold_ms: float, window: int):
+        self.interval = interval
+        self.threshold = threshold_ms / 1000
+        self.lags: deque = deque(maxlen=window)
+        self.stats = {"stalls": 0, "snapshots": 0, "max_ms": 0.0}
+        self.beat = time.monotonic()
+        self.running = False
+        self.loop_thread: int | None = None
+        self.thread: threading.Thread | None = None
+
+    def percentiles(self) -> dict[str, float]:
+        ordered = sorted(self.lags)
+        if not ordered:
+            return {"p50": 0.0, "p95": 0.0, "p99": 0.0}
+        return {
+            name: ordered[min(int(q * len(ordered)), len(ordered) - 1)] * 1000
+            for name, q in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99))
+        }
+
+    def watch_thread(self):
+        reported = None
+        while True:
+            time.sleep(self.threshold / 2)
+            beat = self.beat
+            stalled = time.monotonic() - beat - self.interval
+            if not self.running or stalled < self.threshold or reported == beat:
+                continue
+            # Одна отметка — один снимок, даже если блокировка длится долго
+            reported = beat
+            frame = sys._current_frames().get(self.loop_thread)
+            if frame is None:
+                continue
+            self.stats["snapshots"] += 1
+            stack = "".join(traceback.format_stack(frame)[-LAG_STACK_DEPTH:])
+            print(f"[LAG] Цикл заблокирован уже {stalled * 1000:.0f} мс, стек:\n{stack}", end="")
+
+    async def run(self):
+        self.loop_thread = threading.get_ident()
+        self.beat = time.monotonic()
+        self.running = True
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.watch_thread, name="lag-watchdog", daemon=True)
+            self.thread.start()
+        try:
+            while True:
+                expected = self.beat + self.interval
+                await asyncio.sleep(self.interval)
+                self.beat = time.monotonic()
+                lag = max(self.beat - expected, 0.0)
+                self.lags.append(lag)
+                self.stats["max_ms"] = max(self.stats["max_ms"], lag * 1000)
+                if lag >= self.threshold:
+                    self.stats["stalls"] += 1
+                    print(f"[LAG] Задержка цикла {lag * 1000:.0f} мс")
+        finally:
+            self.running = False
+
+
+lag_watchdog = LoopLagWatchdog(LAG_CHECK_INTERVAL, LAG_THRESHOLD_MS, LAG_WINDOW)
+
+
+# === Профилирование по запросу ===
+
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))
+PROFILE_DEFAULT_SECONDS = int(os.getenv("PROFILE_DEFAULT_SECONDS", "30"))
+PROFILE_MAX_SECONDS = int(os.getenv("PROFILE_MAX_SECONDS", "300"))
+PROFILE_TOP = 25
+PROFILE_STATS = {"running": False, "sessions": 0}
+# Самый глубокий кадр потока цикла в этих файлах — цикл ждёт I/O (runners.py — у uvloop)
+PROFILE_IDLE_FILES = ("selectors.py", "runners.py")
+
+
+def frame_label(filename: str, name: str, lineno: int | None = None) -> str:
+    # Чужие файлы — с каталогом пакета, чтобы pydantic/main.py не путался с ботом
+    where = os.path.basename(filename)
+    if filename != __file__:
+        where = f"{os.path.basename(os.path.dirname(filename))}/{where}"
+    return f"{where}{f':{lineno}' if lineno else ''} {name}"
+
+
+def await_path(coro) -> str:
+    # Цепочка await задачи от внешней корутины к самой глубокой: функции main.py и место ожидания
+    names, last = [], None
+    while coro is not None:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None)
+        if frame is None:
+            break
+        if frame.f_code.co_filename == __file__:
+            names.append(frame.f_code.co_name)
+        last = frame
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None)
+    if last is None:
+        return "(задача без корутины)"
+    if last.f_code.co_filename != __file__:
+        names.append(frame_label(last.f_code.co_filename, last.f_code.co_name, last.f_lineno))
+    return " → ".join(names)
+
+
+class SamplingProfiler:
+    # Поток-сэмплер раз в interval снимает стек потока event loop через
+    # sys._current_frames() — это видно, на чём цикл тратит CPU. Корутина в самом
+    # цикле раз в 100 мс обходит задачи и запоминает, на каком await каждая стоит.
+    # Вне сеанса ни поток, ни корутина не существуют
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.loop_thread = threading.get_ident()
+        self.stop = threading.Event()
+        self.samples = self.idle = self.ticks = 0
+        self.stacks: Counter = Counter()
+        self.lines: Counter = Counter()
+        self.awaits: Counter = Counter()
+
+    def sample_loop_thread(self):
+        while not self.stop.wait(self.interval):
+            frame = sys._current_frames().get(self.loop_thread)
+            if frame is None:
+                continue
+            self.samples += 1
+            if os.path.basename(frame.f_code.co_filename) in PROFILE_IDLE_FILES:
+                self.idle += 1
+                continue
+            self.lines[(frame.f_code.co_filename, frame.f_code.co_name, frame.f_lineno)] += 1
+            stack = []
+            while frame is not None:
+                stack.append((frame.f_code.co_filename, frame.f_code.co_name))
+                frame = frame.f_back
+            self.stacks[tuple(stack)] += 1
+
+    async def sample_tasks(self, period: float = 0.1):
+        current = asyncio.current_task()
+        while not self.stop.is_set():
+            self.ticks += 1
+            for task in asyncio.all_tasks():
+                if task is not current:
+                    self.awaits[await_path(task.get_coro())] += 1
+            await asyncio.sleep(period)
+
+    def report(self, seconds: int) -> str:
+        busy = self.samples - self.idle
+        handlers = {
+            handler.callback.__name__
+            for observer in dp.observers.values() for handler in observer.handlers
+        }
+        entries, inclusive, collapsed = Counter(), Counter(), Counter()
+        for stack, count in self.stacks.items():
+            # Стек от самого глубокого кадра. Точка входа — обработчик апдейта,
+            # а вне обработчиков — самый внешний кадр main.py (фоновая задача)
+            own = [i for i, (filename, _) in enumerate(stack) if filename == __file__]
+            entry = next((i for i in reversed(own) if stack[i][1] in handlers), own[-1] if own else None)
+            entries[stack[entry][1] if entry is not None else "(вне main.py)"] += count
+            for frame in set(stack):
+                inclusive[frame] += count
+            collapsed[stack[:entry + 1] if entry is not None else stack[:8]] += count
+
+        def share(count: int) -> str:
+            return f"{count / max(busy, 1):6.1%}"
+
+        lines = [
+            f"Профиль за {seconds} с, снимок стека каждые {self.interval * 1000:.0f} мс",
+            f"Снимков: {self.samples}, цикл занят в {busy / max(self.samples, 1):.0%} из них",
+            "",
+            "== Точки входа (обработчик или фоновая задача main.py), доля занятого времени ==",
+            *(f"{share(count)}  {name}" for name, count in entries.most_common(PROFILE_TOP)),
+            "",
+            "== Собственное время: строки, на которых стоял цикл ==",
+            *(f"{share(count)}  {frame_label(*line)}" for line, count in self.lines.most_common(PROFILE_TOP)),
+            "",
+            "== Включительное время функций ==",
+            *(f"{share(count)}  {frame_label(*frame)}" for frame, count in inclusive.most_common(PROFILE_TOP)),
+            "",
+            "== Горячие стеки (от точки входа вглубь) ==",
+        ]
+        for stack, count in collapsed.most_common(10):
+            lines.append(f"{share(count)}")
+            lines.extend(f"    {frame_label(*frame)}" for frame in reversed(stack))
+        lines += [
+            "",
+            f"== Ожидания задач: в среднем задач на этом await ({self.ticks} обходов) ==",
+            *(f"{count / max(self.ticks, 1):8.1f}  {path}" for path, count in self.awaits.most_common(PROFILE_TOP)),
+        ]
+        return "\n".join(lines)
+
+
+async def profile_with_sampling(seconds: int) -> str:
+    profiler = SamplingProfiler(PROFILE_INTERVAL)
+    thread = threading.Thread(target=profiler.sample_loop_thread, name="profiler", daemon=True)
+    thread.start()
+    task_sampler = asyncio.create_task(profiler.sample_tasks())
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        profiler.stop.set()
+        await task_sampler
+        await asyncio.to_thread(thread.join)
+    return profiler.report(seconds)
+
+
+async def profile_with_yappi(seconds: int) -> str:
+    # yappi с часами wall учитывает время корутин между await
+    import yappi
+
+    yappi.set_clock_type("wall")
+    yappi.clear_stats()
+    yappi.start()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        yappi.stop()
+    stats = list(yappi.get_func_stats().sort("ttot", "desc"))
+    yappi.clear_stats()
+
+    def row(stat) -> str:
+        return f"{stat.ttot:9.3f} {stat.tsub:9.3f} {stat.ncall:8d}  {frame_label(stat.module, stat.name, stat.lineno)}"
+
+    header = f"{'всего, с':>9} {'своё, с':>9} {'вызовов':>8}  функция"
+    return "\n".join([
+        f"Профиль yappi (wall) за {seconds} с",
+        "",
+        "== Функции main.py ==",
+        header,
+        *(row(stat) for stat in [stat for stat in stats if stat.module == __file__][:PROFILE_TOP]),
+        "",
+        "== Все функции ==",
+        header,
+        *(row(stat) for stat in stats[:PROFILE_TOP * 2]),
+    ])
+
+
+async def run_profile_session(chat_id: int, seconds: int, use_yappi: bool):
+    started_at = datetime.now()
+    try:
+        report = await (profile_with_yappi if use_yappi else profile_with_sampling)(seconds)
+        await bot.send_document(
+            chat_id,
+            document=BufferedInputFile(report.encode(), filename=f"profile_{started_at:%Y%m%d_%H%M%S}.txt"),
+            caption=f"🔬 Профиль за {seconds} с ({'yappi' if use_yappi else 'сэмплирование'})"
+        )
+    except Exception as e:
+        print(f"[PROFILE] Ошибка сеанса: {e}")
+        await bot.send_message(chat_id, f"❌ Профилирование не удалось: {e}")
+    finally:
+        PROFILE_STATS["running"] = False
+
+
+def start_profile_session(chat_id: int, seconds: int, use_yappi: bool) -> str | None:
+    # Возвращает текст ошибки или None, если сеанс запущен
+    if PROFILE_STATS["running"]:
+        return "⏳ Профилирование уже идёт, дождитесь отчёта."
+    if use_yappi and importlib.util.find_spec("yappi") is None:
+        return "❌ yappi не установлен: pip install yappi"
+    PROFILE_STATS["running"] = True
+    PROFILE_STATS["sessions"] += 1
+    print(f"[PROFILE] Сеанс на {seconds} с ({'yappi' if use_yappi else 'сэмплирование'})")
+    spawn(run_profile_session(chat_id, seconds, use_yappi))
+    return None
+
+
+@dp.message(Command("profile"))
+async def cmd_profile(message: types.Message):
+    if not await has_admin_access(message.from_user.id):
+        await message.answer("⚠️ Только модератор.")
+        return
+
+    args = (message.text or "").split()[1:]
+    seconds, use_yappi = PROFILE_DEFAULT_SECONDS, False
+    for arg in args:
+        if arg.isdigit():
+            seconds = min(max(int(arg), 1), PROFILE_MAX_SECONDS)
+        elif arg.lower() == "yappi":
+            use_yappi = True
+        else:
+            await message.answer(
+                f"Используйте: <code>/profile [секунды] [yappi]</code> — до {PROFILE_MAX_SECONDS} с",
+                parse_mode="HTML"
+            )
+            return
+
+    error = start_profile_session(message.chat.id, seconds, use_yappi)
+    await message.answer(error or f"🔬 Профилирую {seconds} с, отчёт придёт файлом.")
+
+
+# === Метрики ===
+
+def metrics_text() -> str:
+    lines = [
+        "📈 <b>Метрики</b>",
+        "",
+        "<b>Кнопки</b>",
+        f"Обработано: {THROTTLE_STATS['passed']}",
+        f"Склеено повторов: {THROTTLE_STATS['coalesced']}",
+        f"Отброшено лимитом: {THROTTLE_STATS['throttled']}",
+        "",
+        "<b>Рассылки</b>",
+        f"Помечено неактивными: {SUPPRESSION_STATS['deactivated']}",
+        f"Пропущено отправок: {SUPPRESSION_STATS['suppressed']}",
+        f"Подписчиков в памяти: мероприятия {len(subscribers.events)}, новости {len(subscribers.news)}",
+        f"Активных рассылок: {len(BROADCAST_JOBS)}",
+        f"Очередь QR для входа: {CHECKIN_QR_QUEUE.qsize()}",
+        "",
+        "<b>Новостные ленты</b>",
+        *(
+            f"{feed.name}: опрос раз в {feed.interval / 60:.0f} мин, "
+            f"запросов {feed.polls}, без изменений {feed.not_modified}, ошибок подряд {feed.failures}"
+            for feed in NEWS_FEEDS.values()
+        ),
+        "",
+        f"Дайджестов отправлено: {DIGEST_STATS['messages']}, вместо отдельных сообщений: {DIGEST_STATS['items']}",
+        "",
+        "<b>Очередь Bot API</b>",
+        *(
+            f"{lane}: в очереди {api_scheduler.queue_depth(lane)}, вызовов {api_scheduler.stats[lane]['calls']}, "
+            f"ожидание ср. {api_scheduler.stats[lane]['wait_total'] / max(api_scheduler.stats[lane]['calls'], 1) * 1000:.0f} мс, "
+            f"макс. {api_scheduler.stats[lane]['wait_max'] * 1000:.0f} мс"
+            for lane in API_LANES
+        ),
+        f"Ответов 429: {api_scheduler.stats['retry_after']}",
+        "",
+        "<b>Архив</b>",
+        f"Перенесено с запуска: мероприятий {ARCHIVE_STATS['events']}, регистраций {ARCHIVE_STATS['registrations']}",
+        "",
+        "<b>Обслуживание БД</b>",
+        f"Последний ночной проход: {MAINTENANCE_STATS['last_run'] or 'не было'}",
+        f"Checkpoint WAL: {MAINTENANCE_STATS['checkpoints']}, освобождено страниц: {MAINTENANCE_STATS['vacuumed_pages']}",
+        "",
+        "<b>Кэш строк</b>",
+        f"Мероприятия: {event_cache.stats['hits']} попаданий / {event_cache.stats['misses']} промахов",
+        f"Локации: {location_cache.stats['hits']} попаданий / {location_cache.stats['misses']} промахов",
+        "",
+        "<b>Правки экранов</b>",
+        f"Полных: {render_cache.stats['edits']}, только подпись: {render_cache.stats['caption_only']}, "
+        f"только клавиатура: {render_cache.stats['markup_only']}",
+        f"Пропущено без изменений: {render_cache.stats['skipped']}, ответов «not modified»: {render_cache.stats['not_modified']}",
+        "",
+        "<b>Задержка event loop</b>",
+        "p50 {p50:.1f} мс, p95 {p95:.1f} мс, p99 {p99:.1f} мс".format(**lag_watchdog.percentiles()),
+        f"Максимум: {lag_watchdog.stats['max_ms']:.0f} мс, "
+        f"дольше {LAG_THRESHOLD_MS:.0f} мс: {lag_watchdog.stats['stalls']} раз",
+        "",
+        "<b>Профилирование</b>",
+        f"{'Идёт сеанс' if PROFILE_STATS['running'] else 'Не запущено'}, сеансов с запуска: {PROFILE_STATS['sessions']}",
+        "",
+        "<b>Запись в БД</b>",
+        f"Операций: {db_writer.stats['operations']}, пачек: {db_writer.stats['batches']}",
+        f"В очереди: {db_writer.queue.qsize()}",
+    ]
+    return "\n".join(lines)
+
+
+@dp.message(Command("metrics"))
+async def cmd_metrics(message: types.Message):
+    if not await has_admin_access(message.from_user.id):
+        await message.answer("⚠️ Только модератор.")
+        return
+    await message.answer(metrics_text(), parse_mode="HTML")
+
+
 # === Запуск ===
 
+class StartupTimer:
+    def __init__(self):
+        self.phases: list[tuple[str, float]] = []
+
+    async def phase(self, name: str, coro):
+        started = time.perf_counter()
+        result = await coro
+        self.phases.append((name, (time.perf_counter() - started) * 1000))
+        return result
+
+    def report(self):
+        total = (time.perf_counter() - STARTUP_STARTED) * 1000
+        breakdown = ", ".join(f"{name}: {ms:.0f} мс" for name, ms in self.phases)
+        print(f"[Startup] {breakdown}; всего {total:.0f} мс")
+
+
+FIRST_UPDATE_SEEN = False
+
+
+@dp.update.outer_middleware()
+async def first_update_middleware(handler, event, data):
+    global FIRST_UPDATE_SEEN
+    if not FIRST_UPDATE_SEEN:
+        FIRST_UPDATE_SEEN = True
+        print(f"[Startup] Первое обновление через {(time.perf_counter() - STARTUP_STARTED) * 1000:.0f} мс после запуска")
+    return await handler(event, data)
+
+
+# === Обслуживание БД ===
+# Только для SQLite: задачи работают с файлом базы напрямую, мимо repo
+
+MAINTENANCE_HOUR = int(os.getenv("MAINTENANCE_HOUR", "4"))            # ночное окно, местное время
+MAINTENANCE_IDLE_SECONDS = float(os.getenv("MAINTENANCE_IDLE_SECONDS", "60"))
+MAINTENANCE_BUDGET_MS = float(os.getenv("MAINTENANCE_BUDGET_MS", "50"))  # максимум блокировки за шаг
+MAINTENANCE_TOTAL_SECONDS = 300    # общий лимит ночного прохода
+MAINTENANCE_WINDOW = timedelta(hours=1)   # после начала окна ждём затишья не дольше часа
+CHECKPOINT_INTERVAL = 15 * 60
+VACUUM_MAX_PAGES = 2000
+VACUUM_BUSY_TIMEOUT_MS = 5000      # /vacuum ждёт текущую пачку писателя, а не падает сразу
+
+# Время последнего апдейта от Telegram — по нему ждём затишья
+LAST_UPDATE_AT = time.monotonic()
+MAINTENANCE_STATS = {"last_run": None, "checkpoints": 0, "vacuumed_pages": 0}
+
+
+@dp.update.outer_middleware()
+async def activity_middleware(handler, event, data):
+    global LAST_UPDATE_AT
+    LAST_UPDATE_AT = time.monotonic()
+    return await handler(event, data)
+
+
+async def log_maintenance(task: str, started: float, details: str = ""):
+    duration_ms = (time.perf_counter() - started) * 1000
+    await db_writer.execute(
+        "INSERT INTO maintenance_log (task, duration_ms, details) VALUES (?, ?, ?)",
+        (task, round(duration_ms, 1), details)
+    )
+    print(f"[DB] {task}: {duration_ms:.0f} мс {details}".rstrip())
+
+
+async def checkpoint_wal(mode: str) -> tuple[int, int, int]:
+    # Отдельное соединение с коротким busy_timeout: если читатели или писатель
+    # заняты дольше бюджета, SQLite вернёт busy=1, и мы попробуем в следующий раз
+    async with aiosqlite.connect(DB_PATH) as db:
+        await db.execute(f"PRAGMA busy_timeout = {int(MAINTENANCE_BUDGET_MS)}")
+        cursor = await db.execute(f"PRAGMA wal_checkpoint({mode})")
+        busy, log_pages, checkpointed = await cursor.fetchone()
+    MAINTENANCE_STATS["checkpoints"] += 1
+    return busy, log_pages, checkpointed
+
+
+async def optimize_db():
+    # analysis_limit ограничивает ANALYZE выборкой строк, чтобы он укладывался в окно
+    async with aiosqlite.connect(DB_PATH) as db:
+        await db.execute(f"PRAGMA busy_timeout = {int(MAINTENANCE_BUDGET_MS)}")
+        await db.execute("PRAGMA analysis_limit = 400")
+        await db.execute("PRAGMA optimize")
+
+
+async def incremental_vacuum_enabled() -> bool:
+    async with aiosqlite.connect(DB_PATH) as db:
+        cursor = await db.execute("PRAGMA auto_vacuum")
+        return (await cursor.fetchone())[0] == 2  # 2 = INCREMENTAL
+
+
+async def convert_to_incremental_vacuum() -> float:
+    # Полный VACUUM переписывает файл базы целиком и всё это время держит
+    # эксклюзивную блокировку. Поэтому он не запускается сам, только через /vacuum
+    started = time.perf_counter()
+    async with aiosqlite.connect(DB_PATH) as db:
+        await db.execute(f"PRAGMA busy_timeout = {VACUUM_BUSY_TIMEOUT_MS}")
+        await db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        await db.execute("VACUUM")
+    return time.perf_counter() - started
+
+
+async def incremental_vacuum(deadline: float) -> int:
+    # Возвращаем свободные страницы короткими шагами: писатель бота ждёт не дольше
+    # одного шага, размер шага подстраивается под MAINTENANCE_BUDGET_MS
+    pages, freed = 100, 0
+    async with aiosqlite.connect(DB_PATH) as db:
+        await db.execute(f"PRAGMA busy_timeout = {int(MAINTENANCE_BUDGET_MS)}")
+        while time.monotonic() < deadline:
+            cursor = await db.execute("PRAGMA freelist_count")
+            free = (await cursor.fetchone())[0]
+            if not free:
+                break
+
+            started = time.perf_counter()
+            try:
+                # executescript доводит прагму до конца: execute освобождает по одной странице за шаг
+                await db.executescript(f"PRAGMA incremental_vacuum({min(pages, free)});")
+            except sqlite3.OperationalError:
+                # База занята дольше бюджета — уступаем и пробуем позже
+                await asyncio.sleep(1)
+                continue
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            freed += min(pages, free)
+
+            if elapsed_ms > MAINTENANCE_BUDGET_MS:
+                pages = max(pages // 2, 10)
+            elif elapsed_ms < MAINTENANCE_BUDGET_MS / 2:
+                pages = min(pages * 2, VACUUM_MAX_PAGES)
+            await asyncio.sleep(0.1)
+    MAINTENANCE_STATS["vacuumed_pages"] += freed
+    return freed
+
+
+async def run_nightly_maintenance():
+    deadline = time.monotonic() + MAINTENANCE_TOTAL_SECONDS
+
+    started = time.perf_counter()
+    await optimize_db()
+    await log_maintenance("optimize", started)
+
+    started = time.perf_counter()
+    if await incremental_vacuum_enabled():
+        freed = await incremental_vacuum(deadline)
+        await log_maintenance("incremental_vacuum", started, f"страниц: {freed}")
+    else:
+        await log_maintenance("incremental_vacuum", started, "пропущен: auto_vacuum не INCREMENTAL, см. /vacuum")
+
+    started = time.perf_counter()
+    busy, log_pages, checkpointed = await checkpoint_wal("TRUNCATE")
+    await log_maintenance("checkpoint_truncate", started, f"busy={busy} log={log_pages} done={checkpointed}")
+    MAINTENANCE_STATS["last_run"] = datetime.now().strftime("%Y-%m-%d %H:%M")
+
+
+def next_maintenance_window(now: datetime) -> datetime:
+    start = now.replace(hour=MAINTENANCE_HOUR, minute=0, second=0, microsecond=0)
+    return start if start > now else start + timedelta(days=1)
+
+
+async def maintenance_loop():
+    # Пассивный checkpoint — регулярно, он не ждёт читателей и писателей.
+    # Тяжёлые задачи — раз в сутки: просыпаемся к началу ночного окна и, если
+    # бот занят, ждём затишья до конца окна.
+    next_checkpoint = time.monotonic() + CHECKPOINT_INTERVAL
+    window = next_maintenance_window(datetime.now())
+    run_at = window
+    while True:
+        # Сон не длиннее интервала checkpoint: перевод часов сдвигает окно не больше чем на него
+        wait = min(next_checkpoint - time.monotonic(), (run_at - datetime.now()).total_seconds())
+        if wait > 0:
+            await asyncio.sleep(wait)
+            continue
+        try:
+            if time.monotonic() >= next_checkpoint:
+                next_checkpoint = time.monotonic() + CHECKPOINT_INTERVAL
+                await checkpoint_wal("PASSIVE")
+
+            now = datetime.now()
+            if now < run_at:
+                continue
+            idle_for = time.monotonic() - LAST_UPDATE_AT
+            if now >= window + MAINTENANCE_WINDOW:
+                print("[DB] Ночное обслуживание пропущено: за окно не было затишья")
+                window = run_at = next_maintenance_window(now)
+            elif idle_for >= MAINTENANCE_IDLE_SECONDS:
+                window = run_at = next_maintenance_window(window + MAINTENANCE_WINDOW)
+                await run_nightly_maintenance()
+            else:
+                run_at = now + timedelta(seconds=MAINTENANCE_IDLE_SECONDS - idle_for)
+        except Exception as e:
+            print(f"[DB] Ошибка обслуживания: {e}")
+
+
+@dp.message(Command("vacuum"))
+async def cmd_vacuum(message: types.Message):
+    if not await has_admin_access(message.from_user.id):
+        await message.answer("⚠️ Только модератор.")
+        return
+
+    if await incremental_vacuum_enabled():
+        await message.answer("✅ auto_vacuum=INCREMENTAL уже включён, свободное место возвращается ночью.")
+        return
+
+    args = (message.text or "").split()[1:]
+    if args != ["confirm"]:
+        async with aiosqlite.connect(DB_PATH) as db:
+            page_count = (await (await db.execute("PRAGMA page_count")).fetchone())[0]
+            page_size = (await (await db.execute("PRAGMA page_size")).fetchone())[0]
+        await message.answer(
+            "🧹 <b>Разовый VACUUM</b>\n\n"
+            "Переводит базу в auto_vacuum=INCREMENTAL, после чего ночное обслуживание "
+            "возвращает свободное место короткими шагами.\n\n"
+            f"Размер базы: {page_count * page_size / 1024 / 1024:.1f} МБ. VACUUM переписывает файл целиком "
+            "и всё это время держит эксклюзивную блокировку: записи бота ждут до "
+            f"{VACUUM_BUSY_TIMEOUT_MS // 1000} с и при более долгом VACUUM завершаются ошибкой. "
+            "Нужно свободное место на диске не меньше размера базы.\n\n"
+            "Запускайте в затишье: <code>/vacuum confirm</code>",
+            parse_mode="HTML"
+        )
+        return
+
+    await message.answer("🧹 VACUUM запущен…")
+    try:
+        duration = await convert_to_incremental_vacuum()
+    except sqlite3.OperationalError as e:
+        await message.answer(f"❌ VACUUM не выполнен: {e}")
+        return
+    await log_maintenance("vacuum", time.perf_counter() - duration, "включён auto_vacuum=INCREMENTAL")
+    await message.answer(f"✅ Готово за {duration:.1f} с, auto_vacuum=INCREMENTAL включён.")
+
+
 async def main():
-    await init_db()
-    me = await bot.get_me()
+    timer = StartupTimer()
+    timer.phases.append(("imports", (time.perf_counter() - STARTUP_STARTED) * 1000))
+
+    # Миграции БД и запрос к Bot API не зависят друг от друга
+    _, me = await asyncio.gather(
+        timer.phase("init_db", init_db()),
+        timer.phase("get_me", bot.get_me()),
+    )
+    # Прогрев кэшей после миграций
+    await asyncio.gather(
+        timer.phase("media_cache", load_media_cache()),
+        timer.phase("subscribers", subscribers.load()),
+        timer.phase("reminders", reminder_scheduler.rebuild()),
+        timer.phase("location_index", rebuild_location_index()),
+        timer.phase("news_feeds", load_news_feeds()),
+    )
+    timer.report()
+
     print(f"✅ Бот запущен как @{me.username}")
     asyncio.create_task(rss_monitor())
+    asyncio.create_task(news_digest_loop())
+    asyncio.create_task(archive_loop())
+    asyncio.create_task(maintenance_loop())
+    asyncio.create_task(reminder_scheduler.run())
+    asyncio.create_task(checkin_qr_worker())
+    asyncio.create_task(lag_watchdog.run())
+    spawn(backfill_checkin_qr())
     await dp.start_polling(bot)
 
 
+def run_event_loop(coro):
+    # USE_UVLOOP=1 — цикл на libuv; без пакета uvloop остаёмся на asyncio
+    if USE_UVLOOP:
+        try:
+            import uvloop
+        except ImportError:
+            print("[Startup] USE_UVLOOP=1, но uvloop не установлен — запускаюсь на asyncio")
+        else:
+            print(f"[Startup] Event loop: uvloop {uvloop.__version__}")
+            return uvloop.run(coro)
+    return asyncio.run(coro)
+
+
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    run_event_loop(main())
\ No newline at end of file
@@ -0,0 +1,96 @@
+"""Рендер листов с QR-кодами локаций для /qr_sheets.
+
+Модуль не импортирует бота: main.py запускает его отдельным процессом
+(python -m qr_sheets sheet|pdf), задание приходит JSON-ом в stdin, готовый
+PNG или PDF уходит в stdout. Процесс стартует через fork+exec и не
+наследует потоки бота, а импорт здесь — только qrcode и Pillow.
+"""
+import base64
+import json
+import sys
+from io import BytesIO
+
+SHEET_SIZE = (2480, 3508)  # A4 при 300 dpi
+SHEET_GRID = (3, 4)        # колонки × строки
+SHEET_MARGIN = 120
+PER_SHEET = SHEET_GRID[0] * SHEET_GRID[1]
+
+
+def render_sheet(locations: list[tuple[str, str]], bot_username: str, font_path: str) -> bytes:
+    # Рисует до 12 QR-кодов с подписями на листе A4
+    import qrcode
+    from PIL import Image, ImageDraw, ImageFont
+
+    columns, rows = SHEET_GRID
+    cell_w = (SHEET_SIZE[0] - 2 * SHEET_MARGIN) // columns
+    cell_h = (SHEET_SIZE[1] - 2 * SHEET_MARGIN) // rows
+    qr_side = min(cell_w, cell_h) - 200
+
+    try:
+        font = ImageFont.truetype(font_path, 44)
+    except OSError:
+        font = ImageFont.load_default(size=44)
+
+    sheet = Image.new("RGB", SHEET_SIZE, "white")
+    draw = ImageDraw.Draw(sheet)
+
+    for index, (loc_id, name) in enumerate(locations):
+        x = SHEET_MARGIN + (index % columns) * cell_w
+        y = SHEET_MARGIN + (index // columns) * cell_h
+        draw.rectangle((x, y, x + cell_w - 1, y + cell_h - 1), outline=(200, 200, 200), width=2)
+
+        qr = qrcode.QRCode(border=2)
+        qr.add_data(f"https://t.me/{bot_username}?start=location_{loc_id}")
+        qr.make(fit=True)
+        # Целый размер модуля, чтобы код печатался без артефактов масштабирования
+        qr.box_size = qr_side // (qr.modules_count + 2 * qr.border)
+        qr_img = qr.make_image(fill_color="black", back_color="white").get_image().convert("RGB")
+        sheet.paste(qr_img, (x + (cell_w - qr_img.width) // 2, y + 40 + (qr_side - qr_img.height) // 2))
+
+        # Подпись в две строки максимум, по ширине ячейки
+        lines, line = [], ""
+        for word in name.split():
+            candidate = f"{line} {word}".strip()
+            if line and draw.textlength(candidate, font=font) > cell_w - 40:
+                lines.append(line)
+                line = word
+            else:
+                line = candidate
+        lines.append(line)
+        if len(lines) > 2:
+            lines = [lines[0], lines[1][:max(len(lines[1]) - 1, 0)] + "…"]
+
+        text_y = y + 60 + qr_side
+        for text_line in lines:
+            text_w = draw.textlength(text_line, font=font)
+            draw.text((x + (cell_w - text_w) / 2, text_y), text_line, fill="black", font=font)
+            text_y += 54
+
+    bio = BytesIO()
+    sheet.save(bio, format="PNG", dpi=(300, 300))
+    return bio.getvalue()
+
+
+def sheets_to_pdf(sheets: list[bytes]) -> bytes:
+    from PIL import Image
+
+    pages = [Image.open(BytesIO(sheet)).convert("RGB") for sheet in sheets]
+    bio = BytesIO()
+    pages[0].save(bio, format="PDF", save_all=True, append_images=pages[1:], resolution=300)
+    return bio.getvalue()
+
+
+def main() -> None:
+    command = sys.argv[1] if len(sys.argv) > 1 else ""
+    job = json.load(sys.stdin)
+    if command == "sheet":
+        result = render_sheet([tuple(loc) for loc in job["locations"]], job["bot_username"], job["font_path"])
+    elif command == "pdf":
+        result = sheets_to_pdf([base64.b64decode(sheet) for sheet in job["sheets"]])
+    else:
+        sys.exit("Использование: python -m qr_sheets sheet|pdf < задание.json")
+    sys.stdout.buffer.write(result)
+
+
+if __name__ == "__main__":
+    main()
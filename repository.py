@@ -0,0 +1,963 @@
+"""Доступ к данным для обработчиков бота.
+
+SQLiteRepository работает с bot.db: чтение — через отдельные соединения,
+запись — через групповой писатель из main.py. MemoryRepository хранит всё
+в словарях и повторяет поведение SQLite-версии; нужен нагрузочному стенду,
+чтобы отделить стоимость обработчиков от стоимости хранилища.
+
+Через репозиторий идут обработчики и отправка рассылок. Фоновые задачи
+(опрос лент и дайджесты, напоминания, догрузка QR) и обслуживание файла
+базы (checkpoint, VACUUM, /vacuum) работают только с SQLite напрямую.
+"""
+import itertools
+from datetime import datetime, timedelta, timezone
+
+
+NEWS_MODES = ("immediate", "hourly", "daily")
+PREF_COLUMNS = ("events_enabled", "news_enabled")
+DEFAULT_STATUS = "Не зачислен"  # как DEFAULT у users.status
+
+EVENT_ARCHIVE_COLUMNS = (
+    "id, title, description, event_datetime, location, registration_deadline, photo_file_id, "
+    "created_by, created_at, capacity, waitlist_enabled, seats_taken"
+)
+REGISTRATION_ARCHIVE_COLUMNS = "user_id, event_id, registered_at, status, attended"
+LOOKUP_CHUNK = 500  # ID в одном IN (...): ниже лимита параметров SQLite
+
+
+def segment_query(segment: dict, active: bool = True) -> tuple[str, str, str, list]:
+    # FROM-часть, ключ пагинации, условия WHERE и их параметры
+    source, key = "users u JOIN notification_prefs np ON u.tg_id = np.user_id", "u.tg_id"
+    conditions, params = [], []
+
+    kind, value = segment.get("kind", "all"), segment.get("value")
+    if kind == "event":
+        # Записавшихся берём из registrations по idx_registrations_event(event_id, user_id),
+        # а не перебираем всех пользователей с подзапросом на каждого
+        source = ("registrations r JOIN users u ON u.tg_id = r.user_id"
+                  " JOIN notification_prefs np ON np.user_id = r.user_id")
+        key = "r.user_id"
+        conditions += ["r.event_id = ?", "r.status = 'confirmed'"]
+        params.append(value)
+
+    conditions.append("u.is_active = ?")
+    params.append(int(active))
+
+    # Без ключа pref настройки уведомлений не учитываются (напоминания записавшимся)
+    pref = segment.get("pref")
+    if pref == "events":
+        conditions.append("np.events_enabled = 1")
+    elif pref == "news":
+        conditions.append("np.news_enabled = 1")
+    elif pref == "any":
+        conditions.append("(np.events_enabled = 1 OR np.news_enabled = 1)")
+    if segment.get("mode"):
+        conditions.append("np.news_mode = ?")
+        params.append(segment["mode"])
+    if segment.get("feed"):
+        conditions.append("NOT EXISTS (SELECT 1 FROM feed_optouts fo WHERE fo.user_id = u.tg_id AND fo.feed_id = ?)")
+        params.append(segment["feed"])
+
+    if kind == "role":
+        conditions.append("u.role = ?")
+        params.append(value)
+    elif kind == "status":
+        conditions.append("u.status = ?")
+        params.append(value)
+    elif kind == "not_event":
+        conditions.append("NOT EXISTS (SELECT 1 FROM registrations r WHERE r.event_id = ? AND r.user_id = u.tg_id)")
+        params.append(value)
+    elif kind == "joined":
+        since, until = value
+        if since:
+            conditions.append("u.joined_at >= ?")
+            params.append(since)
+        if until:
+            # Верхняя граница включительно — до конца указанного дня
+            conditions.append("u.joined_at < date(?, '+1 day')")
+            params.append(until)
+
+    return source, key, " AND ".join(conditions), params
+
+
+class SQLiteRepository:
+    def __init__(self, connect, writer):
+        # connect() возвращает новое соединение aiosqlite, writer — GroupCommitWriter
+        self.connect = connect
+        self.writer = writer
+
+    # --- Пользователи ---
+
+    async def upsert_user(self, tg_id: int, full_name: str, username: str | None):
+        # /start от заблокировавшего бота пользователя снова делает его активным
+        async def operation(db):
+            await db.execute("""
+                INSERT INTO users (tg_id, full_name, username)
+                VALUES (?, ?, ?)
+                ON CONFLICT(tg_id) DO UPDATE SET
+                    full_name = excluded.full_name,
+                    username = excluded.username,
+                    is_active = 1,
+                    deactivated_at = NULL
+            """, (tg_id, full_name, username))
+            await db.execute("INSERT OR IGNORE INTO notification_prefs (user_id) VALUES (?)", (tg_id,))
+        await self.writer.submit(operation)
+
+    async def get_user(self, tg_id: int) -> dict | None:
+        async with self.connect() as db:
+            cursor = await db.execute(
+                "SELECT full_name, username, role, status FROM users WHERE tg_id = ?", (tg_id,)
+            )
+            row = await cursor.fetchone()
+        if not row:
+            return None
+        return dict(zip(("full_name", "username", "role", "status"), row))
+
+    async def get_role(self, tg_id: int) -> str | None:
+        async with self.connect() as db:
+            cursor = await db.execute("SELECT role FROM users WHERE tg_id = ?", (tg_id,))
+            row = await cursor.fetchone()
+        return row[0] if row else None
+
+    async def search_users(self, query: str) -> list[tuple]:
+        async with self.connect() as db:
+            if query.isdigit():
+                cursor = await db.execute(
+                    "SELECT tg_id, full_name, username, role FROM users WHERE tg_id = ?", (int(query),)
+                )
+            else:
+                cursor = await db.execute(
+                    "SELECT tg_id, full_name, username, role FROM users WHERE full_name LIKE ?", (f"%{query}%",)
+                )
+            return await cursor.fetchall()
+
+    async def set_role(self, tg_id: int, role: str) -> bool:
+        return bool(await self.writer.execute("UPDATE users SET role = ? WHERE tg_id = ?", (role, tg_id)))
+
+    async def set_status(self, tg_id: int, status: str) -> bool:
+        return bool(await self.writer.execute("UPDATE users SET status = ? WHERE tg_id = ?", (status, tg_id)))
+
+    async def bulk_update_users(self, updates: dict[int, tuple[str | None, str | None]]) -> set[int]:
+        # Весь файл — одна операция писателя: либо применён целиком, либо не применён вовсе.
+        # Возвращает ID, которые нашлись в базе и были обновлены
+        ids = list(updates)
+
+        async def operation(db):
+            found = set()
+            for i in range(0, len(ids), LOOKUP_CHUNK):
+                part = ids[i:i + LOOKUP_CHUNK]
+                cursor = await db.execute(
+                    f"SELECT tg_id FROM users WHERE tg_id IN ({','.join('?' * len(part))})", part
+                )
+                found.update(row[0] for row in await cursor.fetchall())
+            await db.executemany(
+                "UPDATE users SET status = COALESCE(?, status), role = COALESCE(?, role) WHERE tg_id = ?",
+                [(status, role, tg_id) for tg_id, (status, role) in updates.items() if tg_id in found]
+            )
+            return found
+        return await self.writer.submit(operation)
+
+    async def mark_inactive(self, tg_ids: list[int]):
+        # Пользователь заблокировал бота: рассылки его пропускают до следующего /start
+        async def operation(db):
+            await db.executemany(
+                "UPDATE users SET is_active = 0, deactivated_at = CURRENT_TIMESTAMP WHERE tg_id = ?",
+                [(tg_id,) for tg_id in tg_ids]
+            )
+        await self.writer.submit(operation)
+
+    async def attendance(self, tg_id: int) -> dict:
+        # Текущие регистрации плюс итоги по архиву прошедших мероприятий
+        async with self.connect() as db:
+            cursor = await db.execute("""
+                SELECT
+                    COUNT(*) AS total,
+                    COUNT(*) FILTER (WHERE attended = 1) AS visited
+                FROM registrations r
+                JOIN events e ON r.event_id = e.id
+                WHERE r.user_id = ?
+            """, (tg_id,))
+            total, visited = await cursor.fetchone()
+            cursor = await db.execute(
+                "SELECT registrations, attended FROM user_attendance_totals WHERE user_id = ?", (tg_id,)
+            )
+            archived = await cursor.fetchone() or (0, 0)
+        return {"total": total, "visited": visited, "archived_total": archived[0], "archived_visited": archived[1]}
+
+    async def user_event_history(self, tg_id: int) -> list[tuple[str, str]]:
+        async with self.connect() as db:
+            cursor = await db.execute("""
+                SELECT e.title, e.event_datetime FROM events e
+                JOIN registrations r ON e.id = r.event_id
+                WHERE r.user_id = ?
+            """, (tg_id,))
+            return await cursor.fetchall()
+
+    async def stats(self) -> dict:
+        async with self.connect() as db:
+            cursor = await db.execute("""
+                SELECT
+                    (SELECT COUNT(*) FROM users),
+                    (SELECT COUNT(*) FROM events),
+                    (SELECT COUNT(*) FROM registrations),
+                    (SELECT COUNT(*) FROM users WHERE is_active = 0),
+                    (SELECT COUNT(*) FROM events_archive)
+            """)
+            row = await cursor.fetchone()
+        return dict(zip(("users", "events", "registrations", "inactive", "archived"), row))
+
+    # --- Настройки уведомлений ---
+
+    async def get_prefs(self, user_id: int) -> tuple[bool, bool, str]:
+        async with self.connect() as db:
+            cursor = await db.execute(
+                "SELECT events_enabled, news_enabled, news_mode FROM notification_prefs WHERE user_id = ?",
+                (user_id,)
+            )
+            row = await cursor.fetchone()
+        # Если настроек нет (маловероятно, но на всякий случай)
+        return (bool(row[0]), bool(row[1]), row[2]) if row else (True, True, "immediate")
+
+    async def toggle_pref(self, user_id: int, column: str) -> tuple[bool, bool, str]:
+        # Переключение и чтение флагов — одна операция вместо двух соединений
+        if column not in PREF_COLUMNS:
+            raise ValueError(f"Неизвестная настройка: {column}")
+
+        async def operation(db):
+            cursor = await db.execute(f"""
+                UPDATE notification_prefs SET {column} = 1 - {column}
+                WHERE user_id = ?
+                RETURNING events_enabled, news_enabled, news_mode
+            """, (user_id,))
+            row = await cursor.fetchone()
+            await cursor.close()
+            return (bool(row[0]), bool(row[1]), row[2]) if row else (True, True, "immediate")
+        return await self.writer.submit(operation)
+
+    async def cycle_news_mode(self, user_id: int) -> tuple[bool, bool, str]:
+        async def operation(db):
+            cursor = await db.execute("SELECT news_mode FROM notification_prefs WHERE user_id = ?", (user_id,))
+            row = await cursor.fetchone()
+            await cursor.close()
+            current = row[0] if row and row[0] in NEWS_MODES else "immediate"
+            cursor = await db.execute("""
+                UPDATE notification_prefs SET news_mode = ?
+                WHERE user_id = ?
+                RETURNING events_enabled, news_enabled, news_mode
+            """, (NEWS_MODES[(NEWS_MODES.index(current) + 1) % len(NEWS_MODES)], user_id))
+            row = await cursor.fetchone()
+            await cursor.close()
+            return (bool(row[0]), bool(row[1]), row[2]) if row else (True, True, "immediate")
+        return await self.writer.submit(operation)
+
+    async def get_feed_optouts(self, user_id: int) -> set[int]:
+        async with self.connect() as db:
+            cursor = await db.execute("SELECT feed_id FROM feed_optouts WHERE user_id = ?", (user_id,))
+            return {row[0] for row in await cursor.fetchall()}
+
+    async def toggle_feed_optout(self, user_id: int, feed_id: int) -> bool:
+        # Возвращает True, если пользователь теперь получает новости этой ленты
+        async def operation(db):
+            cursor = await db.execute(
+                "DELETE FROM feed_optouts WHERE user_id = ? AND feed_id = ?", (user_id, feed_id)
+            )
+            if cursor.rowcount:
+                return True
+            await db.execute("INSERT INTO feed_optouts (user_id, feed_id) VALUES (?, ?)", (user_id, feed_id))
+            return False
+        return await self.writer.submit(operation)
+
+    async def subscriber_snapshot(self) -> tuple[list[tuple], list[tuple[int, int]]]:
+        # Настройки всех пользователей разом — для индекса подписчиков в памяти
+        async with self.connect() as db:
+            cursor = await db.execute("""
+                SELECT u.tg_id, np.events_enabled, np.news_enabled, np.news_mode, u.is_active
+                FROM users u
+                JOIN notification_prefs np ON u.tg_id = np.user_id
+            """)
+            prefs = await cursor.fetchall()
+            cursor = await db.execute("SELECT user_id, feed_id FROM feed_optouts")
+            optouts = await cursor.fetchall()
+        return prefs, optouts
+
+    # --- Сегменты рассылок ---
+
+    async def count_segment(self, segment: dict, active: bool = True) -> int:
+        source, _, where, params = segment_query(segment, active)
+        async with self.connect() as db:
+            cursor = await db.execute(f"SELECT COUNT(*) FROM {source} WHERE {where}", params)
+            return (await cursor.fetchone())[0]
+
+    async def segment_page(self, segment: dict, after: int, limit: int) -> list[int]:
+        # Keyset-пагинация: следующие limit ID после after, по возрастанию
+        source, key, where, params = segment_query(segment)
+        async with self.connect() as db:
+            cursor = await db.execute(f"""
+                SELECT {key} FROM {source}
+                WHERE {where} AND {key} > ?
+                ORDER BY {key}
+                LIMIT ?
+            """, (*params, after, limit))
+            return [row[0] for row in await cursor.fetchall()]
+
+    # --- Мероприятия ---
+
+    async def get_event(self, event_id: int) -> dict | None:
+        async with self.connect() as db:
+            cursor = await db.execute("""
+                SELECT title, description, event_datetime, location, registration_deadline,
+                       photo_file_id, capacity, waitlist_enabled
+                FROM events WHERE id = ?
+            """, (event_id,))
+            row = await cursor.fetchone()
+        if not row:
+            return None
+        return dict(zip(
+            ("title", "description", "event_datetime", "location", "registration_deadline",
+             "photo_file_id", "capacity", "waitlist_enabled"),
+            row
+        ))
+
+    async def create_event(self, title: str, description: str, event_datetime: str, registration_deadline: str,
+                           location: str, photo_file_id: str | None, created_by: int) -> int:
+        async def operation(db):
+            cursor = await db.execute("""
+                INSERT INTO events (
+                    title, description, event_datetime, registration_deadline,
+                    location, photo_file_id, created_by
+                ) VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, (title, description, event_datetime, registration_deadline, location, photo_file_id, created_by))
+            return cursor.lastrowid
+        return await self.writer.submit(operation)
+
+    async def set_capacity(self, event_id: int, capacity: int | None, waitlist: bool) -> bool:
+        return bool(await self.writer.execute(
+            "UPDATE events SET capacity = ?, waitlist_enabled = ? WHERE id = ?",
+            (capacity, int(waitlist), event_id)
+        ))
+
+    async def open_events(self, user_id: int) -> list[tuple]:
+        # Открытая регистрация, есть места (или лист ожидания), пользователь ещё не записан
+        async with self.connect() as db:
+            cursor = await db.execute("""
+                SELECT e.id, e.title, e.registration_deadline, e.photo_file_id, e.capacity, e.seats_taken
+                FROM events e
+                WHERE datetime(e.registration_deadline) >= datetime('now')
+                AND (e.capacity IS NULL OR e.seats_taken < e.capacity OR e.waitlist_enabled = 1)
+                AND NOT EXISTS (
+                    SELECT 1 FROM registrations r
+                    WHERE r.user_id = ? AND r.event_id = e.id
+                )
+                ORDER BY e.registration_deadline
+            """, (user_id,))
+            return await cursor.fetchall()
+
+    # --- Регистрации ---
+
+    async def register(self, user_id: int, event_id: int) -> str:
+        # Возвращает confirmed / waitlist / already_confirmed / already_waitlist / full / not_found.
+        # Захват места — одна условная вставка, счётчик seats_taken ведут триггеры
+        async def operation(db):
+            cursor = await db.execute("""
+                INSERT INTO registrations (user_id, event_id, status)
+                SELECT ?, e.id,
+                       CASE WHEN e.capacity IS NULL OR e.seats_taken < e.capacity
+                            THEN 'confirmed' ELSE 'waitlist' END
+                FROM events e
+                WHERE e.id = ?
+                  AND (e.capacity IS NULL OR e.seats_taken < e.capacity OR e.waitlist_enabled = 1)
+                ON CONFLICT(user_id, event_id) DO NOTHING
+                RETURNING status
+            """, (user_id, event_id))
+            row = await cursor.fetchone()
+            await cursor.close()
+            if row:
+                return row[0]
+
+            # Вставки не было — выясняем почему (редкий путь)
+            cursor = await db.execute("""
+                SELECT (SELECT status FROM registrations WHERE user_id = ? AND event_id = e.id)
+                FROM events e WHERE e.id = ?
+            """, (user_id, event_id))
+            row = await cursor.fetchone()
+            await cursor.close()
+            if not row:
+                return "not_found"
+            if row[0]:
+                return f"already_{row[0]}"
+            return "full"
+        return await self.writer.submit(operation)
+
+    async def promote_waitlist(self, event_id: int) -> list[int]:
+        # Переводит ожидающих в подтверждённые по порядку записи, пока есть свободные места
+        async def operation(db):
+            cursor = await db.execute("""
+                UPDATE registrations SET status = 'confirmed'
+                WHERE rowid IN (
+                    SELECT r.rowid FROM registrations r
+                    JOIN events e ON e.id = r.event_id
+                    WHERE r.event_id = ? AND r.status = 'waitlist'
+                    ORDER BY r.registered_at, r.rowid
+                    LIMIT (
+                        SELECT CASE WHEN capacity IS NULL THEN -1
+                                    ELSE max(capacity - seats_taken, 0) END
+                        FROM events WHERE id = ?
+                    )
+                )
+                RETURNING user_id
+            """, (event_id, event_id))
+            promoted = [row[0] for row in await cursor.fetchall()]
+            await cursor.close()
+            return promoted
+        return await self.writer.submit(operation)
+
+    async def mark_attended(self, user_id: int, event_id: int) -> bool:
+        # Ноль обновлённых строк — пользователь не зарегистрирован (или в листе ожидания)
+        return bool(await self.writer.execute("""
+            UPDATE registrations
+            SET attended = 1
+            WHERE user_id = ? AND event_id = ? AND status = 'confirmed'
+        """, (user_id, event_id)))
+
+    async def event_registrations(self, event_id: int, chunk_size: int):
+        # Пачки строк выгрузки: user_id, full_name, username, role, status,
+        # статус регистрации, registered_at, attended. Вся выборка в память не поднимается
+        async with self.connect() as db:
+            cursor = await db.execute("""
+                SELECT r.user_id, u.full_name, u.username, u.role, u.status,
+                       r.status, r.registered_at, r.attended
+                FROM registrations r
+                LEFT JOIN users u ON u.tg_id = r.user_id
+                WHERE r.event_id = ?
+                ORDER BY r.registered_at
+            """, (event_id,))
+            while rows := await cursor.fetchmany(chunk_size):
+                yield rows
+
+    async def confirmed_events(self, user_id: int) -> list[tuple[int, str]]:
+        async with self.connect() as db:
+            cursor = await db.execute("""
+                SELECT e.id, e.title FROM events e
+                JOIN registrations r ON e.id = r.event_id
+                WHERE r.user_id = ? AND r.status = 'confirmed'
+            """, (user_id,))
+            return await cursor.fetchall()
+
+    async def get_checkin_qr(self, user_id: int, event_id: int) -> str | None:
+        async with self.connect() as db:
+            cursor = await db.execute(
+                "SELECT qr_file_id FROM registrations WHERE user_id = ? AND event_id = ?",
+                (user_id, event_id)
+            )
+            row = await cursor.fetchone()
+        return row[0] if row else None
+
+    async def save_checkin_qr(self, user_id: int, event_id: int, file_id: str):
+        await self.writer.execute(
+            "UPDATE registrations SET qr_file_id = ? WHERE user_id = ? AND event_id = ?",
+            (file_id, user_id, event_id)
+        )
+
+    # --- Архив ---
+
+    async def past_event_ids(self, cutoff: str) -> list[int]:
+        async with self.connect() as db:
+            cursor = await db.execute(
+                "SELECT id FROM events WHERE event_datetime < ? ORDER BY event_datetime", (cutoff,)
+            )
+            return [row[0] for row in await cursor.fetchall()]
+
+    async def snapshot_event(self, event_id: int):
+        # Снимок до переноса регистраций: триггеры обнулят seats_taken по мере удаления.
+        # OR IGNORE сохраняет первый снимок, если прошлый проход прервался на середине.
+        await self.writer.execute(f"""
+            INSERT OR IGNORE INTO events_archive ({EVENT_ARCHIVE_COLUMNS}, archived_at)
+            SELECT {EVENT_ARCHIVE_COLUMNS}, CURRENT_TIMESTAMP FROM events WHERE id = ?
+        """, (event_id,))
+
+    async def archive_registrations_batch(self, event_id: int, limit: int) -> int:
+        # Переносим пачку регистраций и сразу учитываем её в итогах пользователей
+        async def operation(db):
+            cursor = await db.execute(
+                "SELECT rowid FROM registrations WHERE event_id = ? LIMIT ?", (event_id, limit)
+            )
+            rowids = [row[0] for row in await cursor.fetchall()]
+            if not rowids:
+                return 0
+            placeholders = ",".join("?" * len(rowids))
+            await db.execute(f"""
+                INSERT INTO registrations_archive ({REGISTRATION_ARCHIVE_COLUMNS}, archived_at)
+                SELECT {REGISTRATION_ARCHIVE_COLUMNS}, CURRENT_TIMESTAMP FROM registrations
+                WHERE rowid IN ({placeholders})
+            """, rowids)
+            await db.execute(f"""
+                INSERT INTO user_attendance_totals (user_id, registrations, attended)
+                SELECT user_id, 1, attended FROM registrations WHERE rowid IN ({placeholders})
+                ON CONFLICT(user_id) DO UPDATE SET
+                    registrations = registrations + excluded.registrations,
+                    attended = attended + excluded.attended
+            """, rowids)
+            await db.execute(f"DELETE FROM registrations WHERE rowid IN ({placeholders})", rowids)
+            return len(rowids)
+        return await self.writer.submit(operation)
+
+    async def delete_archived_event(self, event_id: int):
+        async def operation(db):
+            await db.execute("DELETE FROM event_reminders WHERE event_id = ?", (event_id,))
+            await db.execute("DELETE FROM events WHERE id = ?", (event_id,))
+        await self.writer.submit(operation)
+
+    # --- Медиа ---
+
+    async def media_assets(self) -> dict[str, str]:
+        async with self.connect() as db:
+            cursor = await db.execute("SELECT key, file_id FROM media_assets")
+            return dict(await cursor.fetchall())
+
+    async def set_media_asset(self, key: str, file_id: str, description: str):
+        await self.writer.execute("""
+            INSERT INTO media_assets (key, file_id, description)
+            VALUES (?, ?, ?)
+            ON CONFLICT(key) DO UPDATE SET file_id = excluded.file_id
+        """, (key, file_id, description))
+
+    # --- Локации ---
+
+    async def get_location(self, loc_id: str) -> dict | None:
+        async with self.connect() as db:
+            cursor = await db.execute("""
+                SELECT name, description, photo_file_id, latitude, longitude
+                FROM locations WHERE id = ?
+            """, (loc_id,))
+            row = await cursor.fetchone()
+        if not row:
+            return None
+        return dict(zip(("name", "description", "photo_file_id", "latitude", "longitude"), row))
+
+    async def save_location(self, loc_id: str, name: str, description: str, photo_file_id: str | None):
+        await self.writer.execute("""
+            INSERT INTO locations (id, name, description, photo_file_id)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(id) DO UPDATE SET
+                name = excluded.name,
+                description = excluded.description,
+                photo_file_id = excluded.photo_file_id
+        """, (loc_id, name, description, photo_file_id))
+
+    async def set_location_coords(self, loc_id: str, lat: float, lon: float) -> bool:
+        return bool(await self.writer.execute(
+            "UPDATE locations SET latitude = ?, longitude = ? WHERE id = ?", (lat, lon, loc_id)
+        ))
+
+    async def location_points(self) -> list[tuple[str, str, float, float]]:
+        async with self.connect() as db:
+            cursor = await db.execute("""
+                SELECT id, name, latitude, longitude FROM locations
+                WHERE latitude IS NOT NULL AND longitude IS NOT NULL
+            """)
+            return await cursor.fetchall()
+
+    async def list_locations(self, loc_ids: list[str] | None = None) -> list[tuple[str, str]]:
+        async with self.connect() as db:
+            if loc_ids:
+                cursor = await db.execute(
+                    f"SELECT id, name FROM locations WHERE id IN ({','.join('?' * len(loc_ids))}) ORDER BY name",
+                    loc_ids
+                )
+            else:
+                cursor = await db.execute("SELECT id, name FROM locations ORDER BY name")
+            return await cursor.fetchall()
+
+    # --- Новости ---
+
+    async def latest_news(self, limit: int) -> list[tuple[str, str]]:
+        # Ленты опрашиваются в фоне (см. main.py), здесь только чтение
+        async with self.connect() as db:
+            cursor = await db.execute("SELECT title, link FROM news_items ORDER BY id DESC LIMIT ?", (limit,))
+            return await cursor.fetchall()
+
+
+def utc_now() -> str:
+    # Как CURRENT_TIMESTAMP в SQLite: UTC, без часового пояса
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def parse_sqlite_datetime(value: str | None) -> datetime | None:
+    # Аналог datetime(...) в SQLite: нераспознанная строка даёт NULL
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class MemoryRepository:
+    # Тот же интерфейс, что у SQLiteRepository, без диска и без await на I/O
+    def __init__(self):
+        self.users: dict[int, dict] = {}
+        self.prefs: dict[int, dict] = {}
+        self.feed_optouts: dict[int, set[int]] = {}
+        self.events: dict[int, dict] = {}
+        self.event_ids = itertools.count(1)
+        # (user_id, event_id) -> регистрация; по мероприятию — в порядке записи
+        self.registrations: dict[tuple[int, int], dict] = {}
+        self.by_event: dict[int, dict[int, dict]] = {}
+        self.by_user: dict[int, dict[int, dict]] = {}
+        self.media: dict[str, str] = {}
+        self.locations: dict[str, dict] = {}
+        self.news: list[tuple[str, str]] = []
+        # Архив: снимки мероприятий и итоги посещений user_id -> [регистраций, посещено]
+        self.events_archive: dict[int, dict] = {}
+        self.attendance_totals: dict[int, list[int]] = {}
+
+    # --- Пользователи ---
+
+    async def upsert_user(self, tg_id: int, full_name: str, username: str | None):
+        user = self.users.setdefault(tg_id, {"role": "applicant", "status": DEFAULT_STATUS, "joined_at": utc_now()})
+        user.update(full_name=full_name, username=username, is_active=True)
+        self.prefs.setdefault(tg_id, {"events_enabled": True, "news_enabled": True, "news_mode": "immediate"})
+
+    async def get_user(self, tg_id: int) -> dict | None:
+        user = self.users.get(tg_id)
+        if not user:
+            return None
+        return {key: user[key] for key in ("full_name", "username", "role", "status")}
+
+    async def get_role(self, tg_id: int) -> str | None:
+        user = self.users.get(tg_id)
+        return user["role"] if user else None
+
+    async def search_users(self, query: str) -> list[tuple]:
+        if query.isdigit():
+            matches = [int(query)] if int(query) in self.users else []
+        else:
+            needle = query.lower()
+            matches = [tg_id for tg_id, user in self.users.items() if needle in (user["full_name"] or "").lower()]
+        return [(tg_id, self.users[tg_id]["full_name"], self.users[tg_id]["username"], self.users[tg_id]["role"])
+                for tg_id in matches]
+
+    async def set_role(self, tg_id: int, role: str) -> bool:
+        if tg_id not in self.users:
+            return False
+        self.users[tg_id]["role"] = role
+        return True
+
+    async def set_status(self, tg_id: int, status: str) -> bool:
+        if tg_id not in self.users:
+            return False
+        self.users[tg_id]["status"] = status
+        return True
+
+    async def bulk_update_users(self, updates: dict[int, tuple[str | None, str | None]]) -> set[int]:
+        found = {tg_id for tg_id in updates if tg_id in self.users}
+        for tg_id in found:
+            status, role = updates[tg_id]
+            if status:
+                self.users[tg_id]["status"] = status
+            if role:
+                self.users[tg_id]["role"] = role
+        return found
+
+    async def mark_inactive(self, tg_ids: list[int]):
+        for tg_id in tg_ids:
+            if tg_id in self.users:
+                self.users[tg_id]["is_active"] = False
+
+    async def attendance(self, tg_id: int) -> dict:
+        registrations = self.by_user.get(tg_id, {}).values()
+        archived_total, archived_visited = self.attendance_totals.get(tg_id, (0, 0))
+        return {
+            "total": len(registrations),
+            "visited": sum(bool(reg["attended"]) for reg in registrations),
+            "archived_total": archived_total,
+            "archived_visited": archived_visited,
+        }
+
+    async def user_event_history(self, tg_id: int) -> list[tuple[str, str]]:
+        return [(self.events[event_id]["title"], self.events[event_id]["event_datetime"])
+                for event_id in self.by_user.get(tg_id, {})]
+
+    async def stats(self) -> dict:
+        return {
+            "users": len(self.users),
+            "events": len(self.events),
+            "registrations": len(self.registrations),
+            "inactive": sum(not user["is_active"] for user in self.users.values()),
+            "archived": len(self.events_archive),
+        }
+
+    # --- Настройки уведомлений ---
+
+    def _prefs_tuple(self, user_id: int) -> tuple[bool, bool, str]:
+        prefs = self.prefs.get(user_id)
+        if not prefs:
+            return True, True, "immediate"
+        return prefs["events_enabled"], prefs["news_enabled"], prefs["news_mode"]
+
+    async def get_prefs(self, user_id: int) -> tuple[bool, bool, str]:
+        return self._prefs_tuple(user_id)
+
+    async def toggle_pref(self, user_id: int, column: str) -> tuple[bool, bool, str]:
+        if column not in PREF_COLUMNS:
+            raise ValueError(f"Неизвестная настройка: {column}")
+        if user_id in self.prefs:
+            self.prefs[user_id][column] = not self.prefs[user_id][column]
+        return self._prefs_tuple(user_id)
+
+    async def cycle_news_mode(self, user_id: int) -> tuple[bool, bool, str]:
+        if user_id in self.prefs:
+            current = self.prefs[user_id]["news_mode"]
+            self.prefs[user_id]["news_mode"] = NEWS_MODES[(NEWS_MODES.index(current) + 1) % len(NEWS_MODES)]
+        return self._prefs_tuple(user_id)
+
+    async def get_feed_optouts(self, user_id: int) -> set[int]:
+        return set(self.feed_optouts.get(user_id, ()))
+
+    async def toggle_feed_optout(self, user_id: int, feed_id: int) -> bool:
+        optouts = self.feed_optouts.setdefault(user_id, set())
+        if feed_id in optouts:
+            optouts.discard(feed_id)
+            return True
+        optouts.add(feed_id)
+        return False
+
+    async def subscriber_snapshot(self) -> tuple[list[tuple], list[tuple[int, int]]]:
+        prefs = [
+            (tg_id, p["events_enabled"], p["news_enabled"], p["news_mode"], self.users[tg_id]["is_active"])
+            for tg_id, p in self.prefs.items()
+        ]
+        optouts = [(user_id, feed_id) for user_id, feeds in self.feed_optouts.items() for feed_id in feeds]
+        return prefs, optouts
+
+    # --- Сегменты рассылок ---
+
+    def _in_segment(self, tg_id: int, segment: dict, active: bool) -> bool:
+        # Те же условия, что собирает segment_query
+        user, prefs = self.users.get(tg_id), self.prefs.get(tg_id)
+        if not user or not prefs or bool(user["is_active"]) != active:
+            return False
+
+        pref = segment.get("pref")
+        if pref == "events" and not prefs["events_enabled"]:
+            return False
+        if pref == "news" and not prefs["news_enabled"]:
+            return False
+        if pref == "any" and not (prefs["events_enabled"] or prefs["news_enabled"]):
+            return False
+        if segment.get("mode") and prefs["news_mode"] != segment["mode"]:
+            return False
+        if segment.get("feed") and segment["feed"] in self.feed_optouts.get(tg_id, ()):
+            return False
+
+        kind, value = segment.get("kind", "all"), segment.get("value")
+        if kind == "role":
+            return user["role"] == value
+        if kind == "status":
+            return user["status"] == value
+        if kind == "event":
+            registration = self.registrations.get((tg_id, value))
+            return bool(registration) and registration["status"] == "confirmed"
+        if kind == "not_event":
+            return (tg_id, value) not in self.registrations
+        if kind == "joined":
+            since, until = value
+            if since and user["joined_at"] < since:
+                return False
+            if until:
+                next_day = (datetime.strptime(until, "%Y-%m-%d") + timedelta(days=1)).strftime("%Y-%m-%d")
+                return user["joined_at"] < next_day
+        return True
+
+    def _segment_ids(self, segment: dict, active: bool) -> list[int]:
+        if segment.get("kind") == "event":
+            candidates = self.by_event.get(segment["value"], {})
+        else:
+            candidates = self.users
+        return sorted(tg_id for tg_id in candidates if self._in_segment(tg_id, segment, active))
+
+    async def count_segment(self, segment: dict, active: bool = True) -> int:
+        return len(self._segment_ids(segment, active))
+
+    async def segment_page(self, segment: dict, after: int, limit: int) -> list[int]:
+        return [tg_id for tg_id in self._segment_ids(segment, True) if tg_id > after][:limit]
+
+    # --- Мероприятия ---
+
+    async def get_event(self, event_id: int) -> dict | None:
+        event = self.events.get(event_id)
+        if not event:
+            return None
+        return {key: event[key] for key in (
+            "title", "description", "event_datetime", "location", "registration_deadline",
+            "photo_file_id", "capacity", "waitlist_enabled"
+        )}
+
+    async def create_event(self, title: str, description: str, event_datetime: str, registration_deadline: str,
+                           location: str, photo_file_id: str | None, created_by: int) -> int:
+        event_id = next(self.event_ids)
+        self.events[event_id] = {
+            "title": title, "description": description, "event_datetime": event_datetime,
+            "registration_deadline": registration_deadline, "location": location,
+            "photo_file_id": photo_file_id, "created_by": created_by,
+            "capacity": None, "waitlist_enabled": 0, "seats_taken": 0,
+        }
+        return event_id
+
+    async def set_capacity(self, event_id: int, capacity: int | None, waitlist: bool) -> bool:
+        event = self.events.get(event_id)
+        if not event:
+            return False
+        event.update(capacity=capacity, waitlist_enabled=int(waitlist))
+        return True
+
+    async def open_events(self, user_id: int) -> list[tuple]:
+        # datetime('now') в SQLite — UTC
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        registered = self.by_user.get(user_id, {})
+        result = []
+        for event_id, event in self.events.items():
+            deadline = parse_sqlite_datetime(event["registration_deadline"])
+            has_room = (event["capacity"] is None or event["seats_taken"] < event["capacity"]
+                        or event["waitlist_enabled"])
+            if deadline and deadline >= now and has_room and event_id not in registered:
+                result.append((event_id, event["title"], event["registration_deadline"], event["photo_file_id"],
+                               event["capacity"], event["seats_taken"]))
+        result.sort(key=lambda row: row[2])
+        return result
+
+    # --- Регистрации ---
+
+    async def register(self, user_id: int, event_id: int) -> str:
+        event = self.events.get(event_id)
+        if not event:
+            return "not_found"
+        existing = self.registrations.get((user_id, event_id))
+        if existing:
+            return f"already_{existing['status']}"
+
+        if event["capacity"] is None or event["seats_taken"] < event["capacity"]:
+            status = "confirmed"
+            event["seats_taken"] += 1
+        elif event["waitlist_enabled"]:
+            status = "waitlist"
+        else:
+            return "full"
+
+        registration = {"status": status, "attended": False, "qr_file_id": None, "registered_at": utc_now()}
+        self.registrations[(user_id, event_id)] = registration
+        self.by_event.setdefault(event_id, {})[user_id] = registration
+        self.by_user.setdefault(user_id, {})[event_id] = registration
+        return status
+
+    async def promote_waitlist(self, event_id: int) -> list[int]:
+        event = self.events.get(event_id)
+        if not event:
+            return []
+        promoted = []
+        for user_id, registration in self.by_event.get(event_id, {}).items():
+            if event["capacity"] is not None and event["seats_taken"] >= event["capacity"]:
+                break
+            if registration["status"] == "waitlist":
+                registration["status"] = "confirmed"
+                event["seats_taken"] += 1
+                promoted.append(user_id)
+        return promoted
+
+    async def mark_attended(self, user_id: int, event_id: int) -> bool:
+        registration = self.registrations.get((user_id, event_id))
+        if not registration or registration["status"] != "confirmed":
+            return False
+        registration["attended"] = True
+        return True
+
+    async def event_registrations(self, event_id: int, chunk_size: int):
+        rows = []
+        for user_id, registration in self.by_event.get(event_id, {}).items():
+            user = self.users.get(user_id, {})
+            rows.append((user_id, user.get("full_name"), user.get("username"), user.get("role"), user.get("status"),
+                         registration["status"], registration["registered_at"], registration["attended"]))
+        for i in range(0, len(rows), chunk_size):
+            yield rows[i:i + chunk_size]
+
+    async def confirmed_events(self, user_id: int) -> list[tuple[int, str]]:
+        return [(event_id, self.events[event_id]["title"])
+                for event_id, registration in self.by_user.get(user_id, {}).items()
+                if registration["status"] == "confirmed"]
+
+    async def get_checkin_qr(self, user_id: int, event_id: int) -> str | None:
+        registration = self.registrations.get((user_id, event_id))
+        return registration["qr_file_id"] if registration else None
+
+    async def save_checkin_qr(self, user_id: int, event_id: int, file_id: str):
+        registration = self.registrations.get((user_id, event_id))
+        if registration:
+            registration["qr_file_id"] = file_id
+
+    # --- Архив ---
+
+    async def past_event_ids(self, cutoff: str) -> list[int]:
+        past = [(event["event_datetime"], event_id) for event_id, event in self.events.items()
+                if event["event_datetime"] < cutoff]
+        return [event_id for _, event_id in sorted(past)]
+
+    async def snapshot_event(self, event_id: int):
+        event = self.events.get(event_id)
+        if event:
+            self.events_archive.setdefault(event_id, dict(event))
+
+    async def archive_registrations_batch(self, event_id: int, limit: int) -> int:
+        registrations = self.by_event.get(event_id, {})
+        batch = list(itertools.islice(registrations, limit))
+        for user_id in batch:
+            registration = registrations.pop(user_id)
+            del self.registrations[(user_id, event_id)]
+            del self.by_user[user_id][event_id]
+            if registration["status"] == "confirmed":
+                self.events[event_id]["seats_taken"] -= 1
+            totals = self.attendance_totals.setdefault(user_id, [0, 0])
+            totals[0] += 1
+            totals[1] += int(registration["attended"])
+        return len(batch)
+
+    async def delete_archived_event(self, event_id: int):
+        self.events.pop(event_id, None)
+        self.by_event.pop(event_id, None)
+
+    # --- Медиа ---
+
+    async def media_assets(self) -> dict[str, str]:
+        return dict(self.media)
+
+    async def set_media_asset(self, key: str, file_id: str, description: str):
+        self.media[key] = file_id
+
+    # --- Локации ---
+
+    async def get_location(self, loc_id: str) -> dict | None:
+        location = self.locations.get(loc_id)
+        return dict(location) if location else None
+
+    async def save_location(self, loc_id: str, name: str, description: str, photo_file_id: str | None):
+        location = self.locations.setdefault(loc_id, {"latitude": None, "longitude": None})
+        location.update(name=name, description=description, photo_file_id=photo_file_id)
+
+    async def set_location_coords(self, loc_id: str, lat: float, lon: float) -> bool:
+        location = self.locations.get(loc_id)
+        if not location:
+            return False
+        location.update(latitude=lat, longitude=lon)
+        return True
+
+    async def location_points(self) -> list[tuple[str, str, float, float]]:
+        return [(loc_id, location["name"], location["latitude"], location["longitude"])
+                for loc_id, location in self.locations.items()
+                if location["latitude"] is not None and location["longitude"] is not None]
+
+    async def list_locations(self, loc_ids: list[str] | None = None) -> list[tuple[str, str]]:
+        ids = [loc_id for loc_id in loc_ids if loc_id in self.locations] if loc_ids else list(self.locations)
+        return sorted(((loc_id, self.locations[loc_id]["name"]) for loc_id in ids), key=lambda row: row[1])
+
+    # --- Новости ---
+
+    async def latest_news(self, limit: int) -> list[tuple[str, str]]:
+        # Новости (title, link) от старых к новым; в памяти ленты не опрашиваются
+        return self.news[-limit:][::-1]
@@ -0,0 +1,31 @@
+"""Общие фикстуры тестов.
+
+main.py хранит состояние в глобальных переменных модуля, поэтому каждый тест
+получает свою временную базу, свежий репозиторий и пустые кэши. Асинхронные
+сценарии запускаются через asyncio.run внутри обычных тестов.
+"""
+import os
+import sys
+
+# main.py требует токен и ID модератора при импорте; к Telegram тесты не обращаются
+os.environ.setdefault("BOT_TOKEN", "123456:test")
+os.environ.setdefault("MODER_ID", "0")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+import main
+from repository import SQLiteRepository
+
+
+@pytest.fixture
+def bot_state(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "DB_PATH", str(tmp_path / "test.db"))
+    # Очередь писателя привязывается к циклу, а у каждого теста свой asyncio.run
+    monkeypatch.setattr(main, "db_writer", main.GroupCommitWriter(main.WRITE_BATCH_SIZE, main.WRITE_BATCH_DELAY))
+    monkeypatch.setattr(main, "repo", SQLiteRepository(main.connect_db, main.db_writer))
+    monkeypatch.setattr(main, "MEDIA_CACHE", None)
+    monkeypatch.setattr(main, "event_cache", main.RowCache(main.load_event_row, main.ROW_CACHE_SIZE))
+    monkeypatch.setattr(main, "location_cache", main.RowCache(main.load_location_row, main.ROW_CACHE_SIZE))
+    monkeypatch.setattr(main, "subscribers", main.SubscriberIndex())
+    return main
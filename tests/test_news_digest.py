@@ -0,0 +1,53 @@
+"""Дайджест не должен рассылать новости, сохранённые при первом опросе ленты."""
+import asyncio
+
+import aiosqlite
+from aiogram import Bot
+from aiogram.methods import SendMessage
+
+import bench
+import main
+
+
+class MessageRecorder(bench.NullSession):
+    def __init__(self):
+        super().__init__()
+        self.texts: list[str] = []
+
+    async def make_request(self, bot, method, timeout=None):
+        if isinstance(method, SendMessage):
+            self.texts.append(method.text)
+        return await super().make_request(bot, method, timeout)
+
+
+def entry(n: int) -> dict:
+    return {"link": f"https://example.org/news/{n}", "title": f"Новость {n}", "description": ""}
+
+
+def test_digest_skips_primed_items(bot_state, monkeypatch):
+    session = MessageRecorder()
+    monkeypatch.setattr(main, "bot", Bot(token=main.BOT_TOKEN, session=session))
+
+    async def run():
+        await bench.prepare_db(main.DB_PATH, 3)
+        try:
+            async with aiosqlite.connect(main.DB_PATH) as db:
+                await db.execute("UPDATE notification_prefs SET news_mode = 'hourly'")
+                cursor = await db.execute("INSERT INTO news_feeds (name, url) VALUES ('Test', 'https://example.org/rss')")
+                feed = main.NewsFeed(cursor.lastrowid, "Test", "https://example.org/rss", False)
+                await db.commit()
+
+            # Курсор режима создаётся раньше, чем первый опрос ленты успевает сохранить её содержимое
+            await main.send_news_digest("hourly")
+            await main.store_news_items(feed, [entry(n) for n in range(1, 6)])
+            feed.primed = True
+            await main.store_news_items(feed, [entry(6)])
+            await main.send_news_digest("hourly")
+        finally:
+            await main.db_writer.close()
+
+    asyncio.run(run())
+    assert len(session.texts) == 3
+    for text in session.texts:
+        assert "Новость 6" in text
+        assert "Новость 1<" not in text
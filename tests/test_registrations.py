@@ -0,0 +1,71 @@
+"""Одновременные нажатия «Зарегистрироваться» через диспетчер: мест не больше вместимости."""
+import asyncio
+from datetime import datetime
+
+import aiosqlite
+from aiogram import Bot, types
+from aiogram.methods import AnswerCallbackQuery
+
+import bench
+import main
+
+CAPACITY = 300
+USERS = 2000
+
+
+class AnswerRecorder(bench.NullSession):
+    # Запоминает ответы на колбэки: по ним видно, что сказали каждому пользователю
+    def __init__(self):
+        super().__init__()
+        self.answers: dict[str, str] = {}
+
+    async def make_request(self, bot, method, timeout=None):
+        if isinstance(method, AnswerCallbackQuery):
+            self.answers[method.callback_query_id] = method.text
+        return await super().make_request(bot, method, timeout)
+
+
+def register_update(tg_id: int, event_id: int) -> types.Update:
+    user = types.User(id=tg_id, is_bot=False, first_name=f"User {tg_id}")
+    chat = types.Chat(id=tg_id, type="private")
+    return types.Update(update_id=tg_id, callback_query=types.CallbackQuery(
+        id=str(tg_id), from_user=user, chat_instance="test", data=f"reg_{event_id}",
+        message=types.Message(message_id=1, date=datetime.now(), chat=chat, from_user=user, caption="event")
+    ))
+
+
+def test_concurrent_registrations_fill_capacity(bot_state):
+    session = AnswerRecorder()
+    bot = Bot(token=main.BOT_TOKEN, session=session)
+
+    async def run():
+        await bench.prepare_db(main.DB_PATH, USERS)
+        try:
+            event_id = await main.repo.create_event(
+                "Test", "", "2099-01-01 18:00", "2099-01-01 12:00", "Кампус", None, 0
+            )
+            await main.repo.set_capacity(event_id, CAPACITY, False)
+            await asyncio.gather(*(
+                main.dp.feed_update(bot, register_update(tg_id, event_id)) for tg_id in range(1, USERS + 1)
+            ))
+        finally:
+            await main.db_writer.close()
+
+        async with aiosqlite.connect(main.DB_PATH) as db:
+            cursor = await db.execute(
+                "SELECT COUNT(*) FROM registrations WHERE event_id = ? AND status = 'confirmed'", (event_id,)
+            )
+            registered = (await cursor.fetchone())[0]
+            cursor = await db.execute("SELECT seats_taken FROM events WHERE id = ?", (event_id,))
+            seats_taken = (await cursor.fetchone())[0]
+        return registered, seats_taken
+
+    registered, seats_taken = asyncio.run(run())
+    assert registered == seats_taken == CAPACITY
+
+    answers = session.answers
+    assert len(answers) == USERS
+    confirmed = [tg_id for tg_id, text in answers.items() if text.startswith("✅ Регистрация подтверждена")]
+    full = [tg_id for tg_id, text in answers.items() if text == "😔 Свободных мест не осталось."]
+    assert len(confirmed) == CAPACITY
+    assert len(full) == USERS - CAPACITY
@@ -0,0 +1,78 @@
+"""SQLiteRepository и MemoryRepository на одном сценарии должны давать одинаковые ответы."""
+import asyncio
+from datetime import datetime, timezone
+
+import bench
+import main
+from repository import MemoryRepository, SQLiteRepository
+
+
+async def scenario(repository) -> dict:
+    main.repo = repository
+    for tg_id in range(1, 5):
+        await repository.upsert_user(tg_id, f"User {tg_id}", None)
+
+    past = await repository.create_event("Прошедшее", "", "2000-01-01 18:00", "2000-01-01 12:00", "Кампус", None, 0)
+    await repository.set_capacity(past, 2, True)
+    future = await repository.create_event("Будущее", "", "2099-01-01 18:00", "2099-01-01 12:00", "Кампус", None, 0)
+
+    results = {
+        "register": [await repository.register(tg_id, past) for tg_id in (1, 2, 3, 1)]
+                    + [await repository.register(4, future), await repository.register(4, 999)],
+        "attended": [await repository.mark_attended(1, past), await repository.mark_attended(3, past)],
+        "set_status": await repository.set_status(2, "Зачислен"),
+        "set_role": await repository.set_role(3, "student"),
+        "toggle": await repository.toggle_pref(1, "events_enabled"),
+        "bulk": sorted(await repository.bulk_update_users({2: (None, "curator"), 3: ("Зачислен", None), 77: ("X", None)})),
+    }
+    await repository.mark_inactive([4])
+    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    segments = [
+        {"kind": "all"}, {"pref": "events", "kind": "event", "value": past}, {"kind": "event", "value": past},
+        {"pref": "events", "kind": "not_event", "value": past}, {"kind": "role", "value": "curator"},
+        {"kind": "status", "value": "Зачислен"}, {"pref": "news", "kind": "all", "mode": "immediate"},
+        {"kind": "joined", "value": (today, today)}, {"kind": "joined", "value": (None, "2000-01-01")},
+    ]
+    for i, segment in enumerate(segments):
+        results[f"segment_{i}"] = (
+            await repository.count_segment(segment), await repository.count_segment(segment, active=False),
+            await repository.segment_page(segment, 0, 2), await repository.segment_page(segment, 2, 10),
+        )
+    # registered_at у бэкендов разный — сравниваем остальные колонки выгрузки
+    results["export"] = [[row[:6] + row[7:] for row in rows] async for rows in repository.event_registrations(past, 2)]
+    results |= {
+        "stats_before": await repository.stats(),
+        "archived": await main.archive_past_events(),
+        "stats_after": await repository.stats(),
+    }
+    for tg_id in range(1, 5):
+        results[tg_id] = (
+            await repository.get_user(tg_id),
+            await repository.attendance(tg_id),
+            await repository.confirmed_events(tg_id),
+            [row[0] for row in await repository.open_events(tg_id)],
+            await repository.get_prefs(tg_id),
+        )
+    return results
+
+
+def test_backends_agree(bot_state):
+    async def run():
+        await bench.prepare_db(main.DB_PATH, 0)
+        try:
+            sqlite = await scenario(SQLiteRepository(main.connect_db, main.db_writer))
+        finally:
+            await main.db_writer.close()
+        memory = await scenario(MemoryRepository())
+        return sqlite, memory
+
+    sqlite, memory = asyncio.run(run())
+    assert sqlite == memory
+    # Сценарий действительно проверяет архив и статус по умолчанию
+    assert sqlite["archived"] == (1, 3)
+    assert sqlite["stats_after"]["archived"] == 1
+    assert sqlite[1][1] == {"total": 0, "visited": 0, "archived_total": 1, "archived_visited": 1}
+    assert sqlite[1][0]["status"] == "Не зачислен"
+    assert sqlite["bulk"] == [2, 3]
+    assert sqlite["segment_1"] == (1, 0, [2], [])
+    assert [len(rows) for rows in sqlite["export"]] == [2, 1]